@@ -0,0 +1,150 @@
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from dsmz_processing import STAGING_DATA_DIR
+import os
+
+#Typed artifacts handed from one stage to the next: staging_data/artifacts/<name>/ holds one .npy file per column
+    # (numbers as int64/float64, strings as fixed width unicode) and a schema.json (columns, dtypes, lengths, metadata)
+ARTIFACTS_DIR = os.path.join(STAGING_DATA_DIR, "artifacts")
+SCHEMA = "schema.json"
+FORMAT_VERSION = 1
+#Also write the legacy text files (json/tsv/csv) next to every artifact (or later with `python scripts/artifacts.py`)
+WRITE_LEGACY_FILES = False
+
+LABELS = "labels_no_fungi"                      #row_labels, column_labels
+DEGREES_I = "degrees_i"                         #weighted_degree (initial graph, node order)
+DEGREES_II = "degrees_ii"                       #weighted_degree (after the sparsification)
+LAYOUT = "graph_layout_no_fungi"                #labels, x, y, z, community, stability + modularity
+BC_CC = "ncbi_bc_cc_no_fungi"                   #ncbi, bc, cc (sorted by ncbi)
+COMMUNITY_NODES = "community_nodes_no_fungi"    #ncbi, rank, community (nodes of the communities of size >= 2)
+COMMUNITY_RANKS = "community_ranks_no_fungi"    #community_id, community_size, rank, count, percentage
+
+
+def _column_array(values):
+    array = np.asarray(values)
+    if array.dtype == object or array.dtype.kind == "S":
+        array = array.astype(str)
+    elif array.dtype.kind in "iub":
+        array = array.astype(np.int64)
+    elif array.dtype.kind == "f":
+        array = array.astype(np.float64)
+    return array
+
+
+# Writes the artifact `name`: columns {column: values} (1D, lengths may differ) and json metadata. The previous
+    # version is replaced only once the new one is complete
+def write_artifact(name, columns, meta=None, directory=ARTIFACTS_DIR, legacy=None):
+    target = os.path.join(directory, name)
+    partial = target + ".partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+
+    schema = {"name": name, "version": FORMAT_VERSION, "columns": {}, "meta": meta or {}}
+    for column, values in columns.items():
+        array = _column_array(values)
+        np.save(os.path.join(partial, f"{column}.npy"), array)
+        schema["columns"][column] = {"file": f"{column}.npy", "dtype": array.dtype.str, "length": len(array)}
+    with open(os.path.join(partial, SCHEMA), "w") as f:
+        json.dump(schema, f, indent=2)
+
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(partial, target)
+    if WRITE_LEGACY_FILES if legacy is None else legacy:
+        export_legacy(name, directory)
+
+
+# Read side of an artifact: the schema is read at once, a column only when it is used (memory-mapped, read only)
+class Artifact:
+
+    def __init__(self, name, directory=ARTIFACTS_DIR):
+        self.name = name
+        self.directory = os.path.join(directory, name)
+        with open(os.path.join(self.directory, SCHEMA), "r") as f:
+            self.schema = json.load(f)
+        if self.schema["version"] != FORMAT_VERSION:
+            raise ValueError(f"{name}: artifact format {self.schema['version']}, expected {FORMAT_VERSION}")
+        self._columns = {}
+
+    @staticmethod
+    def exists(name, directory=ARTIFACTS_DIR):
+        return os.path.exists(os.path.join(directory, name, SCHEMA))
+
+    @property
+    def columns(self):
+        return list(self.schema["columns"])
+
+    @property
+    def meta(self):
+        return self.schema["meta"]
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            info = self.schema["columns"][column]
+            self._columns[column] = np.load(os.path.join(self.directory, info["file"]), mmap_mode="r")
+        return self._columns[column]
+
+    # DataFrame of the given columns (all by default), only those are read
+    def frame(self, columns=None):
+        return pd.DataFrame({column: np.asarray(self[column]) for column in (columns or self.columns)})
+
+
+# Memory-mapped columns of an artifact, in the given order
+def load_columns(name, *columns, directory=ARTIFACTS_DIR):
+    artifact = Artifact(name, directory)
+    return tuple(artifact[column] for column in columns)
+
+
+# Legacy text files (the formats the stages exchanged before the artifacts), written from the artifacts
+
+def _legacy_labels(artifact, directory):
+    row_labels, column_labels = artifact["row_labels"].tolist(), artifact["column_labels"].tolist()
+    with open(os.path.join(directory, "labels_no_fungi.json"), "w") as f:
+        json.dump({
+            "row_labels": row_labels,
+            "column_labels": column_labels,
+            "r_label_to_index": {label: idx for idx, label in enumerate(row_labels)},
+            "c_label_to_index": {label: idx for idx, label in enumerate(column_labels)}
+        }, f, indent=2)
+
+
+def _legacy_degrees(artifact, directory):
+    pd.DataFrame({"weighted_degree": np.asarray(artifact["weighted_degree"])}).to_csv(
+        os.path.join(directory, f"{artifact.name}.csv"), index=False)
+
+
+def _legacy_layout(artifact, directory):
+    labels = artifact["labels"].tolist()
+    communities = artifact["community"].tolist()
+    pos3 = np.column_stack([artifact["x"], artifact["y"], artifact["z"]]).tolist()
+    unique_comms = sorted(set(communities))
+    output = {"labels": labels, "pos3": dict(zip(labels, pos3)), "communities": communities,
+              "unique_comms": unique_comms, "N": len(unique_comms), "modularity": artifact.meta["modularity"],
+              "stability": artifact["stability"].tolist()}
+    with open(os.path.join(directory, "graph_layout_data_no_fungi.json"), "w") as f:
+        json.dump(output, f)
+
+
+def _legacy_bc_cc(artifact, directory):
+    with open(os.path.join(directory, "ncbi_bc_cc(2000-70%)_no_fungi.txt"), "w") as f:
+        f.write("ncbi\tbc\tcc\n")
+        for ncbi, bc_val, cc_val in zip(artifact["ncbi"].tolist(), artifact["bc"].tolist(), artifact["cc"].tolist()):
+            f.write(f"{ncbi}\t{bc_val:.25f}\t{cc_val:.25f}\n")
+
+
+#The community tables are also always written as CSV by community_analysis.py
+LEGACY_EXPORTERS = {LABELS: _legacy_labels, DEGREES_I: _legacy_degrees, DEGREES_II: _legacy_degrees,
+                    LAYOUT: _legacy_layout, BC_CC: _legacy_bc_cc}
+
+
+def export_legacy(name, directory=ARTIFACTS_DIR, output_dir=STAGING_DATA_DIR):
+    if name in LEGACY_EXPORTERS:
+        LEGACY_EXPORTERS[name](Artifact(name, directory), output_dir)
+
+
+if __name__ == "__main__":
+    for name in LEGACY_EXPORTERS:
+        if Artifact.exists(name):
+            export_legacy(name)
+            print(f"Exported {name}")
@@ -0,0 +1,144 @@
+import random
+import warnings
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import dijkstra
+from scipy.sparse.linalg import spsolve_triangular
+from dissimilarity import map_tasks
+
+#Sources handled by one task (partial dependency vectors are summed in task order, so results only depend on this)
+SOURCE_BLOCK = 25
+#Adaptive mode: sources added between two checks of the top-N ranking
+ADAPTIVE_BATCH = 100
+
+#Graph shared with the worker processes (inherited through fork, see dissimilarity.map_tasks)
+_shared = {}
+
+
+# Brandes dependencies of all the nodes on the shortest paths (weights are distances) from source s, as in
+    # networkx: Dijkstra distances, shortest-path DAG (v precedes w if dist[v] + w_vw == dist[w]), path counts sigma
+    # and dependencies delta by two triangular solves on the DAG with the nodes sorted by distance
+def _source_dependencies(adjacency, entry_rows, s):
+    n = adjacency.shape[0]
+    dist = dijkstra(adjacency, indices=s)
+    reached = np.flatnonzero(np.isfinite(dist))
+    order = reached[np.argsort(dist[reached], kind="stable")]
+    m = len(order)
+    pos = np.full(n, -1, dtype=np.int64)
+    pos[order] = np.arange(m)
+
+    on_path = (pos[entry_rows] >= 0) & (dist[entry_rows] + adjacency.data == dist[adjacency.indices])
+    dag = sp.csr_matrix((np.ones(on_path.sum()), (pos[adjacency.indices[on_path]], pos[entry_rows[on_path]])),
+                        shape=(m, m))
+
+    #sigma = (I - L)^-1 e_s, u = (I - L^T)^-1 (1 / sigma), delta = sigma * (L^T u)
+    first = np.zeros(m)
+    first[0] = 1.0
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", sp.SparseEfficiencyWarning)
+        sigma = spsolve_triangular(-dag, first, lower=True, unit_diagonal=True)
+        u = spsolve_triangular((-dag).T.tocsr(), 1.0 / sigma, lower=False, unit_diagonal=True)
+    delta = sigma * (dag.T @ u)
+
+    dependencies = np.zeros(n)
+    dependencies[order] = delta
+    dependencies[s] = 0.0
+    return dependencies
+
+
+# Dependencies of the sources [i0, i1) of component c (on the component's own CSR adjacency)
+def _betweenness_block(c, i0, i1):
+    _, adjacency, entry_rows, sources = _shared["components"][c]
+    total = np.zeros(adjacency.shape[0])
+    for s in sources[i0:i1]:
+        total += _source_dependencies(adjacency, entry_rows, s)
+    return total
+
+
+# Sum of the dependencies of the given sources (CSR row indices). Paths never leave a connected component, so every
+    # component with at least 3 nodes (smaller ones have no intermediate nodes) is solved on its own with its sources:
+    # blocks of sources of the largest components first, in parallel over the fork pool, summed in task order
+def _dependency_sums(graph, sources, block_size, n_jobs):
+    adjacency = graph.adjacency.astype(np.float64)
+    sources = np.asarray(sources, dtype=np.int64)
+    component = np.full(adjacency.shape[0], -1, dtype=np.int64)
+    local = np.zeros(adjacency.shape[0], dtype=np.int64)
+
+    components = []
+    for rows in graph.components():
+        if len(rows) < 3:
+            break
+        c = len(components)
+        component[rows] = c
+        local[rows] = np.arange(len(rows))
+        sub = adjacency[rows][:, rows].tocsr()
+        sub.sort_indices()
+        entry_rows = np.repeat(np.arange(len(rows)), np.diff(sub.indptr))
+        components.append((rows, sub, entry_rows, local[sources[component[sources] == c]]))
+
+    _shared["components"] = components
+    try:
+        total = np.zeros(adjacency.shape[0])
+        tasks = [(c, i0, min(i0 + block_size, len(comp_sources)))
+                 for c, (_, _, _, comp_sources) in enumerate(components) for i0 in range(0, len(comp_sources), block_size)]
+        for (c, _, _), partial in zip(tasks, map_tasks(_betweenness_block, tasks, n_jobs=n_jobs)):
+            total[components[c][0]] += partial
+    finally:
+        _shared.clear()
+    return total
+
+
+# Normalization of nx.betweenness_centrality(normalized=True, endpoints=False): with k sampled sources, the sources
+    # themselves are scaled by 1/((k-1)(n-2)) and the other nodes by 1/(k(n-2))
+def _rescale(totals, n, sources):
+    if n - 1 < 2:
+        return totals
+    k = len(sources)
+    if k == n:
+        return totals / ((n - 1) * (n - 2))
+    scale = np.full(len(totals), 1.0 / (k * (n - 2)))
+    scale[sources] = 1.0 / ((k - 1) * (n - 2)) if k > 1 else np.nan
+    return totals * scale
+
+
+# Approximate betweenness centrality of the nodes of a CSRGraph (in `nodes` order), weights used as distances.
+    # Same sampled sources as nx.betweenness_centrality(G, k=k, weight="weight", seed=seed) on graph.to_networkx()
+def betweenness_centrality(graph, k=None, seed=42, block_size=SOURCE_BLOCK, n_jobs=None):
+    n = graph.n_nodes
+    if k is None or k == n:
+        sources = graph.nodes
+    else:
+        sources = graph.nodes[random.Random(seed).sample(range(n), k)]
+
+    totals = _rescale(_dependency_sums(graph, sources, block_size, n_jobs), n, sources)
+    return totals[graph.nodes]
+
+
+# Adaptive sampling: sources are added ADAPTIVE_BATCH at a time (in a random order fixed by seed) until the top_n nodes
+    # change by at most a fraction tol between two batches, or max_k sources are used.
+    # Returns the betweenness (in `nodes` order) and the number of sources used
+def adaptive_betweenness_centrality(graph, top_n=100, tol=0.01, max_k=None, batch=ADAPTIVE_BATCH, seed=42,
+                                    block_size=SOURCE_BLOCK, n_jobs=None):
+    n = graph.n_nodes
+    max_k = n if max_k is None else min(max_k, n)
+    top_n = min(top_n, n)
+    order = list(range(n))
+    random.Random(seed).shuffle(order)
+    sources = graph.nodes[order]
+
+    totals = np.zeros(len(graph.labels))
+    used = 0
+    previous_top = None
+    while used < max_k:
+        new_sources = sources[used:min(used + batch, max_k)]
+        totals += _dependency_sums(graph, new_sources, block_size, n_jobs)
+        used += len(new_sources)
+
+        centrality = _rescale(totals, n, sources[:used])[graph.nodes]
+        top = set(np.argsort(-centrality, kind="stable")[:top_n].tolist())
+        if previous_top is not None and 1 - len(top & previous_top) / top_n <= tol:
+            break
+        previous_top = top
+
+    print(f"Adaptive betweenness: {used} sampled sources")
+    return centrality, used
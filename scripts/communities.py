@@ -0,0 +1,228 @@
+import itertools
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+from dissimilarity import map_tasks
+
+#Minimum modularity gain for a node move (same role as MIN in python-louvain)
+MIN_GAIN = 1e-10
+
+#Graph shared with the worker processes (inherited through fork, see dissimilarity.map_tasks)
+_shared = {}
+
+
+# Louvain matrix of a CSRGraph in node order: symmetric, self-loops counted twice on the diagonal, so that row sums
+    # are the networkx weighted degrees and modularity is the one of python-louvain
+def _modularity_matrix(graph):
+    adjacency = graph.adjacency.astype(np.float64)[graph.nodes][:, graph.nodes].tocsr()
+    adjacency = (adjacency + sp.diags(adjacency.diagonal())).tocsr()
+    adjacency.sort_indices()
+    return adjacency
+
+
+def modularity(matrix, community, resolution=1.0):
+    two_m = matrix.sum()
+    if two_m == 0:
+        return 0.0
+    coo = matrix.tocoo()
+    internal = coo.data[community[coo.row] == community[coo.col]].sum()
+    totals = np.bincount(community, weights=np.asarray(matrix.sum(axis=1)).ravel())
+    return internal / two_m - resolution * np.sum((totals / two_m) ** 2)
+
+
+# Greedy random coloring of the graph without self-loops (Jones-Plassmann): every round, the uncolored nodes whose
+    # random priority beats the one of all their uncolored neighbours take the next color. Returns the nodes of every
+    # color
+def _coloring(matrix, rng):
+    n = matrix.shape[0]
+    rows = np.repeat(np.arange(n), np.diff(matrix.indptr))
+    cols = matrix.indices
+    rows, cols = rows[rows != cols], cols[rows != cols]
+    priority = rng.permutation(n)
+    color = np.full(n, -1, dtype=np.int64)
+    n_colors = 0
+    while (color < 0).any():
+        uncolored = (color[rows] < 0) & (color[cols] < 0)
+        rows, cols = rows[uncolored], cols[uncolored]
+        beaten = np.zeros(n, dtype=bool)
+        beaten[rows[priority[cols] > priority[rows]]] = True
+        color[(color < 0) & ~beaten] = n_colors
+        n_colors += 1
+    order = np.argsort(color, kind="stable")
+    return np.split(order, np.cumsum(np.bincount(color))[:-1])
+
+
+# Exact modularity change of moving the (pairwise non adjacent) nodes of a batch from sources to targets: link_gain is
+    # the weight of every node towards its target minus the one towards its source. Returns it with the new totals
+def _batch_gain(totals, sources, targets, k, link_gain, two_m, resolution):
+    n = len(totals)
+    new_totals = totals - np.bincount(sources, weights=k, minlength=n) + np.bincount(targets, weights=k, minlength=n)
+    touched = np.unique(np.r_[sources, targets])
+    squares = np.sum(new_totals[touched] ** 2 - totals[touched] ** 2)
+    return 2 * link_gain.sum() / two_m - resolution * squares / two_m ** 2, new_totals
+
+
+# One pass of the local moving phase: the color classes (see _coloring, in random order) move one after the other, every
+    # node of a class to the neighbouring community with the largest modularity gain. Nodes of a class are never
+    # adjacent, so the gains of a whole class come from one pass over their CSR segments. The gains of a class share the
+    # totals before its moves, so a batch that would lower the modularity is replaced by its best single move (exact
+    # gain): the modularity never decreases. Updates community in place, returns the number of moved nodes, the
+    # modularity improvement and the new community totals
+def _moving_pass(matrix, classes, community, totals, degree, resolution, rng):
+    n = matrix.shape[0]
+    indices, data = matrix.indices, matrix.data
+    two_m = degree.sum()
+    moved, improvement = 0, 0.0
+    for c in rng.permutation(len(classes)):
+        nodes, entry_rows, entries = classes[c]
+        if len(entries) == 0:
+            continue
+        own, k = community[nodes], degree[nodes]
+
+        #Links of every (node, neighbouring community) pair, pairs sorted by node then community
+        pairs, inverse = np.unique(entry_rows * n + community[indices[entries]], return_inverse=True)
+        links = np.bincount(inverse.ravel(), weights=data[entries], minlength=len(pairs))
+        pair_rows, candidates = pairs // n, pairs % n
+        k_pair = degree[pair_rows]
+        is_own = candidates == community[pair_rows]
+        gains = links - resolution * (totals[candidates] - is_own * k_pair) * k_pair / two_m
+        position = np.searchsorted(nodes, pair_rows)
+        own_links = np.zeros(len(nodes))
+        own_links[position[is_own]] = links[is_own]
+        own_gain = own_links - resolution * (totals[own] - k) * k / two_m
+
+        #Best candidate of every node: largest gain, lowest community among ties
+        starts = np.flatnonzero(np.r_[True, pair_rows[1:] != pair_rows[:-1]])
+        lengths = np.diff(np.r_[starts, len(pairs)])
+        best_gain = np.maximum.reduceat(gains, starts)
+        first = np.minimum.reduceat(np.where(gains == np.repeat(best_gain, lengths), np.arange(len(pairs)),
+                                             len(pairs)), starts)
+        movers = position[starts]
+        move = best_gain > own_gain[movers] + MIN_GAIN
+        movers, best = movers[move], first[move]
+        if len(movers) == 0:
+            continue
+
+        delta, new_totals = _batch_gain(totals, own[movers], candidates[best], k[movers],
+                                        links[best] - own_links[movers], two_m, resolution)
+        if delta <= 0:
+            single = np.argmax(gains[best] - own_gain[movers])
+            movers, best = movers[single:single + 1], best[single:single + 1]
+            delta, new_totals = _batch_gain(totals, own[movers], candidates[best], k[movers],
+                                            links[best] - own_links[movers], two_m, resolution)
+
+        totals = new_totals
+        community[nodes[movers]] = candidates[best]
+        moved += len(movers)
+        improvement += delta
+    return moved, improvement, totals
+
+
+# Local moving phase: passes over the color classes (see _moving_pass) until a pass moves nothing or improves the
+    # modularity by less than MIN_GAIN. Returns the communities and whether any node moved
+def _local_moving(matrix, resolution, rng):
+    n = matrix.shape[0]
+    indptr, indices = matrix.indptr, matrix.indices
+    degree = np.asarray(matrix.sum(axis=1)).ravel()
+    community = np.arange(n)
+    totals = degree.copy()
+    moved_any = False
+
+    #CSR entries of every color class, without self-loops (still grouped by row)
+    classes = []
+    for nodes in _coloring(matrix, rng):
+        lengths = indptr[nodes + 1] - indptr[nodes]
+        entries = np.repeat(indptr[nodes] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        entry_rows = np.repeat(nodes, lengths)
+        not_self = indices[entries] != entry_rows
+        classes.append((nodes, entry_rows[not_self], entries[not_self]))
+
+    while True:
+        moved, improvement, totals = _moving_pass(matrix, classes, community, totals, degree, resolution, rng)
+        if moved == 0:
+            return community, moved_any
+        moved_any = True
+        if improvement <= MIN_GAIN:
+            return community, moved_any
+
+
+# Connectivity refinement (as in Leiden): every community is split into its connected parts
+def _split_disconnected(matrix, community):
+    coo = matrix.tocoo()
+    inside = community[coo.row] == community[coo.col]
+    internal = sp.csr_matrix((coo.data[inside], (coo.row[inside], coo.col[inside])), shape=matrix.shape)
+    return connected_components(internal, directed=False)[1]
+
+
+# Communities numbered 0, 1, ... in order of first appearance (as python-louvain returns them)
+def _renumber(community):
+    _, first, inverse = np.unique(community, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first, kind="stable")] = np.arange(len(first))
+    return rank[inverse.ravel()]
+
+
+# Multilevel Louvain on a Louvain matrix (see _modularity_matrix): local moving, then aggregation of the communities
+    # into nodes, until nothing moves. With refine, disconnected communities are split before every aggregation
+def louvain(matrix, resolution=1.0, seed=0, refine=False):
+    rng = np.random.default_rng(seed)
+    node_community = np.arange(matrix.shape[0])
+    current = matrix
+
+    while True:
+        community, moved = _local_moving(current, resolution, rng)
+        if not moved:
+            break
+        if refine:
+            community = _split_disconnected(current, community)
+        community = _renumber(community)
+        node_community = community[node_community]
+        aggregation = sp.csr_matrix((np.ones(len(community)), (np.arange(len(community)), community)))
+        current = (aggregation.T @ current @ aggregation).tocsr()
+        current.sort_indices()
+
+    if refine:
+        node_community = _split_disconnected(matrix, node_community)
+    return _renumber(node_community)
+
+
+def _ensemble_run(seed, resolution, refine):
+    matrix = _shared["matrix"]
+    community = louvain(matrix, resolution=resolution, seed=seed, refine=refine)
+    return community, modularity(matrix, community)
+
+
+# Co-assignment stability of every node: mean over the other runs of the Jaccard index between the node's community in
+    # the chosen partition and its community in the run
+def _stability(best, partitions):
+    if not partitions:
+        return np.ones(len(best))
+    best_size = np.bincount(best)
+    scores = np.zeros(len(best))
+    for community in partitions:
+        pairs = best.astype(np.int64) * (community.max() + 1) + community
+        keys, inverse = np.unique(pairs, return_inverse=True)
+        overlap = np.bincount(inverse.ravel())[inverse.ravel()]
+        union = best_size[best] + np.bincount(community)[community] - overlap
+        scores += overlap / union
+    return scores / len(partitions)
+
+
+# Ensemble of Louvain runs on a CSRGraph, one per (seed, resolution), in parallel worker processes. Returns the
+    # partition (node order) with the best modularity (at resolution 1), its modularity and the per node stability
+def community_ensemble(graph, seeds=range(8), resolutions=(1.0,), refine=False, n_jobs=None):
+    matrix = _modularity_matrix(graph)
+    runs = list(itertools.product(seeds, resolutions))
+    _shared["matrix"] = matrix
+    try:
+        results = list(map_tasks(_ensemble_run, [(seed, resolution, refine) for seed, resolution in runs],
+                                 n_jobs=n_jobs))
+    finally:
+        _shared.clear()
+
+    best = int(np.argmax([q for _, q in results]))           #first best run in case of ties
+    partition, best_modularity = results[best]
+    others = [community for r, (community, _) in enumerate(results) if r != best]
+    print(f"Community ensemble: {len(runs)} runs, best modularity {best_modularity:.4f} "
+          f"(seed {runs[best][0]}, resolution {runs[best][1]})")
+    return partition, best_modularity, _stability(partition, others)
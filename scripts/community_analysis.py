@@ -1,170 +1,85 @@
-from ete3 import NCBITaxa
-from collections import defaultdict, Counter
-import json
 import numpy as np
-import time
-import csv
+from artifacts import COMMUNITY_NODES, COMMUNITY_RANKS, LABELS, LAYOUT, load_columns, write_artifact
+from community_summary import (LINEAGE_LEVELS, MIN_COMMUNITY_SIZE, CommunitySummary, community_codes, grouped_counts,
+                               write_csv)
+from taxonomy import Taxonomy
 import os
 
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 STAGING_DATA_DIR = os.path.join(PROJECT_DIR, "project_data/staging_data")
 
-with open(os.path.join(STAGING_DATA_DIR, "labels_no_fungi.json"), "r") as f:
-    labels_data = json.load(f)
+# Only the columns needed here, memory-mapped from the artifacts of dsmz_matrix.py and graph.py
+row_labels, = load_columns(LABELS, "row_labels")                        # NCBI taxids as strings
+labels, communities = load_columns(LAYOUT, "labels", "community")      # graph nodes and their community ids
 
-row_labels = labels_data["row_labels"]  # NCBI taxids as strings
-
-with open(os.path.join(STAGING_DATA_DIR, "graph_layout_data_no_fungi.json"), "r") as f:
-    graph_data = json.load(f)
-
-labels = graph_data["labels"]           # nodes used in louvain/layout script
-communities = graph_data["communities"] # parallel list of community ids
-
-ncbi = NCBITaxa()
+# NCBI taxonomy from the local taxdump: compact table built once in staging_data, then memory-mapped (no sqlite)
+taxonomy = Taxonomy.load()
 
 # row_labels = list of NCBI taxids as strings
-taxids_int = [int(t) for t in row_labels]
-
-# taxid -> rank (species, genus, family, ...)
-rank_dict = ncbi.get_rank(taxids_int)
-
-# taxid (int) -> scientific name
-name_dict = ncbi.get_taxid_translator(taxids_int)
-
-# taxid (str) -> scientific name
-ncbi_to_name = {str(t): name_dict.get(t, "Unknown") for t in taxids_int}
+taxids_int = np.array(row_labels, dtype=np.int64)
 
+# Rank codes (indices into rank_names); taxids missing from the taxonomy get the extra code of "Unknown"
+rank_names = np.r_[taxonomy.rank_names, np.array(["Unknown"], dtype=object)]
+unknown = len(rank_names) - 1
 
-rank_counter = Counter(rank_dict.values())
-
+# Number of taxa per rank (taxa found in the taxonomy), most frequent first, ties in order of first appearance
+codes = taxonomy.rank_codes(taxids_int)
+_, rank, count, first = grouped_counts(np.zeros(len(codes), dtype=np.int64), codes)
+order = np.lexsort((first, -count))
 print("=== Number of taxa per rank ===")
-for rank, count in rank_counter.most_common():
-    print(f"{rank} : {count}")
-
-
-comm_to_nodes = defaultdict(list)
-for node, comm_id in zip(labels, communities):
-    comm_to_nodes[comm_id].append(node)
-
-communities_sorted = sorted(comm_to_nodes.items(), key=lambda x: len(x[1]), reverse=True)
-ncbi_to_communities = defaultdict(list)
-community_rank_summary = {}
-community_rank_full = {}
-
+for r, c in zip(rank_names[rank[order]], count[order]):
+    print(f"{r} : {c}")
 
-MIN_COMMUNITY_SIZE = 2
 
-for comm_id, nodes in communities_sorted:
-    if len(nodes) < MIN_COMMUNITY_SIZE:
-        continue
+# Integer-coded nodes: community code (communities by decreasing size) and rank code of every node
+node_taxids = np.array(labels, dtype=np.int64)
+node_codes, community_ids, community_sizes = community_codes(communities)
+node_ranks = taxonomy.rank_codes(node_taxids)
+node_ranks[node_ranks < 0] = unknown
 
-    ranks_of_community = []
-    for n in nodes:
-        tid = int(n)
-        ranks_of_community.append(rank_dict.get(tid, "Unknown"))
-        ncbi_to_communities[str(n)].append(comm_id)
-    
-    counter = Counter(ranks_of_community)
-
-    community_rank_full[comm_id] = {
-        "community_size": len(nodes),
-        "rank_distribution": counter
-    }
-
-    top_ranks = counter.most_common(4)
-
-    community_rank_summary[comm_id] = {
-        "size": len(nodes),
-        "top_ranks": [
-            {
-                "rank": r,
-                "count": c,
-                "fraction": c / len(nodes)
-            }
-            for r, c in top_ranks
-        ]
-    }
+summary = CommunitySummary(node_codes, community_ids, community_sizes, node_ranks, rank_names,
+                           min_size=MIN_COMMUNITY_SIZE)
 
 
 output_file = "community_rank_distribution.csv"
-
-with open(os.path.join(STAGING_DATA_DIR, output_file), "w", newline="") as f:
-    writer = csv.writer(f)
-    writer.writerow([
-        "community_id",
-        "community_size",
-        "rank",
-        "count",
-        "percentage"
-    ])
-
-    for comm_id, info in community_rank_full.items():
-        size = info["community_size"]
-        counter = info["rank_distribution"]
-
-        for rank, count in counter.items():
-            percentage = 100.0 * count / size
-
-            writer.writerow([
-                comm_id,
-                size,
-                rank,
-                count,
-                round(percentage, 3)
-            ])
+columns = ["community_id", "community_size", "rank", "count", "percentage"]
+rank_rows = list(summary.rank_distribution())
+write_csv(os.path.join(STAGING_DATA_DIR, output_file), columns, rank_rows)
+write_artifact(COMMUNITY_RANKS, dict(zip(columns, zip(*rank_rows))) if rank_rows else {c: [] for c in columns})
 
 print(f"\nSaved full rank distributions (size>1) to: {output_file}")
 
 
+# Nodes of the kept communities sorted by taxid (every node is in exactly one community)
 output_file = "ncbi_node_info_with_communities.csv"
+nodes, node_communities = summary.kept_nodes()
+order = np.argsort(node_taxids[nodes], kind="stable")
+nodes, node_communities = nodes[order], node_communities[order]
+node_ncbi = np.asarray(labels).astype(str)[nodes].tolist()
+node_rank = taxonomy.ranks(node_taxids[nodes], missing="Unknown_rank").tolist()
+write_csv(os.path.join(STAGING_DATA_DIR, output_file),
+          ["ncbi", "scientific_name", "rank", "communities"],
+          zip(node_ncbi, taxonomy.names(node_taxids[nodes]).tolist(), node_rank, map(str, node_communities.tolist())))
+write_artifact(COMMUNITY_NODES, {"ncbi": node_ncbi, "rank": node_rank, "community": node_communities})
 
-with open(os.path.join(STAGING_DATA_DIR, output_file), "w", newline="") as f:
-    writer = csv.writer(f)
-    writer.writerow(["ncbi", "scientific_name", "rank", "communities"])
-
-    for ncbi in sorted(ncbi_to_communities.keys(), key=lambda x: int(x)):
-        tid_int = int(ncbi)
-
-        name = ncbi_to_name.get(ncbi, "Unknown")
-        rank = rank_dict.get(tid_int, "Unknown_rank")
+print(f"\nSaved node info table to: {output_file}")
 
+output_file = "summaries_of_communities.csv"
+write_csv(os.path.join(STAGING_DATA_DIR, output_file),
+          ["community", "size",
+           "rank_1", "count_1", "fraction_1",
+           "rank_2", "count_2", "fraction_2",
+           "rank_3", "count_3", "fraction_3",
+           "rank_4", "count_4", "fraction_4"],
+          summary.top_ranks(4))
 
-        comm_list = sorted(set(ncbi_to_communities[ncbi]))
-        comm_str = ";".join(map(str, comm_list))
+print(f"\nSaved communities' summeries to: {output_file}")
 
-        writer.writerow([ncbi, name, rank, comm_str])
 
-print(f"\nSaved node info table to: {output_file}")
-
-output_file = "summaries_of_communities.csv"
+# Every lineage level of every node (phylum ... species), not only the node's own rank
+output_file = "community_lineage_distribution.csv"
+write_csv(os.path.join(STAGING_DATA_DIR, output_file),
+          ["community_id", "community_size", "level", "taxid", "scientific_name", "count", "percentage"],
+          summary.lineage_distribution(taxonomy.ancestors(node_taxids, LINEAGE_LEVELS), taxonomy.names))
 
-with open(os.path.join(STAGING_DATA_DIR, output_file), "w", newline="") as f:
-    writer = csv.writer(f)
-    # header
-    writer.writerow([
-        "community", "size",
-        "rank_1", "count_1", "fraction_1",
-        "rank_2", "count_2", "fraction_2",
-        "rank_3", "count_3", "fraction_3",
-        "rank_4", "count_4", "fraction_4"
-    ])
-
-    for comm_id, info in community_rank_summary.items():
-        row = [comm_id, info["size"]]
-
-        top_ranks = info["top_ranks"]
-
-        # riempi fino a 4 (se meno di 4 rank, pad con vuoti)
-        for i in range(4):
-            if i < len(top_ranks):
-                row.extend([
-                    top_ranks[i]["rank"],
-                    top_ranks[i]["count"],
-                    round(top_ranks[i]["fraction"], 4)
-                ])
-            else:
-                row.extend(["", "", ""])
-
-        writer.writerow(row)
-
-print(f"\nSaved communities' summeries to: {output_file}")
\ No newline at end of file
+print(f"\nSaved lineage distributions (size>1) to: {output_file}")
@@ -0,0 +1,110 @@
+import csv
+import numpy as np
+
+#Communities smaller than this are left out of every summary
+MIN_COMMUNITY_SIZE = 2
+#Ranks of the top-ranks summary
+TOP_RANKS = 4
+#Lineage levels aggregated by lineage_distribution
+LINEAGE_LEVELS = ("phylum", "class", "order", "family", "genus", "species")
+
+
+# Integer codes of the node -> community array, numbered like the summaries list the communities: by decreasing size,
+    # ties in order of first appearance. Returns (code of every node, community ids, sizes), ids and sizes per code
+def community_codes(communities):
+    ids, first, inverse, sizes = np.unique(np.asarray(communities), return_index=True, return_inverse=True,
+                                           return_counts=True)
+    order = np.lexsort((first, -sizes))
+    code = np.empty(len(ids), dtype=np.int64)
+    code[order] = np.arange(len(ids))
+    return code[inverse.ravel()], ids[order], sizes[order]
+
+
+# Counts of the (group, value) pairs of two integer-coded node arrays (values < 0 are left out), one grouped
+    # bincount over the combined key. Returns (group, value, count, first) per distinct pair, sorted by group and then
+    # by first appearance of the pair in node order (the order in which a Counter would list them)
+def grouped_counts(groups, values):
+    keep = np.flatnonzero(values >= 0)
+    n_values = int(values.max(initial=-1)) + 1
+    keys = groups[keep] * n_values + values[keep]
+    pairs, first, counts = np.unique(keys, return_index=True, return_counts=True)
+    group, value, first = pairs // max(n_values, 1), pairs % max(n_values, 1), keep[first]
+    order = np.lexsort((first, group))
+    return group[order], value[order], counts[order], first[order]
+
+
+# First k pairs of every group by decreasing count, ties in order of first appearance (Counter.most_common(k)).
+    # Returns the indices of the kept pairs (group by group) and their position in the group
+def top_counts(group, counts, first, k=TOP_RANKS):
+    order = np.lexsort((first, -counts, group))
+    starts = np.searchsorted(group[order], group[order], side="left")
+    position = np.arange(len(order)) - starts
+    keep = position < k
+    return order[keep], position[keep]
+
+
+# Rank distributions of the communities from integer codes: node_codes as returned by community_codes and the rank
+    # code of every node (index into rank_names). Only the communities with at least min_size nodes
+class CommunitySummary:
+
+    def __init__(self, node_codes, ids, sizes, rank_codes, rank_names, min_size=MIN_COMMUNITY_SIZE):
+        self.node_codes, self.ids, self.sizes = node_codes, ids, sizes
+        self.rank_names = np.asarray(rank_names, dtype=object)
+        self.n_kept = int(np.count_nonzero(sizes >= min_size))         #codes are sorted by decreasing size
+        self.rank_counts = grouped_counts(node_codes, rank_codes)
+
+    # Pair arrays restricted to the kept communities
+    def _kept(self, pairs):
+        keep = pairs[0] < self.n_kept
+        return tuple(a[keep] for a in pairs)
+
+    # Rows (community_id, community_size, rank, count, percentage) of every rank found in every kept community
+    def rank_distribution(self):
+        group, value, count, _ = self._kept(self.rank_counts)
+        size = self.sizes[group]
+        percentage = [round(p, 3) for p in (100.0 * count / size).tolist()]
+        return zip(self.ids[group].tolist(), size.tolist(), self.rank_names[value].tolist(), count.tolist(), percentage)
+
+    # Rows (community, size, rank_1, count_1, fraction_1, ..., rank_k, count_k, fraction_k) of the kept communities,
+        # padded with "" when a community has less than k ranks
+    def top_ranks(self, k=TOP_RANKS):
+        group, value, count, first = self._kept(self.rank_counts)
+        top, position = top_counts(group, count, first, k)
+        table = np.full((self.n_kept, 2 + 3 * k), "", dtype=object)
+        table[:, 0] = self.ids[:self.n_kept].tolist()
+        table[:, 1] = self.sizes[:self.n_kept].tolist()
+        rows, columns = group[top], 2 + 3 * position
+        table[rows, columns] = self.rank_names[value[top]].tolist()
+        table[rows, columns + 1] = count[top].tolist()
+        table[rows, columns + 2] = [round(f, 4) for f in (count[top] / self.sizes[group[top]]).tolist()]
+        return table.tolist()
+
+    # Node indices of the kept communities and their community ids
+    def kept_nodes(self):
+        nodes = np.flatnonzero(self.node_codes < self.n_kept)
+        return nodes, self.ids[self.node_codes[nodes]]
+
+    # Rows (community_id, community_size, level, taxid, scientific_name, count, percentage) of the taxa found at every
+        # lineage level in every kept community: ancestors maps each level to the taxid of every node's ancestor at
+        # that level (-1 when the lineage has none, see Taxonomy.ancestors), names gives the names of an array of
+        # taxids. Community by community, levels in the given order, taxa by decreasing count (ties: first appearance)
+    def lineage_distribution(self, ancestors, names, levels=LINEAGE_LEVELS):
+        parts = []
+        for i, level in enumerate(levels):
+            group, value, count, first = self._kept(grouped_counts(self.node_codes, ancestors[level]))
+            order = np.lexsort((first, -count, group))
+            parts.append((group[order], np.full(len(order), i), value[order], count[order]))
+        group, level, taxid, count = (np.concatenate(a) for a in zip(*parts))
+        order = np.argsort(group, kind="stable")
+        group, level, taxid, count = group[order], level[order], taxid[order], count[order]
+        size = self.sizes[group]
+        return zip(self.ids[group].tolist(), size.tolist(), np.asarray(levels, dtype=object)[level].tolist(),
+                   taxid.tolist(), list(names(taxid)), count.tolist(),
+                   [round(p, 3) for p in (100.0 * count / size).tolist()])
+
+
+def write_csv(path, header, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
@@ -0,0 +1,219 @@
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+from dissimilarity import map_tasks
+
+#Rows of the graph handled by one clustering task (bounds the size of the block @ W product)
+CLUSTERING_BLOCK = 512
+#Adjacency entries handled at once by the sparsification (bounds its temporary arrays)
+SPARSIFY_BLOCK = 5_000_000
+
+#Matrices shared with the worker processes (inherited through fork, see dissimilarity.map_tasks)
+_shared = {}
+
+
+# Sum over the ordered neighbour pairs (j, k) of row i of w_ij * w_jk * w_ki, for the target rows [i0, i1)
+def _triangles_block(i0, i1):
+    cube_root = _shared["cube_root"]
+    block = cube_root[_shared["targets"][i0:i1]]
+    return np.asarray((block @ cube_root).multiply(block).sum(axis=1)).ravel()
+
+
+# Undirected weighted graph stored as a symmetric CSR adjacency (int32 indices, float32 weights) plus a label array.
+    # Node i is labels[i]; self-loops are stored on the diagonal. `nodes` lists the nodes of the graph in the order
+    # networkx would have inserted them while adding the edges of the similarity matrix one by one (so outputs
+    # indexed by node keep the same order as before)
+class CSRGraph:
+
+    def __init__(self, indptr, indices, weights, labels, nodes=None):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.labels = np.asarray(labels)
+        self.nodes = np.arange(len(self.labels)) if nodes is None else np.asarray(nodes, dtype=np.int64)
+        self._nx = None
+
+    # Graph of the positive entries of a (symmetric) similarity matrix, nodes labelled by labels
+    @classmethod
+    def from_coo(cls, coo, labels):
+        coo = sp.coo_matrix(coo)
+        keep = coo.data > 0
+        rows, cols, data = coo.row[keep], coo.col[keep], coo.data[keep]
+
+        #Nodes in order of first appearance in the sequence (row_0, col_0, row_1, col_1, ...)
+        endpoints = np.column_stack([rows, cols]).ravel()
+        present, first = np.unique(endpoints, return_index=True)
+        nodes = present[np.argsort(first, kind="stable")]
+
+        csr = sp.csr_matrix((data, (rows, cols)), shape=coo.shape)
+        csr.sum_duplicates()
+        csr.sort_indices()
+        return cls(csr.indptr, csr.indices, csr.data, labels, nodes)
+
+    # Same graph as from_coo, built from an edge_store.EdgeShards one shard at a time: a first pass counts the entries
+        # of every row (and finds the node order), a second one fills the CSR arrays. Only the int32/float32 CSR and
+        # one shard are in memory, never the whole COO
+    @classmethod
+    def from_shards(cls, shards, labels):
+        n = shards.n_nodes
+        counts = np.zeros(n, dtype=np.int64)
+        first = np.full(n, np.iinfo(np.int64).max)
+        offset = 0
+        for rows, cols, weights in shards.blocks():
+            keep = weights > 0
+            rows, cols = rows[keep], cols[keep]
+            counts += np.bincount(rows, minlength=n)
+            present, position = np.unique(np.column_stack([rows, cols]).ravel(), return_index=True)
+            first[present] = np.minimum(first[present], position + offset)
+            offset += 2 * len(rows)
+        present = np.flatnonzero(first < np.iinfo(np.int64).max)
+        nodes = present[np.argsort(first[present], kind="stable")]
+
+        indptr = np.r_[0, np.cumsum(counts)]
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        data = np.empty(indptr[-1], dtype=np.float32)
+        cursor = indptr[:-1].copy()
+        for rows, cols, weights in shards.blocks():
+            keep = weights > 0
+            rows, cols, weights = rows[keep], cols[keep], weights[keep]
+            order = np.argsort(rows, kind="stable")
+            rows = rows[order]
+            block_counts = np.bincount(rows, minlength=n)
+            rank = np.arange(len(rows)) - np.repeat(np.cumsum(block_counts) - block_counts, block_counts)
+            slots = cursor[rows] + rank
+            indices[slots] = cols[order]
+            data[slots] = weights[order]
+            cursor += block_counts
+
+        csr = sp.csr_matrix((data, indices, indptr), shape=(n, n))
+        csr.sum_duplicates()
+        csr.sort_indices()
+        return cls(csr.indptr, csr.indices, csr.data, labels, nodes)
+
+    @property
+    def n_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def node_labels(self):
+        return self.labels[self.nodes].tolist()
+
+    @property
+    def adjacency(self):
+        n = len(self.labels)
+        return sp.csr_matrix((self.weights, self.indices, self.indptr), shape=(n, n))
+
+    # Number of undirected edges (self-loops included, once)
+    @property
+    def n_edges(self):
+        n_loops = int(np.count_nonzero(self.adjacency.diagonal()))
+        return (len(self.indices) + n_loops) // 2
+
+    # Weighted degree of the nodes (in `nodes` order), one sparse reduction accumulated in float64.
+        # As in networkx, a self-loop counts twice
+    def weighted_degree(self):
+        adjacency = self.adjacency
+        degree = adjacency @ np.ones(adjacency.shape[1]) + adjacency.diagonal().astype(np.float64)
+        return degree[self.nodes]
+
+    # Top-percent selection: every node selects its min(max(int(percent*deg), 1), m_max) heaviest neighbours (deg
+        # counts the self-loop, ties go to the lower index), rows processed in blocks of about block_size entries.
+        # Returns the selection as a 0/1 CSR matrix (row i = the neighbours selected by i)
+    def top_percent_selection(self, percent, m_max, block_size=SPARSIFY_BLOCK):
+        n = len(self.labels)
+        deg = np.diff(self.indptr)
+        k = np.clip((percent * deg).astype(np.int64), 1, m_max)
+
+        #One segmented sort per block: entries by row, then by decreasing weight (lexsort is stable, so equal weights
+            # stay in column order and ties go to the lower index); an entry is kept if its rank in the row is < k
+        keep = np.zeros(len(self.weights), dtype=bool)
+        bounds = np.unique(np.r_[np.searchsorted(self.indptr, np.arange(0, len(self.weights), max(block_size, 1)),
+                                                 side="right") - 1, n])
+        for r0, r1 in zip(bounds[:-1], bounds[1:]):
+            s, e = self.indptr[r0], self.indptr[r1]
+            entry_rows = np.repeat(np.arange(r0, r1), deg[r0:r1])
+            order = np.lexsort((-self.weights[s:e], entry_rows))
+            rank = np.arange(e - s) - (self.indptr[entry_rows] - s)
+            keep[s + order[rank < k[entry_rows]]] = True
+
+        selected_ptr = np.r_[0, np.cumsum(keep)][self.indptr]
+        return sp.csr_matrix((np.ones(keep.sum(), dtype=np.int8), self.indices[keep], selected_ptr), shape=(n, n))
+
+    # Mutual top-percent sparsification: an edge is kept only if both endpoints select it (see top_percent_selection).
+        # Returns the sparsified graph (same nodes, same order)
+    def sparsify_top_percent(self, percent, m_max, block_size=SPARSIFY_BLOCK):
+        selected = self.top_percent_selection(percent, m_max, block_size)
+        sparse = self.adjacency.multiply(selected.multiply(selected.T)).tocsr()
+        sparse.eliminate_zeros()
+        sparse.sort_indices()
+        return CSRGraph(sparse.indptr, sparse.indices, sparse.data, self.labels, self.nodes)
+
+    # Weighted clustering coefficient of the nodes (in `nodes` order, or of the given CSR rows only), same definition
+        # as nx.clustering(G, weight=...): c_i = diag(W^(1/3) @ W^(1/3) @ W^(1/3))_i / (d_i (d_i - 1)),
+        # W = weights / max weight without self-loops, d_i = number of neighbours other than i. Components with less
+        # than 3 nodes have no triangles (c = 0); the others are evaluated by blocks of rows, largest component first,
+        # in parallel with n_jobs > 1
+    def clustering(self, block_size=CLUSTERING_BLOCK, n_jobs=None, rows=None):
+        adjacency = self.adjacency.astype(np.float64)
+        max_weight = adjacency.data.max() if adjacency.nnz else 1.0            #global normalization
+        off_diagonal = (sp.triu(adjacency, 1) + sp.tril(adjacency, -1)).tocsr()
+        off_diagonal.sort_indices()
+
+        in_triangles = np.concatenate([np.zeros(0, dtype=np.int64)] + [c for c in self.components() if len(c) >= 3])
+        cube_root = off_diagonal[in_triangles][:, in_triangles].tocsr()
+        cube_root.data = np.cbrt(cube_root.data / max_weight)
+
+        position = np.full(adjacency.shape[0], -1, dtype=np.int64)
+        position[in_triangles] = np.arange(len(in_triangles))
+        targets = np.arange(len(in_triangles)) if rows is None else position[rows][position[rows] >= 0]
+
+        _shared["cube_root"] = cube_root
+        _shared["targets"] = targets
+        try:
+            blocks = [(i0, min(i0 + block_size, len(targets))) for i0 in range(0, len(targets), block_size)]
+            triangles = np.zeros(adjacency.shape[0])
+            triangles[in_triangles[targets]] = np.concatenate([np.zeros(0)] + list(map_tasks(_triangles_block, blocks,
+                                                                                             n_jobs=n_jobs)))
+        finally:
+            _shared.clear()
+
+        d = np.diff(off_diagonal.indptr).astype(np.float64)
+        coeffs = np.zeros_like(triangles)
+        nonzero = triangles > 0
+        coeffs[nonzero] = triangles[nonzero] / (d[nonzero] * (d[nonzero] - 1))
+        return coeffs[self.nodes] if rows is None else coeffs[rows]
+
+    # Connected components as arrays of CSR rows (each in `nodes` order), largest first (ties: first node first)
+    def components(self):
+        _, component = connected_components(self.adjacency, directed=False)
+        component = component[self.nodes]
+        _, first, sizes = np.unique(component, return_index=True, return_counts=True)
+        order = np.argsort(component, kind="stable")
+        groups = np.split(self.nodes[order], np.cumsum(sizes)[:-1])
+        return [groups[c] for c in np.lexsort((first, -sizes))]
+
+    # Graph induced by the given CSR rows (nodes in the order of rows)
+    def subgraph(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        adjacency = self.adjacency[rows][:, rows].tocsr()
+        adjacency.sort_indices()
+        return CSRGraph(adjacency.indptr, adjacency.indices, adjacency.data, self.labels[rows])
+
+    # Lazy networkx view for the algorithms that still need it: built once, on first use, with the same node and
+        # adjacency order that adding the edges of the similarity matrix one by one would give
+    def to_networkx(self):
+        if self._nx is not None:
+            return self._nx
+
+        adjacency = sp.triu(self.adjacency, format="coo")
+        order = np.lexsort((adjacency.col, adjacency.row))
+        labels = self.labels.tolist()
+
+        graph = nx.Graph()
+        graph.add_nodes_from(labels[i] for i in self.nodes)
+        graph.add_weighted_edges_from(zip((labels[i] for i in adjacency.row[order]),
+                                          (labels[j] for j in adjacency.col[order]),
+                                          adjacency.data[order].astype(np.float64).tolist()))
+        self._nx = graph
+        return graph
@@ -0,0 +1,468 @@
+import multiprocessing as mp
+import numpy as np
+import scipy.sparse as sp
+from pair_stats import PairStats
+import os
+
+#Number of rows of the taxon x habitat matrix handled by one task
+BLOCK_SIZE = 256
+
+#Matrices shared with the worker processes: they are inherited through fork (copy-on-write),
+    #so the CSR/CSC arrays are never pickled nor copied for each task
+_shared = {}
+
+
+def _share(matrix):
+    csr = sp.csr_matrix(matrix, dtype=np.float64)
+    csr.sum_duplicates()
+    csr.sort_indices()
+    _shared["csr"] = csr
+    _shared["csc"] = csr.tocsc()
+    _shared["row_sums"] = np.asarray(csr.sum(axis=1)).ravel()
+    _shared["weights"] = None
+    return csr.shape[0]
+
+
+# Identical rows (same habitat profile) collapsed in equivalence classes: returns the matrix of the distinct rows
+    # (in order of first appearance), the class of every row and the size of every class
+def collapse_rows(matrix):
+    csr = sp.csr_matrix(matrix, dtype=np.float64)
+    csr.sum_duplicates()
+    csr.sort_indices()
+
+    classes = {}
+    row_class = np.empty(csr.shape[0], dtype=np.int64)
+    for i in range(csr.shape[0]):
+        s, e = csr.indptr[i], csr.indptr[i + 1]
+        row_class[i] = classes.setdefault((csr.indices[s:e].tobytes(), csr.data[s:e].tobytes()), len(classes))
+
+    representatives = np.unique(row_class, return_index=True)[1]
+    return csr[representatives], row_class, np.bincount(row_class)
+
+
+# Expands a matrix computed between classes back to the rows: entry (u, v) goes to every (i, j) with i in class u
+    # and j in class v. Entries come out sorted by row and column, as if computed between the rows directly
+def expand_coo(class_coo, row_class):
+    n_rows = len(row_class)
+    members = np.argsort(row_class, kind="stable")
+    sizes = np.bincount(row_class, minlength=class_coo.shape[0])
+    starts = np.cumsum(sizes) - sizes
+
+    #Rows: every entry (u, v) once for each member i of u
+    n_i = sizes[class_coo.row]
+    entry = np.repeat(np.arange(class_coo.nnz), n_i)
+    rows = members[np.repeat(starts[class_coo.row], n_i) + np.arange(n_i.sum()) - np.repeat(np.cumsum(n_i) - n_i, n_i)]
+
+    #Columns: every (i, v) once for each member j of v
+    n_j = sizes[class_coo.col[entry]]
+    cols = members[np.repeat(starts[class_coo.col[entry]], n_j) + np.arange(n_j.sum()) - np.repeat(np.cumsum(n_j) - n_j, n_j)]
+    rows = np.repeat(rows, n_j)
+    data = class_coo.data[np.repeat(entry, n_j)]
+
+    order = np.lexsort((cols, rows))
+    return sp.coo_matrix((data[order], (rows[order], cols[order])), shape=(n_rows, n_rows))
+
+
+# Nonzeros of the given rows of a CSR matrix: (position of the row in rows, column, value) of each of them
+def _row_entries(csr, rows):
+    lengths = csr.indptr[rows + 1] - csr.indptr[rows]
+    offsets = np.cumsum(lengths) - lengths
+    pos = np.arange(lengths.sum()) + np.repeat(csr.indptr[rows] - offsets, lengths)
+    return np.repeat(np.arange(len(rows)), lengths), csr.indices[pos], csr.data[pos]
+
+
+# sum_k min(A[i,k], A[j,k]) for every i in rows and every j, as a dense len(rows) x n block
+def min_sums_rows(rows):
+    csr, csc = _shared["csr"], _shared["csc"]
+    n = csr.shape[0]
+
+    #One entry for each nonzero A[i,k] of the block
+    blk_rows, blk_cols, blk_vals = _row_entries(csr, rows)
+
+    #Expanding each nonzero A[i,k] over the nonzeros A[j,k] of its column
+    starts = csc.indptr[blk_cols]
+    lengths = csc.indptr[blk_cols + 1] - starts
+    offsets = np.cumsum(lengths) - lengths
+    pos = np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+
+    mins = np.minimum(np.repeat(blk_vals, lengths), csc.data[pos])
+    flat = np.repeat(blk_rows, lengths) * n + csc.indices[pos]
+    return np.bincount(flat, weights=mins, minlength=len(rows) * n).reshape(len(rows), n)
+
+
+def min_sums_block(i0, i1):
+    return min_sums_rows(np.arange(i0, i1))
+
+
+# L1 dissimilarity D[i,j] = row_sums[i] + row_sums[j] - 2*sum_k min(A[i,k], A[j,k]) for the given rows
+    # Matrix entries are bacteria counts (integers), so every partial sum is exact in float64
+    # and the summation order does not change a single bit of the result
+def dissimilarity_rows(rows, min_sums=None):
+    row_sums = _shared["row_sums"]
+    block = row_sums[rows, None] + row_sums[None, :]
+    block -= 2.0 * (min_sums_rows(rows) if min_sums is None else min_sums)
+
+    block[np.arange(len(rows)), rows] = 0.0                 #self distance must be 0
+    block[np.abs(block) < 1e-12] = 0.0                      #tiny float noise to zero
+    return block
+
+
+# Same for the rows [i0, i1)
+def dissimilarity_block(i0, i1, min_sums=None):
+    return dissimilarity_rows(np.arange(i0, i1), min_sums)
+
+
+def _nonzero_entries(block, i0):
+    rows, cols = np.nonzero(block)
+    return rows + i0, cols, block[rows, cols]
+
+
+def _nonzero_dissimilarities(i0, i1):
+    return _nonzero_entries(dissimilarity_block(i0, i1), i0)
+
+
+def _dissimilarity_stats(i0, i1):
+    stats = PairStats()
+    weights = _shared["weights"]
+    if weights is None:
+        stats.update(dissimilarity_block(i0, i1))
+    else:                                   #rows are classes of identical rows: pair (u, v) stands for |u| * |v| pairs
+        stats.update(dissimilarity_block(i0, i1), weights=weights[i0:i1, None] * weights[None, :])
+    return stats
+
+
+# Similarities S = exp(-lam*D) of the rows [i0, i1), values below threshold are dropped
+def _thresholded_similarities(i0, i1, lam, threshold):
+    block = dissimilarity_block(i0, i1)
+    np.exp(-lam * block, out=block)
+    block[block < threshold] = 0.0
+    return _nonzero_entries(block, i0)
+
+
+# Exact pruning index for thresholded similarities: S = exp(-lam*D) >= threshold iff D <= d_max = ln(1/threshold)/lam,
+    # and |row_sums[i] - row_sums[j]| <= D[i,j] <= row_sums[i] + row_sums[j] (L1 distance of non negative rows). So:
+    # - pairs with no habitat in common have D = row_sums[i] + row_sums[j]: they survive only if their row sums are small
+    #   enough, i.e. j lies in a prefix of the rows sorted by row sum;
+    # - the other pairs are found through per-habitat posting lists (rows of each habitat sorted by row sum), scanning
+    #   only the rows j with |row_sums[i] - row_sums[j]| <= d_max.
+    # The kernel is evaluated on these candidate pairs only, and the usual S < threshold test is applied to them.
+def _share_pruning_index(d_max):
+    csc, row_sums = _shared["csc"], _shared["row_sums"]
+    max_sum = row_sums.max() if row_sums.size else 0.0
+    d_max = min(d_max, 2.0 * max_sum)
+    span = max_sum + d_max + 1.0
+
+    #Rows sorted by row sum
+    order = np.argsort(row_sums, kind="stable")
+    _shared["sorted_rows"] = order
+    _shared["sorted_sums"] = row_sums[order]
+
+    #Posting lists: entries of each habitat (column) sorted by the row sum of their row
+    entry_cols = np.repeat(np.arange(csc.shape[1]), np.diff(csc.indptr))
+    post = np.lexsort((row_sums[csc.indices], entry_cols))
+    _shared["post_rows"] = csc.indices[post]
+    _shared["post_vals"] = csc.data[post]
+    _shared["post_keys"] = entry_cols[post] * span + row_sums[csc.indices[post]]
+    _shared["post_span"] = span
+    #Small slack so that float rounding can never exclude a candidate (the final test is exact anyway)
+    _shared["d_max"] = d_max * (1.0 + 1e-9) + 1e-9
+
+
+# Dissimilarities of the candidate pairs of the given rows (see _share_pruning_index): a superset of the pairs with
+    # D <= d_max, values bit for bit equal to dissimilarity_rows. Returns (position in rows, column, value), sorted
+def _pruned_dissimilarities(block_rows):
+    csr, csc, row_sums = _shared["csr"], _shared["csc"], _shared["row_sums"]
+    sorted_rows, sorted_sums = _shared["sorted_rows"], _shared["sorted_sums"]
+    post_keys, span, d_max = _shared["post_keys"], _shared["post_span"], _shared["d_max"]
+    n, n_block = csr.shape[0], len(block_rows)
+    sums_i = row_sums[block_rows]
+
+    #Candidates sharing a habitat: scan of the posting lists restricted to |row_sums[i] - row_sums[j]| <= d_max
+    blk_rows, blk_cols, blk_vals = _row_entries(csr, block_rows)
+    blk_sums = sums_i[blk_rows]
+    lo = np.maximum(np.searchsorted(post_keys, blk_cols * span + blk_sums - d_max, side="left"), csc.indptr[blk_cols])
+    hi = np.minimum(np.searchsorted(post_keys, blk_cols * span + blk_sums + d_max, side="right"), csc.indptr[blk_cols + 1])
+    lengths = np.maximum(hi - lo, 0)
+    offsets = np.cumsum(lengths) - lengths
+    pos = np.arange(lengths.sum()) + np.repeat(lo - offsets, lengths)
+    shared_i = np.repeat(blk_rows, lengths)
+    shared_j = _shared["post_rows"][pos]
+    shared_mins = np.minimum(np.repeat(blk_vals, lengths), _shared["post_vals"][pos])
+
+    #Candidates without common habitats: row_sums[i] + row_sums[j] <= d_max (a prefix of the rows sorted by row sum)
+    n_light = np.searchsorted(sorted_sums, d_max - sums_i, side="right")
+    light_i = np.repeat(np.arange(n_block), n_light)
+    light_j = sorted_rows[np.arange(n_light.sum()) - np.repeat(np.cumsum(n_light) - n_light, n_light)]
+
+    #Candidate pairs = distinct keys i*n + j of the scanned entries and of the light pairs (sorted, no dense block);
+        # sum_k min(A[i,k], A[j,k]) accumulated on the scanned entries over the candidates only
+    shared_flat = shared_i * n + shared_j
+    flat = np.unique(np.concatenate([shared_flat, light_i * n + light_j]))
+    min_sums = np.bincount(np.searchsorted(flat, shared_flat), weights=shared_mins, minlength=len(flat))
+    rows, cols = np.divmod(flat, n)
+
+    #Same operations as dissimilarity_block and _thresholded_similarities, on the candidates only
+    vals = sums_i[rows] + row_sums[cols]
+    vals -= 2.0 * min_sums
+    vals[block_rows[rows] == cols] = 0.0
+    vals[np.abs(vals) < 1e-12] = 0.0
+    return rows, cols, vals
+
+
+def _pruned_similarities(i0, i1, lam, threshold):
+    rows, cols, vals = _pruned_dissimilarities(np.arange(i0, i1))
+    np.exp(-lam * vals, out=vals)
+
+    keep = ~(vals < threshold)
+    return rows[keep] + i0, cols[keep], vals[keep]
+
+
+# Thresholded similarities of the rows [i0, i1) when the shared matrix holds the classes of identical rows (see
+    # collapse_rows): the classes of the block rows are computed once, then every row gets the entries of its class
+    # with each column class expanded to its member rows. Same entries, values and order as the rows [i0, i1) of
+    # expand_coo applied to the similarities of the classes
+def _expanded_similarities(i0, i1, lam, threshold, prune):
+    members, starts, sizes = _shared["members"], _shared["class_starts"], _shared["class_sizes"]
+    classes, inverse = np.unique(_shared["row_class"][i0:i1], return_inverse=True)
+    if prune:
+        rows, cols, vals = _pruned_dissimilarities(classes)
+        np.exp(-lam * vals, out=vals)
+        keep = ~(vals < threshold)
+        rows, cols, vals = rows[keep], cols[keep], vals[keep]
+    else:
+        block = dissimilarity_rows(classes)
+        np.exp(-lam * block, out=block)
+        block[block < threshold] = 0.0
+        rows, cols, vals = _nonzero_entries(block, 0)
+
+    #Entries of every row of the block: those of its class (rows come out sorted)
+    class_ptr = np.searchsorted(rows, np.arange(len(classes) + 1))
+    n_entries = np.diff(class_ptr)[inverse.ravel()]
+    offsets = np.cumsum(n_entries) - n_entries
+    entry = np.arange(n_entries.sum()) + np.repeat(class_ptr[inverse.ravel()] - offsets, n_entries)
+    out_rows = np.repeat(np.arange(i0, i1), n_entries)
+
+    #Every column class expanded to its member rows
+    n_members = sizes[cols[entry]]
+    offsets = np.cumsum(n_members) - n_members
+    out_cols = members[np.arange(n_members.sum()) + np.repeat(starts[cols[entry]] - offsets, n_members)]
+    out_rows = np.repeat(out_rows, n_members)
+    out_vals = vals[np.repeat(entry, n_members)]
+
+    order = np.lexsort((out_cols, out_rows))
+    return out_rows[order], out_cols[order], out_vals[order]
+
+
+def _close_pairs(i0, i1, d_max):
+    rows, cols, vals = _pruned_dissimilarities(np.arange(i0, i1))
+    keep = vals <= d_max
+    return rows[keep] + i0, cols[keep], vals[keep]
+
+
+# Similarity kernels of the fused pass, all derived from m = sum_k min(A_ik, A_jk) and the row sums r:
+    # - exp_l1: S = exp(-lam * (r_i + r_j - 2m)), the kernel of the pipeline (params: lam)
+    # - bray_curtis: S = 2m / (r_i + r_j)
+    # - weighted_jaccard: S = m / (r_i + r_j - m)
+    # Two empty rows are identical profiles: they get similarity 1 with every kernel
+KERNELS = ("exp_l1", "bray_curtis", "weighted_jaccard")
+
+
+def _kernel_block(name, i0, i1, min_sums, params):
+    if name == "exp_l1":
+        block = dissimilarity_block(i0, i1, min_sums)
+        np.exp(-params["lam"] * block, out=block)
+        return block
+
+    row_sums = _shared["row_sums"]
+    total = row_sums[i0:i1, None] + row_sums[None, :]
+    if name == "bray_curtis":
+        num, den = 2.0 * min_sums, total
+    elif name == "weighted_jaccard":
+        num, den = min_sums, total - min_sums
+    else:
+        raise ValueError(f"Unknown similarity kernel: {name}")
+    return np.divide(num, den, out=np.ones_like(num), where=den > 0)
+
+
+def _fused_similarities(i0, i1, kernels):
+    min_sums = min_sums_block(i0, i1)                       #computed once, shared by all the kernels
+    results = []
+    for name, params in kernels.items():
+        block = _kernel_block(name, i0, i1, min_sums, params)
+        block[block < params["threshold"]] = 0.0
+        results.append(_nonzero_entries(block, i0))
+    return results
+
+
+def _run_task(task):
+    func, args = task
+    return func(*args)
+
+
+# Applies func(*args) to every args tuple of tasks and yields the results in task order, in a fork pool of n_jobs
+    # workers (serially with one job or without fork). func must be a module level function (it is sent to the workers
+    # by name); large inputs go through module level dicts filled before the call (inherited by the workers)
+def map_tasks(func, tasks, n_jobs=None):
+    tasks = [(func, args) for args in tasks]
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(n_jobs, len(tasks))
+
+    if n_jobs <= 1 or "fork" not in mp.get_all_start_methods():
+        for task in tasks:
+            yield _run_task(task)
+        return
+
+    with mp.get_context("fork").Pool(n_jobs) as pool:
+        yield from pool.imap(_run_task, tasks)
+
+
+# Applies func(i0, i1, *args) to every row block of matrix and yields the results in block order.
+    # func must be a module level function (it is sent to the workers by name).
+    # With stop, only the rows [0, stop) are used as block rows (they are still compared with all rows)
+def map_blocks(matrix, func, *args, block_size=BLOCK_SIZE, n_jobs=None, prepare=None, stop=None):
+    n_rows = _share(matrix)
+    if prepare is not None:                 #extra shared structures, built once before the workers start
+        prepare()
+    stop = n_rows if stop is None else min(stop, n_rows)
+    yield from map_tasks(func, [(i0, min(i0 + block_size, stop)) + args for i0 in range(0, stop, block_size)],
+                         n_jobs=n_jobs)
+
+
+def _to_coo(results, n_rows):
+    rows, cols, data = [], [], []
+    for r, c, d in results:
+        rows.append(r)
+        cols.append(c)
+        data.append(d)
+
+    if not rows:
+        return sp.coo_matrix((n_rows, n_rows))
+    return sp.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=(n_rows, n_rows))
+
+
+# All-pairs dissimilarity matrix (COO, zero distances not stored)
+def dissimilarity_coo(matrix, block_size=BLOCK_SIZE, n_jobs=None):
+    results = map_blocks(matrix, _nonzero_dissimilarities, block_size=block_size, n_jobs=n_jobs)
+    return _to_coo(results, matrix.shape[0])
+
+
+# Rows of matrix permuted so that `rows` come first (permutation returned too)
+def _rows_first(matrix, rows):
+    rows = np.asarray(rows)
+    rest = np.setdiff1d(np.arange(matrix.shape[0]), rows)
+    perm = np.concatenate([rows, rest])
+    return sp.csr_matrix(matrix)[perm], perm
+
+
+# Distribution of all the n x n pairwise dissimilarities, accumulated block by block in a PairStats.
+    # If rows is given, only the pairs (i, j) with i in rows are used (a sample of the distribution).
+    # With collapse=True, identical rows are computed once and their pairs counted with multiplicity: same result
+def dissimilarity_stats(matrix, stats=None, rows=None, collapse=True, block_size=BLOCK_SIZE, n_jobs=None):
+    stats = PairStats() if stats is None else stats
+    stop, prepare = None, None
+    if rows is not None:
+        matrix, _ = _rows_first(matrix, rows)
+        stop = len(rows)
+    elif collapse:
+        matrix, _, sizes = collapse_rows(matrix)
+        prepare = lambda: _shared.update(weights=sizes)
+
+    for block_stats in map_blocks(matrix, _dissimilarity_stats, block_size=block_size, n_jobs=n_jobs, stop=stop,
+                                  prepare=prepare):
+        stats.merge(block_stats)
+    return stats
+
+
+# All-pairs similarities S = exp(-lam*D) keeping only S >= threshold, yielded as (rows, cols, values) row block by row
+    # block (rows [i0, i1), entries sorted by row and column) as soon as each block is computed, so a consumer such as
+    # edge_store.write_edge_shards never holds more than one block; nothing n x n ever exists in memory.
+    # With prune=True (and threshold > 0) only the candidate pairs of the pruning index are evaluated: same result.
+    # With collapse=True, similarities are computed between the classes of identical rows of each block and expanded
+    # back to the rows (identical rows get similarity 1 with each other): same result.
+    # If a PairStats is given, it is fed with all the n x n similarities (dropped ones count as zeros) once the last
+    # block has been yielded
+def similarity_blocks(matrix, lam, threshold, stats=None, prune=True, collapse=True, block_size=BLOCK_SIZE,
+                      n_jobs=None):
+    n_rows = matrix.shape[0]
+    prune = prune and threshold > 0
+    d_max = np.log(1.0 / threshold) / lam if prune and lam > 0 else np.inf
+
+    if collapse:
+        classes, row_class, sizes = collapse_rows(matrix)
+        _share(classes)
+        _shared.update(row_class=row_class, members=np.argsort(row_class, kind="stable"), class_sizes=sizes,
+                       class_starts=np.cumsum(sizes) - sizes)
+        if prune:
+            _share_pruning_index(d_max)
+        results = map_tasks(_expanded_similarities, [(i0, min(i0 + block_size, n_rows), lam, threshold, prune)
+                                                     for i0 in range(0, n_rows, block_size)], n_jobs=n_jobs)
+    elif prune:
+        results = map_blocks(matrix, _pruned_similarities, lam, threshold, block_size=block_size, n_jobs=n_jobs,
+                             prepare=lambda: _share_pruning_index(d_max))
+    else:
+        results = map_blocks(matrix, _thresholded_similarities, lam, threshold, block_size=block_size, n_jobs=n_jobs)
+
+    nnz = 0
+    for rows, cols, vals in results:
+        if stats is not None:
+            stats.update(vals)
+        nnz += len(vals)
+        yield rows, cols, vals
+    if stats is not None:
+        stats.add_constant(0.0, n_rows * n_rows - nnz)
+
+
+# All-pairs similarity matrix S = exp(-lam*D) keeping only S >= threshold (COO): the blocks of similarity_blocks
+    # gathered in one matrix (see there for prune, collapse and stats)
+def similarity_coo(matrix, lam, threshold, stats=None, prune=True, collapse=True, block_size=BLOCK_SIZE, n_jobs=None):
+    return _to_coo(similarity_blocks(matrix, lam, threshold, stats=stats, prune=prune, collapse=collapse,
+                                     block_size=block_size, n_jobs=n_jobs), matrix.shape[0])
+
+
+# All the pairs with dissimilarity D <= d_max (zero distances included, stored explicitly) as a COO matrix of D,
+    # evaluated on the candidate pairs of the pruning index only. With collapse=True, computed between classes of
+    # identical rows and expanded back to the rows: same result
+def close_pairs_coo(matrix, d_max, collapse=True, block_size=BLOCK_SIZE, n_jobs=None):
+    if collapse:
+        classes, row_class, _ = collapse_rows(matrix)
+        return expand_coo(close_pairs_coo(classes, d_max, collapse=False, block_size=block_size, n_jobs=n_jobs),
+                          row_class)
+
+    results = map_blocks(matrix, _close_pairs, d_max, block_size=block_size, n_jobs=n_jobs,
+                         prepare=lambda: _share_pruning_index(d_max))
+    return _to_coo(results, matrix.shape[0])
+
+
+# Several thresholded similarity matrices from one pass over the pairs: kernels maps a kernel name (see KERNELS)
+    # to its parameters, e.g. {"exp_l1": {"lam": lam, "threshold": 0.1}, "bray_curtis": {"threshold": 0.5}}.
+    # The min-sum term is computed once per block for all of them. Returns {name: COO matrix}
+def fused_similarity_coo(matrix, kernels, collapse=True, block_size=BLOCK_SIZE, n_jobs=None):
+    for name in kernels:
+        if name not in KERNELS:
+            raise ValueError(f"Unknown similarity kernel: {name}")
+
+    row_class = None
+    if collapse:
+        matrix, row_class, _ = collapse_rows(matrix)
+
+    per_kernel = {name: [] for name in kernels}
+    for results in map_blocks(matrix, _fused_similarities, kernels, block_size=block_size, n_jobs=n_jobs):
+        for name, entries in zip(kernels, results):
+            per_kernel[name].append(entries)
+
+    out = {}
+    for name, results in per_kernel.items():
+        coo = _to_coo(results, matrix.shape[0])
+        out[name] = coo if row_class is None else expand_coo(coo, row_class)
+    return out
+
+
+# Exact thresholded similarities of the given rows with all the rows: COO of shape (len(rows), n),
+    # row r of the result is rows[r] of the full similarity matrix
+def similarity_rows(matrix, rows, lam, threshold, block_size=BLOCK_SIZE, n_jobs=None):
+    permuted, perm = _rows_first(matrix, rows)
+    results = map_blocks(permuted, _thresholded_similarities, lam, threshold, block_size=block_size, n_jobs=n_jobs,
+                         stop=len(rows))
+    block = _to_coo(results, matrix.shape[0])
+    return sp.coo_matrix((block.data, (block.row, perm[block.col])), shape=(len(rows), matrix.shape[0]))
@@ -2,11 +2,17 @@ from collections import defaultdict
 from collections import Counter
 import re
 import scipy.sparse as sp
-import json
 import numpy as np
 import matplotlib.pyplot as plt
-import plotly.express as px
-from dsmz_processing import matrix
+from dsmz_processing import load_matrix, MATRIX_FILTERS
+from dissimilarity import dissimilarity_stats, fused_similarity_coo, similarity_blocks, similarity_coo
+from pair_stats import PairStats
+from similarity_lsh import lsh_similarity_coo, lsh_recall
+from edge_store import write_edge_shards, coo_blocks
+from artifacts import LABELS, write_artifact
+from heatmap import save_similarity_heatmap
+from incremental import (save_similarity_state, STATE_FILE, CHANGES_FILE, GRAPH_STATE_FILE, EDGES_DIR,
+                         SIMILARITY_FILE, WRITE_SIMILARITY_NPZ)
 import os
 
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -14,107 +20,112 @@ STAGING_DATA_DIR = os.path.join(PROJECT_DIR, "project_data/staging_data")
 RESULTS_DIR = os.path.join(PROJECT_DIR, "results")
 
 
-with open(os.path.join(STAGING_DATA_DIR, "labels_no_fungi.json"), "r") as f:
-    labels = json.load(f)
+#Filtered taxon x habitat count matrix (CSR, Compressed Sparse Row, easy for computations), memoized in staging_data
+sparse_mat, row_labels, column_labels = load_matrix(**MATRIX_FILTERS)
+row_labels = row_labels.tolist()
+column_labels = column_labels.tolist()
 
-row_labels = labels["row_labels"]
-column_labels = labels["column_labels"]
-r_label_to_index = labels["r_label_to_index"]
-c_label_to_index = labels["c_label_to_index"]
+#Storing configuration of matrix as a typed artifact (read by graph.py and community_analysis.py)
+write_artifact(LABELS, {"row_labels": row_labels, "column_labels": column_labels})
 
-#Creating sparse matrix  (LIst of List, easy to fill)
-sparse_mat = sp.lil_matrix((len(row_labels), len(column_labels)), dtype=float)
-
-#Filling
-for ncbi, ncbi_idx in r_label_to_index.items():
-    for habitat_idx, bd_list in matrix[ncbi_idx].items():    #For takes the bacdive codes list for each column
-        sparse_mat[ncbi_idx, habitat_idx] = len(bd_list)   #Element ij of sparse matrix is the number of bacteria that is_a ncbi and lives_in habitat
-
-
-sparse_mat = sparse_mat.tocsr() #Conversion of matrix to CSR_matrix (Compressed Sparse Row, easy for computations)
-sparse_mat_csc = sparse_mat.tocsc() #Usage of CSC_matrix (Compressed Sparse Column, easy for computations)
 n_rows = sparse_mat.shape[0]
-row_sums = np.asarray(sparse_mat.sum(axis=1)).ravel()
-
-rows, cols, data = [], [], []
-
-for i in range(n_rows):                         #Dissimilarity_mat for loop
-    row_vals = row_sums[i] + row_sums
-
-    # Subtract 2 * sum_k min(A[i,k], A[j,k]) for rows that share columns
-    si, ei = sparse_mat.indptr[i], sparse_mat.indptr[i+1]
-    cols_i = sparse_mat.indices[si:ei]
-    vals_i = sparse_mat.data[si:ei]
-
-    for kcol, vik in zip(cols_i, vals_i):
-        cs, ce = sparse_mat_csc.indptr[kcol], sparse_mat_csc.indptr[kcol+1]
-        c_rows = sparse_mat_csc.indices[cs:ce]
-        c_vals = sparse_mat_csc.data[cs:ce]
-        row_vals[c_rows] -= 2.0 * np.minimum(vik, c_vals)
-
-    
-    row_vals[i] = 0.0                               #self distance must be 0
-    row_vals[np.abs(row_vals) < 1e-12] = 0.0        #tiny float noise to zero
-    row_cols = np.arange(n_rows)
-    row_data = row_vals
-
-    nz = row_data != 0
-    rows.extend([i]*int(nz.sum()))
-    cols.extend(row_cols[nz])
-    data.extend(row_data[nz])
-
-#Creating in final (COO, COOrdinates) matrix
-dissimilarity_mat = sp.coo_matrix((data, (rows, cols)), shape=(n_rows, n_rows))
-
-similarity_mat = dissimilarity_mat.toarray()
+n_pairs = n_rows * n_rows
+
+#Similarity mode: "exact" (all pairs) or "approximate" (MinHash/LSH candidate pairs, for very large taxon sets)
+SIMILARITY_MODE = "exact"
+    # Rows sampled by the approximate mode for the dissimilarity distribution (hence lambda) and the recall check
+SAMPLE_ROWS = 500
+    # Kernels compared with S = exp(-λD) in the same pass (exact mode), name -> threshold, e.g.
+    # {"bray_curtis": 0.10, "weighted_jaccard": 0.10}: each one is saved in similarity_<name>_coo_mat22_no_fungi.npz
+COMPARED_KERNELS = {}
+
+#Streaming statistics of all the n x n pairwise dissimilarities (fed block by block by the kernel)
+if SIMILARITY_MODE == "exact":
+    dissim_stats = dissimilarity_stats(sparse_mat)
+else:
+    sample_rows = np.sort(np.random.default_rng(42).choice(n_rows, min(SAMPLE_ROWS, n_rows), replace=False))
+    dissim_stats = dissimilarity_stats(sparse_mat, rows=sample_rows)
+    print(f"\nApproximate mode: dissimilarity distribution estimated on {len(sample_rows)} sampled rows")
 
 # For Dissimilarity distribution plot
-vals = similarity_mat.ravel()
-
 plt.figure(figsize=(8,5))
-plt.hist(vals, bins=np.linspace(0, 2000, 200))
+dissim_stats.plot_hist(bins=np.linspace(0, 2000, 200))
 plt.xlabel("Dissimilarity value")
 plt.ylabel("Frequency")
 plt.title("Distribution of pairwise dissimilarities")
 plt.savefig(os.path.join(RESULTS_DIR, "distribuzione_dissimilarity_mat22_no_fungi.png"), dpi=300)
 print("\n=== Dissimilarity statistics ===")
-print("Min:", vals.min(),
-      "Max:", vals.max(),
-      "Mean:", vals.mean(),
-      "Median:", np.median(vals))
+print("Min:", dissim_stats.min(),
+      "Max:", dissim_stats.max(),
+      "Mean:", dissim_stats.mean(),
+      "Median:", dissim_stats.median())
 
 #Parameters
-lam= np.log(2)/np.median(vals)
+lam= np.log(2)/dissim_stats.median()
 threshold = 0.10
 
-np.exp(-lam * similarity_mat, out=similarity_mat)
-similarity_mat[similarity_mat < threshold] = 0.0
-vals = similarity_mat.ravel()
-
-#Heatmap construction
-heatmap = px.imshow(similarity_mat, x=row_labels, y=row_labels, color_continuous_scale="Inferno", aspect="auto",)
-heatmap.update_traces(hovertemplate="NCBI X: %{x}<br>" + "NCBI Y: %{y}<br>" + "Similarity: %{z:.5f}<extra></extra>")
-heatmap.update_layout(width=900, height=900)
-
-heatmap.write_html(os.path.join(RESULTS_DIR, "similarity_22_heatmap_no_fungi.html"))
-
-#Sparse comeback!
-similarity_mat = sp.coo_matrix(similarity_mat)
+#Similarities are computed and thresholded block by block: only S >= threshold is ever stored
+sim_stats = PairStats()
+similarity_mat = None
+if SIMILARITY_MODE == "exact" and COMPARED_KERNELS:
+    #Fused mode: the other kernels come from the same min-sum terms, in the same pass
+    kernels = {"exp_l1": {"lam": lam, "threshold": threshold}}
+    kernels.update({name: {"threshold": t} for name, t in COMPARED_KERNELS.items()})
+    compared = fused_similarity_coo(sparse_mat, kernels)
+    similarity_mat = compared.pop("exp_l1")
+    sim_stats.update(similarity_mat.data)
+    sim_stats.add_constant(0.0, n_pairs - similarity_mat.nnz)
+
+    for name, mat in compared.items():
+        sp.save_npz(os.path.join(STAGING_DATA_DIR, f"similarity_{name}_coo_mat22_no_fungi.npz"), mat)
+        print(f"\nSaved similarity_{name}_coo_mat22_no_fungi.npz ({mat.nnz} non zero values)")
+elif SIMILARITY_MODE == "exact" and WRITE_SIMILARITY_NPZ:
+    similarity_mat = similarity_coo(sparse_mat, lam, threshold, stats=sim_stats)
+elif SIMILARITY_MODE != "exact":
+    similarity_mat = lsh_similarity_coo(sparse_mat, lam, threshold)
+    sim_stats.update(similarity_mat.data)
+    sim_stats.add_constant(0.0, n_pairs - similarity_mat.nnz)
+    print(f"LSH recall on {len(sample_rows)} sampled rows: {lsh_recall(sparse_mat, similarity_mat, lam, threshold, sample_size=SAMPLE_ROWS):.4f}")
+
+#Edges as memory-mapped (row, col, weight) shards + manifest, read shard by shard by graph.py. In exact mode every row
+    # block goes to the shards as soon as it is computed: the whole COO is never in memory
+if similarity_mat is None:
+    edge_blocks = similarity_blocks(sparse_mat, lam, threshold, stats=sim_stats)
+else:
+    edge_blocks = coo_blocks(similarity_mat)
+manifest = write_edge_shards(edge_blocks, n_rows, EDGES_DIR)
+print(f"\nSaved similarity_edges_no_fungi/ ({len(manifest['shards'])} shards, {manifest['n_edges']} edges)")
+
+#Legacy COO matrix (only with WRITE_SIMILARITY_NPZ, it needs the whole COO in memory)
+if similarity_mat is not None and WRITE_SIMILARITY_NPZ:
+    sp.save_npz(SIMILARITY_FILE, similarity_mat)
+    print(f"Saved {os.path.basename(SIMILARITY_FILE)}")
+elif os.path.exists(SIMILARITY_FILE):
+    os.remove(SIMILARITY_FILE)                      #stale: older than the shards
 
 print("\n=== Similarity statistics ===")
-print(f"Number of non zero values: {similarity_mat.nnz}")
-print(f"Number of zero values: {(similarity_mat.shape[0] * similarity_mat.shape[0])-similarity_mat.nnz}")
-print("Min:", vals.min(),
-      "Max:", vals.max(),
-      "Mean:", vals.mean(),
-      "Median:", np.median(vals))
+print(f"Number of non zero values: {manifest['n_edges']}")
+print(f"Number of zero values: {n_pairs-manifest['n_edges']}")
+print("Min:", sim_stats.min(),
+      "Max:", sim_stats.max(),
+      "Mean:", sim_stats.mean(),
+      "Median:", sim_stats.median())
 
 plt.figure(figsize=(8,5))
-plt.hist(vals, bins=np.linspace(0, 1, 100))
+sim_stats.plot_hist(bins=np.linspace(0, 1, 100))
 plt.xlabel("Similarity value")
 plt.ylabel("Frequency")
 plt.title("Distribution of pairwise similarities (S = exp(-λD))")
 plt.savefig(os.path.join(RESULTS_DIR, "distribuzione_similarity_mat22_no_fungi.png"), dpi=300)
 
-#Saving matrix
-sp.save_npz(os.path.join(STAGING_DATA_DIR, "similarity_coo_mat22_no_fungi.npz"), similarity_mat)
\ No newline at end of file
+#Multi-resolution heatmap from the shards (block-aggregated PNG tiles + viewer, bounded size, never a dense n x n
+    # matrix). Taxa in RCM order here: `python scripts/heatmap.py` after graph.py orders them by community
+save_similarity_heatmap(order_by="rcm")
+
+#State for incremental.py (exact mode with the exp kernel only, the compared kernels are not patched)
+if SIMILARITY_MODE == "exact" and not COMPARED_KERNELS:
+    save_similarity_state(MATRIX_FILTERS, sparse_mat, row_labels, column_labels, lam, threshold, dissim_stats)
+else:
+    for stale in (STATE_FILE, CHANGES_FILE, GRAPH_STATE_FILE):
+        if os.path.exists(stale):
+            os.remove(stale)
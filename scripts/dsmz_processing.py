@@ -1,96 +1,261 @@
-from collections import defaultdict
-from collections import Counter
-import re
+from array import array
+import hashlib
 import json
 import numpy as np
+import scipy.sparse as sp
 import os
 
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 RAW_DATA_DIR = os.path.join(PROJECT_DIR, "project_data/initial_data")
 STAGING_DATA_DIR = os.path.join(PROJECT_DIR, "project_data/staging_data")
 
-#Putting all lines (splitted) in array (of arrays)
-with open(os.path.join(RAW_DATA_DIR, "DSMZ_Habitat.txt"), 'r') as text:
-    info = [line.strip().split("\t") for line in text]
-
-bacteria = {}
-
-#Filling bacteria dict as: Bacterium[BD_CODE] = [[NCBI/PATH/TO/BACTERIUM], [LAST/FIVE/HABITATS/OF/PATHS]]
-for i in range(len(info)):
-    bd_code = info[i][8]
-    ncbi_path = [t for t in re.split(r'/ncbi:|/', info[i][3])[1:] if t and not t.startswith("bd:")]
-    habitat_paths = info[i][7].split(',')
-    habitat_path = set()
-    for hp in habitat_paths:
-        habitat_path.update([h for h in re.split(r'/OBT:|/', hp)[2:] if h])
-    if bd_code in bacteria:                                                                         #if bacterium already exists it adds new habitats
-        bacteria[bd_code][1].update(habitat_path)
-    else:
-        bacteria[bd_code] = [ncbi_path, habitat_path]
-for bd_code in bacteria:
-    bacteria[bd_code][1] = list(bacteria[bd_code][1])
-
-bacteria = {                            #removing fungi bacteria
-    bd_code: value
-    for bd_code, value in bacteria.items()
-    if "4751" not in value[0]
-}
-
-
-#Habitats filter >3
-habitat_counter = Counter()
-for _, habitats in bacteria.values():
-    habitat_counter.update(habitats)
-
-excluded_habitats = {"000001", "000006", "000009", "000010", "000013", "000014", "000039", "000047", "000089", "000158", "000193", "000490"}       
-min_bacteria_per_habitat = 2
-filtered_habitats = {habitat for habitat, count in habitat_counter.items() if count >= min_bacteria_per_habitat and habitat not in excluded_habitats}
-
-habitat_counter = Counter() #Re-initializing of counter
-for _, habitats in bacteria.values():
-    for h in habitats:
-        if h in filtered_habitats:
-            habitat_counter[h] += 1
-
-#Taxonomy ID filter >3
-ncbi_counter = Counter()
-for ncbi, _ in bacteria.values():
-    ncbi_counter.update(ncbi)
-
-excluded_ncbi = {"1"}
-min_bacteria_per_ncbi = 2
-filtered_ncbi = {ncbi for ncbi, count in ncbi_counter.items() if count >= min_bacteria_per_ncbi and ncbi not in excluded_ncbi}
-
-ncbi_counter = Counter() #Re-initializing of counter
-for ncbi, _ in bacteria.values():
-    for n in ncbi:
-        if n in filtered_ncbi:
-            ncbi_counter[n] += 1
-
-#Creating matrix
-matrix = defaultdict(lambda: defaultdict(set))          #this structure automatically creates the dict whenever we call a key that doesn't exist
-row_labels = list(filtered_ncbi)
-column_labels = list(filtered_habitats)
-r_label_to_index = {label: idx for idx, label in enumerate(row_labels)}
-c_label_to_index = {label: idx for idx, label in enumerate(column_labels)}
-
-#Storing configuration of matrix in json
-with open(os.path.join(STAGING_DATA_DIR, "labels_no_fungi.json"), "w") as f:
-    json.dump({
-        "row_labels": row_labels,
-        "column_labels": column_labels,
-        "r_label_to_index": r_label_to_index,
-        "c_label_to_index": c_label_to_index
-    }, f, indent=2)
-
-#Filling matrix: Element ij of matrix is the list of bacdive codes (bacteria)
-    #that share same ncbi and live same habitat
-for bd_code, (taxids, habitats) in bacteria.items():
-    bac_taxids_filtered = [t for t in taxids if t in r_label_to_index]
-    bac_habitats_filtered = [h for h in habitats if h in c_label_to_index]
-
-    for taxid in bac_taxids_filtered:
-        for habitat in bac_habitats_filtered:
-            i = r_label_to_index[taxid]
-            j = c_label_to_index[habitat]
-            matrix[i][j].add(bd_code)
\ No newline at end of file
+RAW_DATA_FILE = os.path.join(RAW_DATA_DIR, "DSMZ_Habitat.txt")
+
+
+#Content hash of a raw data file (key of the cached parse); with size, hash of its first size bytes only
+def file_hash(path, chunk_size=1 << 20, size=None):
+    sha = hashlib.sha256()
+    remaining = float("inf") if size is None else size
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(int(min(chunk_size, remaining)))
+            if not chunk:
+                break
+            sha.update(chunk)
+            remaining -= len(chunk)
+    return sha.hexdigest()
+
+
+#NCBI path "/ncbi:1/ncbi:2/.../bd:CODE" -> ["1", "2", ...] (same as re.split(r'/ncbi:|/', path)[1:] without bd codes)
+def _ncbi_path(path):
+    taxids = []
+    for t in path.split("/")[1:]:
+        if t.startswith("ncbi:"):
+            t = t[5:]
+        if t and not t.startswith("bd:"):
+            taxids.append(t)
+    return taxids
+
+
+#Habitat path "/OBT:000001/OBT:000002/..." -> ["000002", ...] (same as re.split(r'/OBT:|/', path)[2:], root excluded)
+def _habitat_path(path):
+    habitats = []
+    for h in path.split("/")[2:]:
+        if h.startswith("OBT:"):
+            h = h[4:]
+        if h:
+            habitats.append(h)
+    return habitats
+
+
+#Streaming parser of DSMZ_Habitat.txt: taxids, habitats and bacdive codes are interned to integer ids
+    #(in order of first appearance) while reading, one line at a time. Returns compact arrays:
+    # - taxon_labels, habitat_labels, bd_labels: id -> string
+    # - strain_taxa[strain_taxa_ptr[s]:strain_taxa_ptr[s+1]]: NCBI path of strain s (ids of the first record of the strain)
+    # - strain_habitats[strain_habitats_ptr[s]:strain_habitats_ptr[s+1]]: sorted habitat ids of strain s (union over its records)
+    #With previous (the parse of the first offset bytes of the file, e.g. before new strains were appended) only the
+    #lines after offset are read, on top of it: same result as parsing the whole file
+def parse_habitat_file(path, previous=None, offset=0):
+    taxon_ids, habitat_ids, bd_ids = {}, {}, {}
+    strain_taxa, strain_taxa_ptr = array("i"), array("q", [0])
+    pair_strains, pair_habitats = array("i"), array("i")
+
+    if previous is not None:
+        for ids, key in ((taxon_ids, "taxon_labels"), (habitat_ids, "habitat_labels"), (bd_ids, "bd_labels")):
+            ids.update((label, i) for i, label in enumerate(previous[key].tolist()))
+        strain_taxa.extend(previous["strain_taxa"].tolist())
+        strain_taxa_ptr = array("q", previous["strain_taxa_ptr"].tolist())
+        pair_strains.extend(np.repeat(np.arange(len(bd_ids)), np.diff(previous["strain_habitats_ptr"])).tolist())
+        pair_habitats.extend(previous["strain_habitats"].tolist())
+
+    with open(path, "r") as text:
+        text.seek(offset)
+        for line in text:
+            fields = line.strip().split("\t")
+            strain = bd_ids.setdefault(fields[8], len(bd_ids))
+
+            if strain == len(strain_taxa_ptr) - 1:                    #new bacterium: its NCBI path is the one of its first record
+                strain_taxa.extend(taxon_ids.setdefault(t, len(taxon_ids)) for t in _ncbi_path(fields[3]))
+                strain_taxa_ptr.append(len(strain_taxa))
+
+            for hp in fields[7].split(","):
+                for h in _habitat_path(hp):
+                    pair_strains.append(strain)
+                    pair_habitats.append(habitat_ids.setdefault(h, len(habitat_ids)))
+
+    #Habitats of each strain as a sorted set of ids (CSR-like layout)
+    n_strains, n_habitats = len(bd_ids), max(len(habitat_ids), 1)
+    keys = np.unique(np.frombuffer(pair_strains, dtype=np.int32).astype(np.int64) * n_habitats
+                     + np.frombuffer(pair_habitats, dtype=np.int32))
+    strain_habitats_ptr = np.searchsorted(keys // n_habitats, np.arange(n_strains + 1))
+
+    return {
+        "taxon_labels": np.array(list(taxon_ids), dtype=str),
+        "habitat_labels": np.array(list(habitat_ids), dtype=str),
+        "bd_labels": np.array(list(bd_ids), dtype=str),
+        "strain_taxa": np.frombuffer(strain_taxa, dtype=np.int32).copy(),
+        "strain_taxa_ptr": np.frombuffer(strain_taxa_ptr, dtype=np.int64).copy(),
+        "strain_habitats": (keys % n_habitats).astype(np.int32),
+        "strain_habitats_ptr": strain_habitats_ptr.astype(np.int64),
+    }
+
+
+#Content hash of the raw file, re-computed only when its size or modification time change
+    #(hashes are remembered in cache_dir/source_hashes.json)
+def source_hash(path=RAW_DATA_FILE, cache_dir=STAGING_DATA_DIR):
+    index_file = os.path.join(cache_dir, "source_hashes.json")
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file, "r") as f:
+            index = json.load(f)
+
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    if key in index and index[key][:2] == [stat.st_size, stat.st_mtime_ns]:
+        return index[key][2]
+
+    index[key] = [stat.st_size, stat.st_mtime_ns, file_hash(path)]
+    with open(index_file, "w") as f:
+        json.dump(index, f, indent=2)
+    return index[key][2]
+
+
+#Parsed raw file, cached in staging_data as dsmz_parse_<hash>.npz: re-runs on an unchanged file skip parsing
+def load_habitat_data(path=RAW_DATA_FILE, cache_dir=STAGING_DATA_DIR):
+    raw_hash = source_hash(path, cache_dir)
+    cache_file = os.path.join(cache_dir, f"dsmz_parse_{raw_hash[:16]}.npz")
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            if str(cached["source_hash"]) == raw_hash:
+                return {key: cached[key] for key in cached.files}
+
+    parsed = parse_habitat_file(path)
+    parsed["source_hash"] = np.array(raw_hash)
+    np.savez(cache_file, **parsed)
+    return parsed
+
+
+#Parse of a raw file that is a previous version (content hash previous_hash, previous_size bytes) with lines appended:
+    #only the new lines are parsed, on top of the cached parse of the previous version, and the result is cached like
+    #load_habitat_data does. None if the file does not start with the previous version or its parse is not cached
+def load_appended_habitat_data(previous_hash, previous_size, path=RAW_DATA_FILE, cache_dir=STAGING_DATA_DIR):
+    previous_file = os.path.join(cache_dir, f"dsmz_parse_{previous_hash[:16]}.npz")
+    if not os.path.exists(previous_file) or os.path.getsize(path) < previous_size:
+        return None
+    if file_hash(path, size=previous_size) != previous_hash:
+        return None
+    with open(path, "rb") as f:                                 #the previous version must end with a complete line
+        f.seek(max(previous_size - 1, 0))
+        if previous_size > 0 and f.read(1) != b"\n":
+            return None
+
+    with np.load(previous_file) as cached:
+        previous = {key: cached[key] for key in cached.files}
+    raw_hash = source_hash(path, cache_dir)
+    cache_file = os.path.join(cache_dir, f"dsmz_parse_{raw_hash[:16]}.npz")
+    parsed = parse_habitat_file(path, previous=previous, offset=previous_size)
+    parsed["source_hash"] = np.array(raw_hash)
+    np.savez(cache_file, **parsed)
+    return parsed
+
+
+#Default filters
+EXCLUDED_HABITATS = {"000001", "000006", "000009", "000010", "000013", "000014", "000039", "000047", "000089", "000158", "000193", "000490"}
+EXCLUDED_NCBI = {"1"}
+FUNGI_TAXID = "4751"
+
+
+#Filtered taxon x habitat count matrix from the parsed raw file: element ij is the number of bacteria
+    #that is_a ncbi i (anywhere in their NCBI path) and lives_in habitat j
+def build_matrix(parsed, min_bacteria_per_habitat=2, excluded_habitats=EXCLUDED_HABITATS,
+                 min_bacteria_per_ncbi=2, excluded_ncbi=EXCLUDED_NCBI, fungi_taxid=FUNGI_TAXID):
+    taxon_labels = parsed["taxon_labels"]
+    habitat_labels = parsed["habitat_labels"]
+    taxa, taxa_ptr = parsed["strain_taxa"], parsed["strain_taxa_ptr"]
+    habitats, habitats_ptr = parsed["strain_habitats"], parsed["strain_habitats_ptr"]
+    n_strains = len(taxa_ptr) - 1
+
+    #Strain of every entry of the two relations
+    taxa_strain = np.repeat(np.arange(n_strains), np.diff(taxa_ptr))
+    habitats_strain = np.repeat(np.arange(n_strains), np.diff(habitats_ptr))
+
+    #Removing fungi bacteria
+    keep_strain = np.ones(n_strains, dtype=bool)
+    keep_strain[taxa_strain[np.isin(taxa, np.flatnonzero(taxon_labels == fungi_taxid))]] = False
+
+    #Habitats filter: number of (non fungi) bacteria living in each habitat
+    habitat_count = np.bincount(habitats[keep_strain[habitats_strain]], minlength=len(habitat_labels))
+    keep_habitat = (habitat_count >= min_bacteria_per_habitat) & ~np.isin(habitat_labels, list(excluded_habitats))
+
+    #Taxonomy ID filter: number of (non fungi) bacteria under each taxid
+    ncbi_count = np.bincount(taxa[keep_strain[taxa_strain]], minlength=len(taxon_labels))
+    keep_ncbi = (ncbi_count >= min_bacteria_per_ncbi) & ~np.isin(taxon_labels, list(excluded_ncbi))
+
+    #Rows and columns are kept in order of first appearance in the raw file
+    row_ids, column_ids = np.flatnonzero(keep_ncbi), np.flatnonzero(keep_habitat)
+    r_index = np.full(len(taxon_labels), -1)
+    r_index[row_ids] = np.arange(len(row_ids))
+    c_index = np.full(len(habitat_labels), -1)
+    c_index[column_ids] = np.arange(len(column_ids))
+
+    #Strain x taxon lineage incidence (1 if the taxid is in the NCBI path of the strain) and strain x habitat incidence
+    in_lineage = keep_strain[taxa_strain] & (r_index[taxa] >= 0)
+    lineage = sp.csr_matrix((np.ones(in_lineage.sum()), (taxa_strain[in_lineage], r_index[taxa[in_lineage]])),
+                            shape=(n_strains, len(row_ids)))
+    lineage.data[:] = 1.0                   #a taxid repeated in a path still counts the bacterium once
+
+    in_habitat = keep_strain[habitats_strain] & (c_index[habitats] >= 0)
+    habitat = sp.csr_matrix((np.ones(in_habitat.sum()), (habitats_strain[in_habitat], c_index[habitats[in_habitat]])),
+                            shape=(n_strains, len(column_ids)))
+
+    #Element ij = number of bacteria with taxid i in the lineage and living in habitat j, in one sparse product
+    matrix = (lineage.T @ habitat).tocsr()
+    matrix.sort_indices()
+    return matrix, taxon_labels[row_ids], habitat_labels[column_ids]
+
+
+#Filters of load_matrix in canonical (json) form: part of the cache key, compared by the incremental update
+def filter_params(min_bacteria_per_habitat=2, excluded_habitats=EXCLUDED_HABITATS,
+                  min_bacteria_per_ncbi=2, excluded_ncbi=EXCLUDED_NCBI, fungi_taxid=FUNGI_TAXID):
+    return {
+        "min_bacteria_per_habitat": int(min_bacteria_per_habitat),
+        "excluded_habitats": sorted(excluded_habitats),
+        "min_bacteria_per_ncbi": int(min_bacteria_per_ncbi),
+        "excluded_ncbi": sorted(excluded_ncbi),
+        "fungi_taxid": str(fungi_taxid),
+    }
+
+
+#Filters of the pipeline matrix, shared by dsmz_matrix.py, incremental.py and sweep.py (a change here means a full
+    #rebuild: the incremental update compares them with the stored ones)
+MATRIX_FILTERS = filter_params(min_bacteria_per_habitat=2, excluded_habitats=EXCLUDED_HABITATS,
+                               min_bacteria_per_ncbi=2, excluded_ncbi=EXCLUDED_NCBI, fungi_taxid=FUNGI_TAXID)
+
+
+#Filtered taxon x habitat matrix (CSR) with its row (NCBI) and column (habitat) labels.
+    #Results are memoized in cache_dir as taxon_habitat_<key>.npz, keyed by the raw file hash and the filters,
+    #so later calls (and other stages or notebooks) load it without parsing nor filtering anything
+def load_matrix(min_bacteria_per_habitat=2, excluded_habitats=EXCLUDED_HABITATS,
+                min_bacteria_per_ncbi=2, excluded_ncbi=EXCLUDED_NCBI, fungi_taxid=FUNGI_TAXID,
+                path=RAW_DATA_FILE, cache_dir=STAGING_DATA_DIR):
+    params = filter_params(min_bacteria_per_habitat, excluded_habitats, min_bacteria_per_ncbi, excluded_ncbi, fungi_taxid)
+    raw_hash = source_hash(path, cache_dir)
+    key = hashlib.sha256(json.dumps([raw_hash, params], sort_keys=True).encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, f"taxon_habitat_{key[:16]}.npz")
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            if str(cached["key"]) == key:
+                matrix = sp.csr_matrix((cached["data"], cached["indices"], cached["indptr"]), shape=tuple(cached["shape"]))
+                return matrix, cached["row_labels"], cached["column_labels"]
+
+    matrix, row_labels, column_labels = build_matrix(load_habitat_data(path, cache_dir), **params)
+    np.savez(cache_file, key=np.array(key), data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+             shape=np.array(matrix.shape), row_labels=row_labels, column_labels=column_labels)
+    return matrix, row_labels, column_labels
+
+
+if __name__ == "__main__":
+    matrix, row_labels, column_labels = load_matrix()
+    print(f"Taxon x habitat matrix: {matrix.shape[0]} NCBI taxids x {matrix.shape[1]} habitats, {matrix.nnz} non zero values")
@@ -0,0 +1,113 @@
+import json
+import shutil
+import numpy as np
+import os
+
+#Edges stored in one shard (3 files: row, col, weight) and read in one block by the graph stage
+SHARD_EDGES = 10_000_000
+#Fixed dtypes of the shard files
+ROW_DTYPE, COL_DTYPE, WEIGHT_DTYPE = np.int32, np.int32, np.float32
+MANIFEST = "manifest.json"
+
+
+# Entries of a COO matrix as blocks of at most block_edges (row, col, weight), in storage order
+def coo_blocks(coo, block_edges=SHARD_EDGES):
+    for e0 in range(0, coo.nnz, block_edges):
+        e1 = min(e0 + block_edges, coo.nnz)
+        yield coo.row[e0:e1], coo.col[e0:e1], coo.data[e0:e1]
+
+
+# Writes the (row, col, weight) blocks of an n_nodes x n_nodes similarity matrix as .npy shards of shard_edges entries
+    # (memory-mapped while they are filled, so only one block is in memory) plus a manifest.json in directory.
+    # The shards are written in directory.partial and replace the previous directory only once complete, so the
+    # blocks may be read from the shards being replaced (e.g. by the incremental update)
+def write_edge_shards(blocks, n_nodes, directory, shard_edges=SHARD_EDGES):
+    target, directory = directory, directory + ".partial"
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+    shards = []
+    arrays, filled = None, 0
+
+    def close_shard():
+        if arrays is not None:
+            for array in arrays:
+                array.flush()
+            shards[-1]["n_edges"] = filled
+
+    for rows, cols, weights in blocks:
+        done = 0
+        while done < len(rows):
+            if arrays is None or filled == shard_edges:
+                close_shard()
+                name = f"shard_{len(shards):05d}"
+                shards.append({"row": f"{name}_row.npy", "col": f"{name}_col.npy", "weight": f"{name}_weight.npy",
+                               "n_edges": 0})
+                arrays = [np.lib.format.open_memmap(os.path.join(directory, shards[-1][key]), mode="w+", dtype=dtype,
+                                                    shape=(shard_edges,))
+                          for key, dtype in (("row", ROW_DTYPE), ("col", COL_DTYPE), ("weight", WEIGHT_DTYPE))]
+                filled = 0
+            take = min(len(rows) - done, shard_edges - filled)
+            for array, values in zip(arrays, (rows, cols, weights)):
+                array[filled:filled + take] = values[done:done + take]
+            filled += take
+            done += take
+    close_shard()
+    arrays = None
+
+    #The last shard is cut to its filled length (rewritten: .npy files can not be shrunk in place)
+    if shards and shards[-1]["n_edges"] < shard_edges:
+        for key in ("row", "col", "weight"):
+            path = os.path.join(directory, shards[-1][key])
+            tail = np.load(path, mmap_mode="r")[:shards[-1]["n_edges"]].copy()
+            np.save(path, tail)
+
+    manifest = {"n_nodes": int(n_nodes), "n_edges": int(sum(s["n_edges"] for s in shards)),
+                "dtypes": {"row": np.dtype(ROW_DTYPE).name, "col": np.dtype(COL_DTYPE).name,
+                           "weight": np.dtype(WEIGHT_DTYPE).name},
+                "shards": shards}
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(directory, target)
+    return manifest
+
+
+# Read side of a shard directory: blocks() yields the (row, col, weight) shards memory-mapped (read only), in the
+    # order they were written, so the whole edge list is never loaded at once
+class EdgeShards:
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST), "r") as f:
+            self.manifest = json.load(f)
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, MANIFEST))
+
+    @property
+    def n_nodes(self):
+        return self.manifest["n_nodes"]
+
+    @property
+    def n_edges(self):
+        return self.manifest["n_edges"]
+
+    def blocks(self):
+        for shard in self.manifest["shards"]:
+            yield tuple(np.load(os.path.join(self.directory, shard[key]), mmap_mode="r")
+                        for key in ("row", "col", "weight"))
+
+    # Weighted degree of every node (label index), accumulated shard by shard in float64; as in networkx a self-loop
+        # counts twice. Only positive weights are edges of the graph (same as CSRGraph.from_coo)
+    def weighted_degree(self):
+        degree = np.zeros(self.n_nodes)
+        for rows, cols, weights in self.blocks():
+            keep = weights > 0
+            rows, cols, weights = rows[keep], cols[keep], weights[keep].astype(np.float64)
+            degree += np.bincount(rows, weights=weights, minlength=self.n_nodes)
+            loops = rows == cols
+            degree += np.bincount(rows[loops], weights=weights[loops], minlength=self.n_nodes)
+        return degree
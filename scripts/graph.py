@@ -1,12 +1,14 @@
-import networkx as nx
 import json
 import scipy.sparse as sp
-from tqdm import tqdm
-import community.community_louvain as community_louvain
 import time
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
+from csr_graph import CSRGraph
+from edge_store import EdgeShards
+from artifacts import BC_CC, DEGREES_I, DEGREES_II, LABELS, LAYOUT, Artifact, load_columns, write_artifact
+from layout import component_layout_3d
+from communities import community_ensemble
+from betweenness import betweenness_centrality, adaptive_betweenness_centrality
 import os
 
 start_time = time.time()
@@ -14,40 +16,65 @@ start_time = time.time()
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 STAGING_DATA_DIR = os.path.join(PROJECT_DIR, "project_data/staging_data")
 
-similarity_coo_mat = sp.load_npz(os.path.join(STAGING_DATA_DIR, "similarity_coo_mat22_no_fungi.npz"))
-
-with open(os.path.join(STAGING_DATA_DIR,  "labels_no_fungi.json"), "r") as f:
-    labels = json.load(f)
-
-row_labels = labels["row_labels"]
-column_labels = labels["column_labels"]
-
-similarity_graph = nx.Graph()
-for i, j, w in tqdm(zip(similarity_coo_mat.row, similarity_coo_mat.col, similarity_coo_mat.data), desc = "Costruzione Graph"):
-    if w > 0:
-        similarity_graph.add_edge(row_labels[i], row_labels[j], weight=w)
-print("Number of non-zero elements of the graph:", similarity_coo_mat.nnz)
+#Similarity edges: memory-mapped shards written by dsmz_matrix.py (read one shard at a time), or the npz of older runs
+EDGES_DIR = os.path.join(STAGING_DATA_DIR, "similarity_edges_no_fungi")
+edge_shards = EdgeShards(EDGES_DIR) if EdgeShards.exists(EDGES_DIR) else None
+
+#Incremental update (incremental.py): taxa whose similarities changed since the last run of this script. The layout
+    # then starts from the previous positions and only the clustering coefficients they can affect are recomputed
+CHANGES_FILE = os.path.join(STAGING_DATA_DIR, "incremental_changes_no_fungi.json")
+GRAPH_STATE_FILE = os.path.join(STAGING_DATA_DIR, "graph_state_no_fungi.json")
+changes = None
+if os.path.exists(CHANGES_FILE):
+    with open(CHANGES_FILE, "r") as f:
+        changes = json.load(f)
+    print(f"Incremental update: {len(changes['changed'])} changed taxa, {len(changes['affected'])} affected")
+
+#Taxid labels of the rows (memory-mapped column of the labels artifact written by dsmz_matrix.py)
+row_labels, = load_columns(LABELS, "row_labels")
+
+#CSR graph (int32 indices, float32 weights, taxid label array); networkx only where an algorithm needs it
+if edge_shards is not None:
+    csr_graph = CSRGraph.from_shards(edge_shards, row_labels)
+    print("Number of non-zero elements of the graph:", edge_shards.n_edges)
+else:
+    similarity_coo_mat = sp.load_npz(os.path.join(STAGING_DATA_DIR, "similarity_coo_mat22_no_fungi.npz"))
+    csr_graph = CSRGraph.from_coo(similarity_coo_mat, row_labels)
+    print("Number of non-zero elements of the graph:", similarity_coo_mat.nnz)
+    del similarity_coo_mat
 
 end_time = time.time() 
 elapsed = end_time - start_time
-print(f"Execution time after nx.graph construction: {elapsed:.2f} seconds ({elapsed/60:.2f} minutes)")
+print(f"Execution time after CSR graph construction: {elapsed:.2f} seconds ({elapsed/60:.2f} minutes)")
 
-# Degree computation
-degrees = [degree for node, degree in similarity_graph.degree(weight="weight")]
+# Degree computation (self-loops counted twice as in networkx): streamed over the shards, or one sparse reduction
+if edge_shards is not None:
+    degrees = edge_shards.weighted_degree()[csr_graph.nodes]
+else:
+    degrees = csr_graph.weighted_degree()
 
-df_degrees = pd.DataFrame({"weighted_degree": degrees})
-df_degrees.to_csv(os.path.join(STAGING_DATA_DIR, "degrees_i.csv"), index=False)
+write_artifact(DEGREES_I, {"weighted_degree": degrees})
 
-print("\nSaved degrees_i.csv")
+print("\nSaved degrees_i")
 end_time = time.time() 
 elapsed = end_time - start_time
 print(f"Execution time after saving degrees_i: {elapsed:.2f} seconds ({elapsed/60:.2f} minutes)")
 
 
-# 3D spring layout
-pos3 = nx.spring_layout(similarity_graph, dim=3, weight="weight")
+# 3D spring layout (multilevel, grid repulsion, spectral seed), one connected component per task (largest first),
+    # components then packed side by side
+    # Warm start from the positions of the previous layout artifact (if any)
+WARM_START_LAYOUT = False
+    # Progress saved here during the layout (one file per component), an interrupted run resumes from it
+LAYOUT_CHECKPOINT = os.path.join(STAGING_DATA_DIR, "layout_checkpoint.npz")
+
+initial_pos = None
+if (WARM_START_LAYOUT or changes is not None) and Artifact.exists(LAYOUT):
+    previous_labels, *previous_xyz = load_columns(LAYOUT, "labels", "x", "y", "z")
+    initial_pos = dict(zip(previous_labels.tolist(), np.column_stack(previous_xyz)))
 
-labels = list(similarity_graph.nodes())
+labels = csr_graph.node_labels
+pos3 = dict(zip(labels, component_layout_3d(csr_graph, initial_pos=initial_pos, checkpoint=LAYOUT_CHECKPOINT)))
 x = [pos3[n][0] for n in labels]
 y = [pos3[n][1] for n in labels]
 z = [pos3[n][2] for n in labels]
@@ -55,35 +82,45 @@ z = [pos3[n][2] for n in labels]
 print(f"\nSpring layout completed")
 end_time = time.time() 
 elapsed = end_time - start_time
-print(f"Execution time after 3D nx.spring_layout: {elapsed:.2f} seconds ({elapsed/60:.2f} minutes)")
+print(f"Execution time after 3D spring layout: {elapsed:.2f} seconds ({elapsed/60:.2f} minutes)")
 
-    # Louvain community detection
-partition = community_louvain.best_partition(similarity_graph, weight="weight")
-communities = [partition[n] for n in labels]
+    # Louvain community detection on the CSR graph: one run per (seed, resolution) in parallel, best modularity kept
+LOUVAIN_SEEDS = range(8)
+LOUVAIN_RESOLUTIONS = (1.0,)
+    # Leiden-style refinement (disconnected communities are split)
+LEIDEN_REFINE = False
+
+partition, modularity, stability = community_ensemble(csr_graph, seeds=LOUVAIN_SEEDS, resolutions=LOUVAIN_RESOLUTIONS,
+                                                      refine=LEIDEN_REFINE)
+communities = partition.tolist()
     # Number of communities
 unique_comms = sorted(set(communities))
 N = len(unique_comms)
 
 print(f"\nFound {N} communities")
-pos3_list = {node: pos3[node].tolist() for node in labels}
 
-output = {"labels": labels, "pos3": pos3_list, "communities": communities, "unique_comms": list(unique_comms), "N": N}
+write_artifact(LAYOUT, {"labels": labels, "x": x, "y": y, "z": z, "community": communities, "stability": stability},
+               meta={"modularity": modularity})
 
-with open(os.path.join(STAGING_DATA_DIR, "graph_layout_data_no_fungi.json"), "w") as f:
-    json.dump(output, f)
-    
-print("Saved graph_layout_data.json")
+print("Saved graph_layout")
 end_time = time.time() 
 elapsed = end_time - start_time
 print(f"Execution time after community detection: {elapsed:.2f} seconds ({elapsed/60:.2f} minutes)")
 
 
-#Betweenness Centrality
+#Betweenness Centrality (sampled sources in parallel on the CSR graph, same samples as nx.betweenness_centrality)
     # Number of sample nodes
 k = 800  
+    # Adaptive mode: sources are added until the top BC_TOP_N nodes change by at most BC_TOLERANCE (k is then the maximum)
+ADAPTIVE_BC = False
+BC_TOP_N = 100
+BC_TOLERANCE = 0.01
 
-
-b_c_approx = nx.betweenness_centrality(similarity_graph, k=k, weight="weight", seed=42)
+if ADAPTIVE_BC:
+    b_c_values, k = adaptive_betweenness_centrality(csr_graph, top_n=BC_TOP_N, tol=BC_TOLERANCE, max_k=k, seed=42)
+else:
+    b_c_values = betweenness_centrality(csr_graph, k=min(k, csr_graph.n_nodes), seed=42)
+b_c_approx = dict(zip(csr_graph.node_labels, b_c_values))
 
 sorted_bc_nodes = sorted(b_c_approx.items(), key = lambda x: x[1], reverse=True)
 
@@ -98,61 +135,48 @@ PERCENT = 0.70
     # Max number of neighbors for each node
 M_MAX = 2000           
 
-keep_edges = {}
-
-for node in tqdm(list(similarity_graph.nodes()), desc="Top-percent selection"):
-
-    neighbors = similarity_graph[node]
-    weights = [(nbr, data["weight"]) for nbr, data in neighbors.items()]
-    n_of_edges = len(weights)
-
-    if n_of_edges == 0:
-        keep_edges[node] = set()
-        continue
-
-    # Number of neighbors to keep
-    M_node = int(PERCENT * n_of_edges)
-    if M_node > M_MAX:
-        M_node = M_MAX
-    if M_node < 1:
-        M_node = 1
-
-    # Keep all neighbors if less than M_Max
-    if n_of_edges <= M_node:
-        keep_edges[node] = set(n for n, w in weights)
-        continue
-
-    # ordering by decreasing weight
-    weights_sorted = sorted(weights, key=lambda x: x[1], reverse=True)
-
-    # keep only top M_node
-    keep_edges[node] = set(n for n, w in weights_sorted[:M_node])
-
-for u, v in tqdm(list(similarity_graph.edges()), desc="Cutting arcs"):
-    # keep arc only if both nodes want the neighbor
-    if not (v in keep_edges[u] and u in keep_edges[v]):
-        similarity_graph.remove_edge(u, v)
+# Each node selects its top min(PERCENT*degree, M_MAX) neighbours (per row partial selection on the CSR arrays,
+    # blocks of rows), an arc is kept only if both nodes select it
+sparse_graph = csr_graph.sparsify_top_percent(PERCENT, M_MAX)
 
 end_time = time.time() 
 elapsed = end_time - start_time
 print(f"\nExecution time after sparsification: {elapsed:.2f} seconds ({elapsed/60:.2f} minutes)")
-print(f"Number of non-zero elements after sparsification:", similarity_graph.number_of_edges())
+print(f"Number of non-zero elements after sparsification:", sparse_graph.n_edges)
 
 
 # New Degree computation
-degrees = [degree for node, degree in similarity_graph.degree(weight="weight")]
+degrees = sparse_graph.weighted_degree()
 
-df_degrees = pd.DataFrame({"weighted_degree": degrees})
-df_degrees.to_csv(os.path.join(STAGING_DATA_DIR, "degrees_ii.csv"), index=False)
+write_artifact(DEGREES_II, {"weighted_degree": degrees})
 
-print("\nSaved degrees_ii.csv")
+print("\nSaved degrees_ii")
 end_time = time.time() 
 elapsed = end_time - start_time
 print(f"Execution time after saving degrees_ii: {elapsed:.2f} seconds ({elapsed/60:.2f} minutes)")
 
 
-# Clustering Coefficient
-clustering_coeffs = nx.clustering(similarity_graph, weight='weight')
+# Clustering Coefficient (same weighted definition as nx.clustering, with sparse products over blocks of rows)
+graph_state = {"percent": PERCENT, "m_max": M_MAX, "max_weight": float(sparse_graph.weights.max(initial=0.0))}
+previous_state = None
+if os.path.exists(GRAPH_STATE_FILE):
+    with open(GRAPH_STATE_FILE, "r") as f:
+        previous_state = json.load(f)
+
+if changes is not None and previous_state == graph_state and Artifact.exists(BC_CC):
+    # Only the selections of the affected taxa changed: their sparse edges, hence the coefficients of the affected
+        # taxa and of the taxa that select them. The others keep their previous value (same global max weight)
+    previous_ncbi, previous_cc = load_columns(BC_CC, "ncbi", "cc")
+    previous_cc = dict(zip(previous_ncbi.tolist(), previous_cc.tolist()))
+    label_to_row = {label: i for i, label in enumerate(row_labels)}
+    affected = np.array([label_to_row[label] for label in changes["affected"]], dtype=np.int64)
+    selectors = csr_graph.top_percent_selection(PERCENT, M_MAX).tocsc()[:, affected].tocoo().row
+    recompute = np.union1d(affected, selectors)
+    clustering_coeffs = {label: previous_cc.get(label, 0.0) for label in sparse_graph.node_labels}
+    clustering_coeffs.update(zip(sparse_graph.labels[recompute].tolist(), sparse_graph.clustering(rows=recompute)))
+    print(f"Clustering coefficient recomputed for {len(recompute)} of {sparse_graph.n_nodes} nodes")
+else:
+    clustering_coeffs = dict(zip(sparse_graph.node_labels, sparse_graph.clustering()))
 
     # ordering by decreasing clustering coefficient values
 sorted_cc_nodes = sorted(clustering_coeffs.items(), key=lambda x: x[1], reverse=True)
@@ -167,14 +191,17 @@ cc_dict = dict(sorted_cc_nodes)
 
 all_ncbi = set(bc_dict.keys()) | set(cc_dict.keys())
 
-with open(os.path.join(STAGING_DATA_DIR, "ncbi_bc_cc(2000-70%)_no_fungi.txt"), "w") as f:
-    f.write("ncbi\tbc\tcc\n")
-    for ncbi in sorted(all_ncbi):
-        bc_val = bc_dict.get(ncbi, 0.0)
-        cc_val = cc_dict.get(ncbi, 0.0)
-        f.write(f"{ncbi}\t{bc_val:.25f}\t{cc_val:.25f}\n")
+all_ncbi = sorted(all_ncbi)
+write_artifact(BC_CC, {"ncbi": all_ncbi, "bc": [bc_dict.get(ncbi, 0.0) for ncbi in all_ncbi],
+                       "cc": [cc_dict.get(ncbi, 0.0) for ncbi in all_ncbi]})
+
+print(f'\nSaved ncbi_bc_cc')
 
-print(f'\nSaved ncbi_bc_cc(2000-70%)_no_fungi.txt')
+#Parameters of this run (checked by the next incremental update), the changes are now used
+with open(GRAPH_STATE_FILE, "w") as f:
+    json.dump(graph_state, f)
+if changes is not None:
+    os.remove(CHANGES_FILE)
 end_time = time.time()
 elapsed = end_time - start_time
 print(f"\nTotal execution time: {elapsed:.2f} seconds ({elapsed/60:.2f} minutes)")
\ No newline at end of file
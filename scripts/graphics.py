@@ -1,4 +1,3 @@
-import json
 import time
 import colorsys
 import plotly.graph_objects as go
@@ -6,6 +5,8 @@ import plotly.express as px
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
+from viewer3d import write_lod_viewer
+from artifacts import BC_CC, COMMUNITY_NODES, COMMUNITY_RANKS, DEGREES_I, DEGREES_II, LAYOUT, Artifact
 import os
 
 start_time = time.time()
@@ -14,16 +15,13 @@ PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 STAGING_DATA_DIR = os.path.join(PROJECT_DIR, "project_data/staging_data")
 RESULTS_DIR = os.path.join(PROJECT_DIR, "results")
 
-# Load data for plots
-with open(os.path.join(STAGING_DATA_DIR, "graph_layout_data_no_fungi.json"), "r") as f:
-    data = json.load(f)
-
-nodes_df = pd.read_csv(os.path.join(STAGING_DATA_DIR, "ncbi_node_info_with_communities.csv"))
-rank_dist_df = pd.read_csv(os.path.join(STAGING_DATA_DIR, "community_rank_distribution.csv"))
-summary_df = pd.read_csv(os.path.join(STAGING_DATA_DIR, "summaries_of_communities.csv"))
-bc_cc_df = pd.read_csv(os.path.join(STAGING_DATA_DIR, "ncbi_bc_cc(2000-70%)_no_fungi.txt"), sep="\t")
-degrees_i_df = pd.read_csv(os.path.join(STAGING_DATA_DIR, "degrees_i.csv"))
-degrees_ii_df = pd.read_csv(os.path.join(STAGING_DATA_DIR, "degrees_ii.csv"))
+# Load data for plots: only the columns used below, memory-mapped from the artifacts of the previous stages
+layout = Artifact(LAYOUT)
+nodes_df = Artifact(COMMUNITY_NODES).frame(["ncbi", "rank"])
+rank_dist_df = Artifact(COMMUNITY_RANKS).frame()
+bc_cc_df = Artifact(BC_CC).frame()
+degrees_i = np.asarray(Artifact(DEGREES_I)["weighted_degree"])
+degrees_ii = np.asarray(Artifact(DEGREES_II)["weighted_degree"])
 
 # Degree histogram plot function
 def plot_degree_histogram(degrees, bins, filename, xlim=None, ylim=None):
@@ -51,38 +49,43 @@ def distinct_colors(n):
         out.append(f"rgb({int(r*255)}, {int(g*255)}, {int(b*255)})")
     return out
 
-labels = data["labels"]
-pos3 = data["pos3"]
-communities = data["communities"]
-unique_comms = data["unique_comms"]
-N = data["N"]
-x = [pos3[n][0] for n in labels]
-y = [pos3[n][1] for n in labels]
-z = [pos3[n][2] for n in labels]
+labels = layout["labels"].tolist()
+communities = layout["community"].tolist()
+unique_comms = sorted(set(communities))
+N = len(unique_comms)
+x, y, z = np.asarray(layout["x"]), np.asarray(layout["y"]), np.asarray(layout["z"])
 palette = distinct_colors(N)
 color_map = {comm: palette[i] for i, comm in enumerate(unique_comms)}
 
-# Assign RGB colors to each node
-node_colors = [color_map[c] for c in communities]
-
-# 3D SCatterPlot generation
-fig = go.Figure(data=[go.Scatter3d(
-    x=x, y=y, z=z,
-    mode='markers',
-    marker=dict(
-        size=2,
-        color=node_colors,
-    ),
-    text=labels,
-    customdata=communities,
-    hovertemplate=
-        "<b>NCBI:</b> %{text}<br>" +
-        "Community: %{customdata}<br>" +
-        "<extra></extra>"
-)])
-
-fig.write_html(os.path.join(RESULTS_DIR, "louvain_3d_graph_22_no_fungi.html"))
-print("Saved louvain_3d_graph_22.html")
+# 3D community plot: above LOD_VIEWER_MIN_NODES the level of detail viewer (one trace per community, decimated
+    # previews expanded on click, binary coordinates), otherwise the single trace scatter plot
+LOD_VIEWER_MIN_NODES = 20_000
+
+if len(labels) >= LOD_VIEWER_MIN_NODES:
+    lod_file = write_lod_viewer(labels, x, y, z, communities, color_map)
+    print(f"Saved {os.path.relpath(lod_file, RESULTS_DIR)}")
+else:
+    # Assign RGB colors to each node
+    node_colors = [color_map[c] for c in communities]
+
+    # 3D SCatterPlot generation
+    fig = go.Figure(data=[go.Scatter3d(
+        x=x, y=y, z=z,
+        mode='markers',
+        marker=dict(
+            size=2,
+            color=node_colors,
+        ),
+        text=labels,
+        customdata=communities,
+        hovertemplate=
+            "<b>NCBI:</b> %{text}<br>" +
+            "Community: %{customdata}<br>" +
+            "<extra></extra>"
+    )])
+
+    fig.write_html(os.path.join(RESULTS_DIR, "louvain_3d_graph_22_no_fungi.html"))
+    print("Saved louvain_3d_graph_22.html")
 
 elapsed = time.time() - start_time
 print(f"Execution time after 3D Scatter Plot generation: {elapsed:.2f} seconds ({elapsed/60:.2f} minutes)")
@@ -113,13 +116,11 @@ elapsed = time.time() - start_time
 print(f"Execution time after Betweenness centrality-Clustering coefficient Scatter Plot generation: {elapsed:.2f} seconds ({elapsed/60:.2f} minutes)")
 
 # Degree distributions plots generation
-degrees_i = degrees_i_df["weighted_degree"].values
 print("\n=== Degree statistics ===")
 print(f"Min degree: {degrees_i.min():.2f}")
 print(f"Max degree: {degrees_i.max():.2f}")
 print(f"Mean degree: {degrees_i.mean():.2f}")
 
-degrees_ii = degrees_ii_df["weighted_degree"].values
 print("\n=== Degree statistics (after sparsification) ===")
 print(f"Min degree: {degrees_ii.min():.2f}")
 print(f"Max degree: {degrees_ii.max():.2f}")
@@ -0,0 +1,301 @@
+import json
+import shutil
+import numpy as np
+import matplotlib.pyplot as plt
+import scipy.sparse as sp
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+from artifacts import LABELS, LAYOUT, Artifact, load_columns
+from community_summary import community_codes
+from edge_store import EdgeShards
+from dsmz_processing import PROJECT_DIR, STAGING_DATA_DIR
+import os
+
+RESULTS_DIR = os.path.join(PROJECT_DIR, "results")
+EDGES_DIR = os.path.join(STAGING_DATA_DIR, "similarity_edges_no_fungi")
+HEATMAP_DIR = os.path.join(RESULTS_DIR, "similarity_heatmap_no_fungi")
+OVERVIEW_FILE = os.path.join(RESULTS_DIR, "similarity_heatmap_overview_no_fungi.png")
+
+#Pixels per tile side: level 0 (overview) fits in one tile, every next level halves the taxa per pixel
+TILE_SIZE = 256
+#Drill-down stops before the first level with more non-empty tiles than this (bounds the number and size of the files)
+MAX_TILES_PER_LEVEL = 1024
+#... or with more non-empty pixels than this: a level holds about 2x this many (key, value) pairs (16 bytes each) while
+    # it is aggregated, i.e. about 256 MB with 8M pixels
+MAX_LEVEL_PIXELS = 8_000_000
+#Value of a pixel (block of taxa x taxa): "mean" similarity of the block (zeros included) or "max"
+AGGREGATE = "mean"
+#Taxid labels (and communities) shown by the viewer only up to this many taxa (they are one js file)
+MAX_VIEWER_LABELS = 200_000
+COLORMAP = "inferno"
+#Heaviest neighbours kept per taxon for the RCM order: the ordering graph has at most 2 x this many entries per taxon
+    # (about 16 bytes each), whatever the number of edges
+RCM_NEIGHBOURS = 16
+
+
+# Reverse Cuthill-McKee order of the taxa (sparse seriation: similar taxa end up close to the diagonal)
+def rcm_order(adjacency):
+    return reverse_cuthill_mckee(adjacency.tocsr(), symmetric_mode=True).astype(np.int64)
+
+
+# Symmetric graph of the k heaviest neighbours of every taxon (self-loops excluded), streamed from the edge shards: the
+    # top k kept so far are merged with every shard, on the rows of the shard only, so the memory is O(n k) + one shard
+def neighbour_adjacency(shards, k=RCM_NEIGHBOURS):
+    n = shards.n_nodes
+    top_rows, top_cols = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+    top_weights = np.zeros(0, dtype=np.float32)
+    for rows, cols, weights in shards.blocks():
+        keep = (weights > 0) & (rows != cols)
+        touched = np.zeros(n, dtype=bool)
+        touched[rows[keep]] = True
+        merged = touched[top_rows]
+        rows = np.r_[top_rows[merged], rows[keep]]
+        cols = np.r_[top_cols[merged], cols[keep]]
+        weights = np.r_[top_weights[merged], weights[keep]]
+
+        #Entries by row, then by decreasing weight (ties in shard order): the first k of every row are kept
+        order = np.lexsort((-weights, rows))
+        rows, cols, weights = rows[order], cols[order], weights[order]
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]]) if len(rows) else np.zeros(0, dtype=np.int64)
+        rank = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+        selected = rank < k
+        top_rows = np.r_[top_rows[~merged], rows[selected]]
+        top_cols = np.r_[top_cols[~merged], cols[selected]]
+        top_weights = np.r_[top_weights[~merged], weights[selected]]
+
+    adjacency = sp.csr_matrix((top_weights, (top_rows, top_cols)), shape=(n, n))
+    return adjacency.maximum(adjacency.T).tocsr()
+
+
+# Taxa ordered by community (largest first), in RCM order inside each community; taxa outside the graph go last.
+    # Returns the order (rows) and the community id at every position (-1 for no community)
+def community_order(adjacency, labels, node_labels, communities):
+    rank = np.empty(len(labels), dtype=np.int64)
+    rank[rcm_order(adjacency)] = np.arange(len(labels))
+    node_codes, ids, _ = community_codes(communities)
+    row_of = {label: i for i, label in enumerate(np.asarray(labels).tolist())}
+    rows = np.array([row_of[label] for label in np.asarray(node_labels).tolist()], dtype=np.int64)
+    code = np.full(len(labels), len(ids), dtype=np.int64)
+    code[rows] = node_codes
+    order = np.lexsort((rank, code))
+    return order, np.r_[ids, -1][code[order]]
+
+
+# (key, value) pairs reduced by key: sum or max of the values of every distinct key
+def _reduce(keys, values, how):
+    order = np.argsort(keys, kind="stable")
+    keys, values = keys[order], values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    reduce = np.maximum if how == "max" else np.add
+    return keys[starts], reduce.reduceat(values, starts) if len(keys) else values
+
+
+# Pixels of one level (block x block taxa each, m x m pixels) in one pass over the edge shards: every shard is reduced
+    # to its own (key, value) run and the runs are reduced together once at the end (or as soon as they hold
+    # max_pixels pairs more than the last reduction, so memory stays bounded). Returns (pixel keys r * m + c, values),
+    # or None as soon as the level has more than max_tiles non-empty tiles or more than max_pixels non-empty pixels
+def _level_pixels(shards, position, block, m, how, tile_size=TILE_SIZE, max_tiles=np.inf, max_pixels=np.inf):
+    side = -(-m // tile_size)
+    tiles = np.zeros(0, dtype=np.int64)
+    run_keys, run_values, pending, reduced = [], [], 0, 0
+    for rows, cols, weights in shards.blocks():
+        pixel_rows, pixel_cols = position[rows] // block, position[cols] // block
+        keys, values = _reduce(pixel_rows * m + pixel_cols, np.asarray(weights, dtype=np.float64), how)
+        tiles = np.union1d(tiles, (keys // m) // tile_size * side + (keys % m) // tile_size)
+        if len(tiles) > max_tiles:
+            return None
+        run_keys.append(keys)
+        run_values.append(values)
+        pending += len(keys)
+        if pending > reduced + max_pixels:
+            keys, values = _reduce(np.concatenate(run_keys), np.concatenate(run_values), how)
+            if len(keys) > max_pixels:
+                return None
+            run_keys, run_values, pending, reduced = [keys], [values], len(keys), len(keys)
+
+    if run_keys:
+        keys, values = _reduce(np.concatenate(run_keys), np.concatenate(run_values), how)
+    else:
+        keys, values = np.zeros(0, dtype=np.int64), np.zeros(0)
+    if len(keys) > max_pixels:
+        return None
+    if how != "max":
+        #Mean over the cells of the block (the last row and column of blocks can be smaller)
+        n = len(position)
+        sizes = np.minimum(block, n - np.arange(m) * block).astype(np.float64)
+        values = values / (sizes[keys // m] * sizes[keys % m])
+    return keys, values
+
+
+# Multi-resolution heatmap of the similarity edges of shards (edge_store.EdgeShards), taxa in the given order, straight
+    # from the sparse edges (never a dense n x n matrix): level l has pixels of block = block_0 / 2^l taxa, saved as
+    # PNG tiles directory/tiles/<level>/<row>_<col>.png (empty tiles are not written) plus index.html, a small viewer
+    # (click to zoom in, right click / "-" to zoom out, arrows to pan). Returns the levels written
+def similarity_heatmap(shards, labels, order, directory=HEATMAP_DIR, communities=None, tile_size=TILE_SIZE,
+                       max_tiles=MAX_TILES_PER_LEVEL, max_pixels=MAX_LEVEL_PIXELS, how=AGGREGATE):
+    n = shards.n_nodes
+    position = np.empty(n, dtype=np.int64)
+    position[order] = np.arange(n)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    cmap = plt.get_cmap(COLORMAP)
+    block = 1 << int(np.ceil(np.log2(max(-(-n // tile_size), 1))))
+    levels = []
+    while block >= 1:
+        m = -(-n // block)
+        #Level 0 (one tile) is always written
+        pixels = _level_pixels(shards, position, block, m, how, tile_size, *((max_tiles, max_pixels) if levels else ()))
+        if pixels is None:
+            print(f"Heatmap: more than {max_tiles} tiles or {max_pixels} pixels with {block} taxa per pixel, "
+                  f"drill-down stops at {block * 2} taxa per pixel")
+            break
+        keys, values = pixels
+        rows, cols = keys // m, keys % m
+        tile_keys = rows // tile_size * m + cols // tile_size
+        tile_order = np.argsort(tile_keys, kind="stable")
+        bounds = np.flatnonzero(np.r_[True, tile_keys[tile_order][1:] != tile_keys[tile_order][:-1], True])
+
+        level_dir = os.path.join(directory, "tiles", str(len(levels)))
+        os.makedirs(level_dir)
+        tiles = []
+        for t0, t1 in zip(bounds[:-1], bounds[1:]):
+            pixels = tile_order[t0:t1]
+            ty, tx = rows[pixels[0]] // tile_size, cols[pixels[0]] // tile_size
+            image = np.zeros((min(tile_size, m - ty * tile_size), min(tile_size, m - tx * tile_size)))
+            image[rows[pixels] - ty * tile_size, cols[pixels] - tx * tile_size] = values[pixels]
+            plt.imsave(os.path.join(level_dir, f"{ty}_{tx}.png"), image, cmap=cmap, vmin=0.0, vmax=1.0)
+            tiles.append(f"{ty}_{tx}")
+        levels.append({"block": block, "pixels": m, "tiles": tiles})
+        print(f"Heatmap level {len(levels) - 1}: {block} taxa per pixel, {len(tiles)} tiles")
+        block //= 2
+
+    info = {"n": n, "tile_size": tile_size, "aggregate": how, "levels": levels}
+    with open(os.path.join(directory, "tiles.js"), "w") as f:
+        f.write(f"const HEATMAP = {json.dumps(info)};\n")
+    with open(os.path.join(directory, "labels.js"), "w") as f:
+        if n <= MAX_VIEWER_LABELS:
+            f.write(f"const HEATMAP_LABELS = {json.dumps(np.asarray(labels)[order].tolist())};\n")
+            f.write(f"const HEATMAP_COMMUNITIES = "
+                    f"{json.dumps(None if communities is None else np.asarray(communities).tolist())};\n")
+        else:
+            f.write("const HEATMAP_LABELS = null;\nconst HEATMAP_COMMUNITIES = null;\n")
+    with open(os.path.join(directory, "index.html"), "w") as f:
+        f.write(VIEWER_HTML)
+    return levels
+
+
+VIEWER_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Similarity heatmap</title>
+<style>
+body { font-family: sans-serif; background: #222; color: #ddd; }
+#view { position: relative; width: 768px; height: 768px; background: #000; overflow: hidden; cursor: crosshair; }
+#view img { position: absolute; image-rendering: pixelated; }
+</style>
+<script src="tiles.js"></script>
+<script src="labels.js"></script>
+</head>
+<body>
+<div><button onclick="zoom(-1)">-</button> <span id="status"></span></div>
+<div id="view"></div>
+<div id="hover">&nbsp;</div>
+<script>
+const VIEW = 768, SCALE = VIEW / HEATMAP.tile_size;
+let level = 0, x0 = 0, y0 = 0;
+const view = document.getElementById("view");
+
+function clamp(v, m) { return Math.max(0, Math.min(v, Math.max(m - HEATMAP.tile_size, 0))); }
+
+function draw() {
+  const info = HEATMAP.levels[level], t = HEATMAP.tile_size, present = new Set(info.tiles);
+  view.innerHTML = "";
+  for (let ty = Math.floor(y0 / t); ty * t < y0 + t && ty * t < info.pixels; ty++) {
+    for (let tx = Math.floor(x0 / t); tx * t < x0 + t && tx * t < info.pixels; tx++) {
+      if (!present.has(ty + "_" + tx)) continue;
+      const img = document.createElement("img");
+      img.src = "tiles/" + level + "/" + ty + "_" + tx + ".png";
+      img.style.left = ((tx * t - x0) * SCALE) + "px";
+      img.style.top = ((ty * t - y0) * SCALE) + "px";
+      img.onload = function () { this.style.width = (this.naturalWidth * SCALE) + "px"; };
+      view.appendChild(img);
+    }
+  }
+  document.getElementById("status").textContent = "level " + level + "/" + (HEATMAP.levels.length - 1) +
+    ", " + info.block + " taxa per pixel (" + HEATMAP.aggregate + "), " + HEATMAP.n + " taxa";
+}
+
+function zoom(step, cx, cy) {
+  const next = Math.max(0, Math.min(level + step, HEATMAP.levels.length - 1));
+  if (next === level) return;
+  const f = Math.pow(2, next - level), t = HEATMAP.tile_size;
+  cx = (cx === undefined ? x0 + t / 2 : cx) * f;
+  cy = (cy === undefined ? y0 + t / 2 : cy) * f;
+  level = next;
+  const m = HEATMAP.levels[level].pixels;
+  x0 = clamp(Math.round(cx - t / 2), m);
+  y0 = clamp(Math.round(cy - t / 2), m);
+  draw();
+}
+
+function pixelAt(e) {
+  const r = view.getBoundingClientRect();
+  return [x0 + (e.clientX - r.left) / SCALE, y0 + (e.clientY - r.top) / SCALE];
+}
+
+function describe(p) {
+  const b = HEATMAP.levels[level].block, i0 = Math.floor(p) * b, i1 = Math.min(i0 + b, HEATMAP.n) - 1;
+  if (i0 >= HEATMAP.n) return "";
+  let text = (i0 === i1 ? "#" + i0 : "#" + i0 + "-" + i1);
+  if (HEATMAP_LABELS) text += " NCBI " + HEATMAP_LABELS[i0] + (i0 === i1 ? "" : " ... " + HEATMAP_LABELS[i1]);
+  if (HEATMAP_COMMUNITIES) text += " (community " + HEATMAP_COMMUNITIES[i0] + ")";
+  return text;
+}
+
+view.onclick = function (e) { const [x, y] = pixelAt(e); zoom(1, x, y); };
+view.oncontextmenu = function (e) { e.preventDefault(); const [x, y] = pixelAt(e); zoom(-1, x, y); };
+view.onmousemove = function (e) {
+  const [x, y] = pixelAt(e);
+  document.getElementById("hover").textContent = "Y: " + describe(y) + " | X: " + describe(x);
+};
+document.onkeydown = function (e) {
+  const m = HEATMAP.levels[level].pixels, s = HEATMAP.tile_size / 4;
+  if (e.key === "ArrowLeft") x0 = clamp(x0 - s, m);
+  else if (e.key === "ArrowRight") x0 = clamp(x0 + s, m);
+  else if (e.key === "ArrowUp") y0 = clamp(y0 - s, m);
+  else if (e.key === "ArrowDown") y0 = clamp(y0 + s, m);
+  else if (e.key === "-") return zoom(-1);
+  else if (e.key === "+") return zoom(1);
+  else return;
+  draw();
+};
+draw();
+</script>
+</body>
+</html>
+"""
+
+
+# Heatmap of the similarity edges written by dsmz_matrix.py: taxa by community when graph.py already ran (layout
+    # artifact), otherwise in RCM order. RCM runs on the graph of the RCM_NEIGHBOURS heaviest neighbours of every taxon
+    # (see neighbour_adjacency), never on the whole adjacency. The overview (level 0) is also copied to results/
+def save_similarity_heatmap(order_by="community"):
+    row_labels, = load_columns(LABELS, "row_labels")
+    shards = EdgeShards(EDGES_DIR)
+    adjacency = neighbour_adjacency(shards)
+    if order_by == "community" and Artifact.exists(LAYOUT):
+        node_labels, communities = load_columns(LAYOUT, "labels", "community")
+        order, position_communities = community_order(adjacency, row_labels, node_labels, communities)
+    else:
+        order, position_communities = rcm_order(adjacency), None
+    del adjacency
+
+    levels = similarity_heatmap(shards, row_labels, order, communities=position_communities)
+    if levels and levels[0]["tiles"]:
+        shutil.copyfile(os.path.join(HEATMAP_DIR, "tiles", "0", "0_0.png"), OVERVIEW_FILE)
+    print(f"\nSaved {os.path.basename(HEATMAP_DIR)}/ ({len(levels)} levels) and {os.path.basename(OVERVIEW_FILE)}")
+
+
+if __name__ == "__main__":
+    save_similarity_heatmap()
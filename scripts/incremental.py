@@ -0,0 +1,233 @@
+import itertools
+import json
+import runpy
+import numpy as np
+import scipy.sparse as sp
+from dsmz_processing import (MATRIX_FILTERS, RAW_DATA_FILE, STAGING_DATA_DIR, load_appended_habitat_data,
+                             load_matrix, source_hash)
+from artifacts import LABELS, write_artifact
+from dissimilarity import dissimilarity_stats, similarity_rows
+from edge_store import EdgeShards, coo_blocks, write_edge_shards
+from pair_stats import PairStats
+import os
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#Full rebuild if the median-based lambda moves by more than this (relative) or too many taxa changed
+LAMBDA_TOLERANCE = 0.01
+MAX_CHANGED_FRACTION = 0.25
+
+STATE_FILE = os.path.join(STAGING_DATA_DIR, "similarity_state_no_fungi.npz")
+CHANGES_FILE = os.path.join(STAGING_DATA_DIR, "incremental_changes_no_fungi.json")
+GRAPH_STATE_FILE = os.path.join(STAGING_DATA_DIR, "graph_state_no_fungi.json")
+EDGES_DIR = os.path.join(STAGING_DATA_DIR, "similarity_edges_no_fungi")
+#Legacy COO npz of the similarities: also written (by dsmz_matrix.py and the update) only when this is True, it needs
+    # the whole COO in memory. The shards of EDGES_DIR are the similarity edges of the pipeline
+WRITE_SIMILARITY_NPZ = False
+SIMILARITY_FILE = os.path.join(STAGING_DATA_DIR, "similarity_coo_mat22_no_fungi.npz")
+
+
+# What the incremental update needs from a full (exact mode) run of dsmz_matrix.py: filters, version of the raw file,
+    # taxon x habitat matrix, lambda, threshold and the distribution of the dissimilarities. After a full run
+    # (incremental=False) the next graph.py run recomputes everything, so the changes and graph state are dropped
+def save_similarity_state(params, matrix, row_labels, column_labels, lam, threshold, dissim_stats, incremental=False,
+                          raw_path=RAW_DATA_FILE, path=STATE_FILE):
+    matrix = sp.csr_matrix(matrix)
+    np.savez(path, params=np.array(json.dumps(params, sort_keys=True)), source_hash=np.array(source_hash(raw_path)),
+             source_size=np.array(os.path.getsize(raw_path)), data=matrix.data, indices=matrix.indices,
+             indptr=matrix.indptr, shape=np.array(matrix.shape), row_labels=np.asarray(row_labels, dtype=str),
+             column_labels=np.asarray(column_labels, dtype=str), lam=np.array(lam), threshold=np.array(threshold),
+             dissim_values=dissim_stats.values, dissim_counts=dissim_stats.counts)
+    for stale in ([] if incremental else [CHANGES_FILE, GRAPH_STATE_FILE]):
+        if os.path.exists(stale):
+            os.remove(stale)
+
+
+def load_similarity_state(path=STATE_FILE):
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as cached:
+        state = {key: cached[key] for key in cached.files}
+    state["params"] = json.loads(str(state["params"]))
+    state["matrix"] = sp.csr_matrix((state["data"], state["indices"], state["indptr"]), shape=tuple(state["shape"]))
+    state["dissim_stats"] = PairStats()
+    state["dissim_stats"].values, state["dissim_stats"].counts = state["dissim_values"], state["dissim_counts"]
+    return state
+
+
+# Distribution of the (ordered) pairs of the n x n dissimilarity matrix that involve at least one of rows:
+    # pairs (i, j) and (j, i) with i in rows, minus the pairs inside rows counted twice
+def _pairs_with_rows(matrix, rows):
+    stats = PairStats()
+    if len(rows) == 0:
+        return stats
+    with_all = dissimilarity_stats(matrix, rows=rows)
+    stats.merge(with_all).merge(with_all)
+    return stats.remove(dissimilarity_stats(sp.csr_matrix(matrix)[rows]))
+
+
+# Rows of new whose content differs from the row with the same label in old (new labels included), rows of old whose
+    # label is gone, and the new index of every old row (-1 if removed)
+def _changed_rows(old, old_labels, new, new_labels):
+    new_index = {label: i for i, label in enumerate(new_labels.tolist())}
+    old_to_new = np.array([new_index.get(label, -1) for label in old_labels.tolist()], dtype=np.int64)
+    kept = np.flatnonzero(old_to_new >= 0)
+
+    common = sp.csr_matrix((np.ones(len(kept)), (old_to_new[kept], kept)), shape=(new.shape[0], old.shape[0])) @ old
+    diff = (sp.csr_matrix(new) - common).tocsr()
+    diff.eliminate_zeros()
+
+    is_new = np.ones(new.shape[0], dtype=bool)
+    is_new[old_to_new[kept]] = False
+    changed = np.flatnonzero(is_new | (np.diff(diff.indptr) > 0))
+    return changed, np.flatnonzero(old_to_new < 0), old_to_new
+
+
+# Similarity edges of the updated taxa, streamed block by block in row order (as written by a full run): the old edges
+    # (blocks of the previous shards, sorted by row and column) between unchanged taxa renumbered, merged with the rows
+    # and columns of the changed taxa (changed_coo: their new rows, COO sorted by row and column). Old rows keep their
+    # relative order in the new numbering, so the rows below the first old row still to come are complete and yielded
+def _patched_blocks(old_blocks, old_to_new, changed, changed_coo):
+    n = changed_coo.shape[1]
+    is_changed = np.zeros(n, dtype=bool)
+    is_changed[changed] = True
+
+    #Rows and columns of the changed taxa, both orders (pairs inside changed are already in both orders)
+    new_rows, new_cols = changed[changed_coo.row], changed_coo.col
+    mirror = ~is_changed[new_cols]
+    extra_rows = np.concatenate([new_rows, new_cols[mirror]])
+    extra_cols = np.concatenate([new_cols, new_rows[mirror]])
+    extra_data = np.concatenate([changed_coo.data, changed_coo.data[mirror]])
+    order = np.lexsort((extra_cols, extra_rows))
+    extra_rows, extra_cols, extra_data = extra_rows[order], extra_cols[order], extra_data[order]
+
+    kept_old = np.flatnonzero(old_to_new >= 0)
+    rows, cols, data = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    done = 0
+    for block_rows, block_cols, block_data in itertools.chain(old_blocks, [(None, None, None)]):
+        if block_rows is None:
+            frontier = n
+        else:
+            if len(block_rows) == 0:
+                continue
+            #First new row that may still get old entries: the one of the first kept old row >= the last one seen
+            k = np.searchsorted(kept_old, block_rows[-1])
+            frontier = old_to_new[kept_old[k]] if k < len(kept_old) else n
+            block_rows, block_cols = old_to_new[block_rows], old_to_new[block_cols]
+            keep = (block_rows >= 0) & (block_cols >= 0)
+            keep[keep] &= ~(is_changed[block_rows[keep]] | is_changed[block_cols[keep]])
+            rows = np.concatenate([rows, block_rows[keep]])
+            cols = np.concatenate([cols, block_cols[keep]])
+            data = np.concatenate([data, np.asarray(block_data, dtype=np.float64)[keep]])
+
+        e0, e1 = np.searchsorted(extra_rows, [done, frontier])
+        ready = np.searchsorted(rows, frontier)
+        out_rows = np.concatenate([rows[:ready], extra_rows[e0:e1]])
+        out_cols = np.concatenate([cols[:ready], extra_cols[e0:e1]])
+        out_data = np.concatenate([data[:ready], extra_data[e0:e1]])
+        rows, cols, data = rows[ready:], cols[ready:], data[ready:]
+        done = frontier
+
+        order = np.lexsort((out_cols, out_rows))
+        yield out_rows[order], out_cols[order], out_data[order]
+
+
+def _full_rebuild(reason):
+    print(f"\nFull rebuild: {reason}")
+    runpy.run_path(os.path.join(SCRIPTS_DIR, "dsmz_matrix.py"), run_name="__main__")
+
+
+# Incremental update of the similarity stage after strains were appended to the raw file: only the new lines are
+    # parsed, only the rows and columns of the taxa whose habitat profile changed are recomputed, the dissimilarity
+    # distribution (hence lambda) is patched pair by pair. Falls back to dsmz_matrix.py when the filters or the habitat
+    # columns change, when lambda moves more than LAMBDA_TOLERANCE or when too many taxa changed.
+    # The taxa whose graph neighbourhood changed are saved in CHANGES_FILE for graph.py
+def update():
+    state = load_similarity_state()
+    if state is None:
+        return _full_rebuild("no previous state (run dsmz_matrix.py once)")
+    if state["params"] != MATRIX_FILTERS:
+        return _full_rebuild("matrix filters changed")
+
+    raw_hash = source_hash(RAW_DATA_FILE)
+    if raw_hash == str(state["source_hash"]):
+        print("\nRaw file unchanged: nothing to update")
+        return
+    if load_appended_habitat_data(str(state["source_hash"]), int(state["source_size"])) is None:
+        return _full_rebuild("the raw file is not the previous one with appended lines")
+
+    matrix, row_labels, column_labels = load_matrix(**MATRIX_FILTERS)
+    if not np.array_equal(column_labels, state["column_labels"]):
+        return _full_rebuild("habitat columns changed")
+
+    old = state["matrix"]
+    changed, removed, old_to_new = _changed_rows(old, state["row_labels"], matrix, row_labels)
+    print(f"\nIncremental update: {len(changed)} changed or new taxa, {len(removed)} removed, of {matrix.shape[0]}")
+    if len(changed) + len(removed) > MAX_CHANGED_FRACTION * matrix.shape[0]:
+        return _full_rebuild(f"more than {MAX_CHANGED_FRACTION:.0%} of the taxa changed")
+
+    #Dissimilarity distribution: pairs of the old rows that changed or disappeared out, pairs of the changed rows in
+    dissim_stats = state["dissim_stats"]
+    stale = np.flatnonzero((old_to_new < 0) | np.isin(old_to_new, changed))
+    dissim_stats.remove(_pairs_with_rows(old, stale))
+    dissim_stats.merge(_pairs_with_rows(matrix, changed))
+    lam, new_lam = float(state["lam"]), np.log(2) / dissim_stats.median()
+    print(f"Lambda: {lam:.6g} -> {new_lam:.6g}")
+    if abs(new_lam - lam) > LAMBDA_TOLERANCE * lam:
+        return _full_rebuild(f"lambda moved by more than {LAMBDA_TOLERANCE:.0%}")
+
+    #Old edges: the previous shards (or the float64 values of the legacy npz when it is kept)
+    if WRITE_SIMILARITY_NPZ and os.path.exists(SIMILARITY_FILE):
+        old_coo = sp.load_npz(SIMILARITY_FILE).tocoo()
+        old_blocks = lambda: coo_blocks(old_coo)
+    else:
+        old_blocks = EdgeShards(EDGES_DIR).blocks
+    kept_old = old_to_new[old_to_new >= 0]
+    if np.any(kept_old[1:] <= kept_old[:-1]):
+        return _full_rebuild("the taxa changed order")
+
+    #Rows of the changed taxa recomputed (with the stored lambda)
+    threshold = float(state["threshold"])
+    changed_coo = similarity_rows(matrix, changed, lam, threshold)
+
+    #Taxa whose neighbourhood changed: the changed ones and their old and new neighbours
+    touched = np.zeros(old.shape[0], dtype=bool)
+    touched[stale] = True
+    old_neighbours = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                    [old_to_new[cols[touched[rows]]] for rows, cols, _ in old_blocks()])
+    affected = np.union1d(changed, np.union1d(old_neighbours[old_neighbours >= 0], changed_coo.col))
+
+    #Similarities: old edges renumbered, merged with the rows and columns of the changed taxa, streamed to the shards
+    blocks = _patched_blocks(old_blocks(), old_to_new, changed, changed_coo)
+    if WRITE_SIMILARITY_NPZ:
+        rows, cols, data = (np.concatenate(parts) for parts in zip(*blocks))
+        similarity_mat = sp.coo_matrix((data, (rows, cols)), shape=(matrix.shape[0], matrix.shape[0]))
+        blocks = coo_blocks(similarity_mat)
+    manifest = write_edge_shards(blocks, matrix.shape[0], EDGES_DIR)
+    if WRITE_SIMILARITY_NPZ:
+        sp.save_npz(SIMILARITY_FILE, similarity_mat)
+    row_labels, column_labels = row_labels.tolist(), column_labels.tolist()
+    write_artifact(LABELS, {"row_labels": row_labels, "column_labels": column_labels})
+
+    #Changes of a previous update not yet used by graph.py are carried over
+    changes = {"changed": [row_labels[i] for i in changed], "removed": state["row_labels"][removed].tolist(),
+               "affected": [row_labels[i] for i in affected]}
+    if os.path.exists(CHANGES_FILE):
+        with open(CHANGES_FILE, "r") as f:
+            previous = json.load(f)
+        present = set(row_labels)
+        for key in ("changed", "affected"):
+            changes[key] = sorted(set(changes[key]) | (set(previous[key]) & present))
+        changes["removed"] = sorted((set(changes["removed"]) | set(previous["removed"])) - present)
+
+    save_similarity_state(MATRIX_FILTERS, matrix, row_labels, column_labels, lam, threshold, dissim_stats,
+                          incremental=True)
+    with open(CHANGES_FILE, "w") as f:
+        json.dump(changes, f, indent=2)
+
+    print(f"Saved similarity_edges_no_fungi/ ({manifest['n_edges']} non zero values) "
+          f"and {os.path.basename(CHANGES_FILE)} ({len(changes['affected'])} affected taxa)")
+
+
+if __name__ == "__main__":
+    update()
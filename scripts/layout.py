@@ -0,0 +1,390 @@
+import hashlib
+import os
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import eigsh
+from dissimilarity import map_tasks
+
+#Coarsening stops at this many nodes (or when a level shrinks by less than COARSENING_MIN_RATIO)
+COARSEST_SIZE = 100
+COARSENING_MIN_RATIO = 0.9
+#Handshake rounds of the heavy edge matching (each round matches the mutual heaviest choices of the free nodes)
+MATCHING_ROUNDS = 10
+#Fruchterman-Reingold iterations at the coarsest level, at every finer level and for a warm start
+COARSE_ITERATIONS = 100
+FINE_ITERATIONS = 30
+WARM_ITERATIONS = 20
+#Initial temperature (largest step, the coarsest level starts in the unit cube as in networkx): finer levels and
+    #warm starts only refine
+COARSE_TEMPERATURE = 0.1
+FINE_TEMPERATURE = 0.03
+#Pull of every connected component towards the centre of the domain (same as the gravity of nx.spring_layout)
+GRAVITY = 1.0
+#Mean number of nodes per cell of the finest repulsion grid (2^depth cells per axis)
+CELL_OCCUPANCY = 8
+#Dense eigendecomposition for the spectral seed up to this many nodes, sparse eigsh above
+DENSE_SPECTRAL_MAX = 2000
+#Iterations between two checkpoints
+CHECKPOINT_EVERY = 10
+#Components up to this many nodes are placed directly, without force layout
+TRIVIAL_COMPONENT = 2
+#Free space around every packed component, relative to its size
+PACKING_GAP = 0.2
+
+#Components shared with the worker processes (inherited through fork, see dissimilarity.map_tasks)
+_shared = {}
+
+
+# Node-order adjacency of a CSRGraph without self-loops (float64)
+def _layout_adjacency(graph):
+    adjacency = graph.adjacency.astype(np.float64)[graph.nodes][:, graph.nodes].tocsr()
+    adjacency.setdiag(0)
+    adjacency.eliminate_zeros()
+    return adjacency
+
+
+# Heavy edge matching in handshake rounds: every free node picks its heaviest free neighbour (ties broken by a random
+    # priority of the edge, the same seen from both ends) and mutual picks are matched, so the heaviest free edge is
+    # always matched; nodes still free after MATCHING_ROUNDS stay alone. Returns the (n, n_coarse) aggregation matrix
+def _coarsen(adjacency, rng):
+    n = adjacency.shape[0]
+    match = np.full(n, -1, dtype=np.int64)
+    rows = np.repeat(np.arange(n), np.diff(adjacency.indptr))
+    cols, weights = adjacency.indices, adjacency.data
+    priority = rng.permutation(n)
+    edge = np.maximum(priority[rows], priority[cols]) * n + np.minimum(priority[rows], priority[cols])
+
+    #Every round keeps only the entries between two free nodes (still grouped by row, in CSR order) and takes the
+        # heaviest one of every row with two segmented maxima: first the weight, then the edge priority among the ties
+    for _ in range(MATCHING_ROUNDS):
+        free = (match[rows] < 0) & (match[cols] < 0)
+        rows, cols, weights, edge = rows[free], cols[free], weights[free], edge[free]
+        if len(rows) == 0:
+            break
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        lengths = np.diff(np.r_[starts, len(rows)])
+        heaviest = weights == np.repeat(np.maximum.reduceat(weights, starts), lengths)
+        top = np.maximum.reduceat(np.where(heaviest, edge, -1), starts)
+        chosen = heaviest & (edge == np.repeat(top, lengths))
+        pick = np.full(n, -1, dtype=np.int64)
+        pick[rows[chosen]] = cols[chosen]
+        mutual = np.flatnonzero(pick >= 0)
+        mutual = mutual[pick[pick[mutual]] == mutual]
+        match[mutual] = pick[mutual]
+
+    alone = match < 0
+    match[alone] = np.flatnonzero(alone)
+    leader = np.minimum(np.arange(n), match)
+    _, parent = np.unique(leader, return_inverse=True)
+    return sp.csr_matrix((np.ones(n), (np.arange(n), parent.ravel())), shape=(n, parent.max() + 1))
+
+
+# Levels of the multilevel scheme, finest first: (adjacency, node masses, aggregation matrix to the next level)
+def _hierarchy(adjacency, seed):
+    rng = np.random.default_rng(seed)
+    levels = []
+    mass = np.ones(adjacency.shape[0])
+    while adjacency.shape[0] > COARSEST_SIZE:
+        aggregation = _coarsen(adjacency, rng)
+        if aggregation.shape[1] > COARSENING_MIN_RATIO * adjacency.shape[0]:
+            break
+        levels.append((adjacency, mass, aggregation))
+        adjacency = (aggregation.T @ adjacency @ aggregation).tocsr()
+        adjacency.setdiag(0)
+        adjacency.eliminate_zeros()
+        mass = aggregation.T @ mass
+    levels.append((adjacency, mass, None))
+    return levels
+
+
+# Spectral seed: the first non trivial eigenvectors of the normalized adjacency D^-1/2 A D^-1/2, scaled to [0, 1)
+def _spectral_embedding(adjacency, dim, rng):
+    n = adjacency.shape[0]
+    if n <= dim + 1:
+        return rng.random((n, dim))
+    degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    inv_sqrt = np.zeros(n)
+    inv_sqrt[degree > 0] = 1.0 / np.sqrt(degree[degree > 0])
+    normalized = sp.diags(inv_sqrt) @ adjacency @ sp.diags(inv_sqrt)
+
+    if n <= DENSE_SPECTRAL_MAX:
+        _, vectors = np.linalg.eigh(normalized.toarray())
+        vectors = vectors[:, ::-1]
+    else:
+        values, vectors = eigsh(normalized, k=dim + 1, which="LA", v0=rng.random(n))
+        vectors = vectors[:, np.argsort(-values)]
+
+    pos = vectors[:, 1:dim + 1] * inv_sqrt[:, None]
+    pos[degree == 0] = rng.random(((degree == 0).sum(), dim)) * 2 - 1
+    pos += 1e-6 * rng.standard_normal(pos.shape)                #separates nodes with identical coordinates
+    pos -= pos.min(axis=0)
+    return pos / max(pos.max(), 1e-12)
+
+
+# Repulsion 2 k^2/d (times the masses of the two nodes, as the attraction of aggregated nodes sums their weights) on a
+    # tree of grids (2^l cells per axis at level l, 2^depth at the finest): exact from the nodes of the same and of the
+    # adjacent finest cells, Barnes-Hut style from the mass centroids of the other cells: at every level a cell sees
+    # the cells that are children of its parent's neighbours without being its own neighbours (from its centroid), and
+    # a finest cell sums what its ancestors see. About 6^dim cells per cell and level, instead of all cell pairs
+def _repulsion(pos, mass, k):
+    n, dim = pos.shape
+    depth = max(0, int(round(np.log2(max(n / CELL_OCCUPANCY, 1.0)) / dim)))
+    n_cells = 1 << depth
+    low = pos.min(axis=0)
+    size = max((pos.max(axis=0) - low).max(), 1e-12) / n_cells
+    cell = np.minimum(((pos - low) / size).astype(np.int64), n_cells - 1)
+    cell_id = np.ravel_multi_index(cell.T, (n_cells,) * dim)
+
+    order = np.argsort(cell_id, kind="stable")
+    occupied, starts, counts = np.unique(cell_id[order], return_index=True, return_counts=True)
+    occupied_coords = np.array(np.unravel_index(occupied, (n_cells,) * dim)).T
+    node_slot = np.empty(n, dtype=np.int64)
+    node_slot[order] = np.repeat(np.arange(len(occupied)), counts)
+    leaf_mass = np.bincount(node_slot, weights=mass, minlength=len(occupied))
+    leaf_moment = np.column_stack([np.bincount(node_slot, weights=mass * pos[:, d], minlength=len(occupied))
+                                   for d in range(dim)])
+
+    #Far field: level by level (levels 0 and 1 have no separated cells), the same push for all the nodes of a cell
+    leaf_force = np.zeros((len(occupied), dim))
+    children_of_neighbours = np.array(np.meshgrid(*[np.arange(-2, 4)] * dim, indexing="ij")).reshape(dim, -1).T
+    for level in range(2, depth + 1):
+        side = 1 << level
+        cells, leaf_cell = np.unique(np.ravel_multi_index((occupied_coords >> (depth - level)).T, (side,) * dim),
+                                     return_inverse=True)
+        leaf_cell = leaf_cell.ravel()
+        cell_mass = np.bincount(leaf_cell, weights=leaf_mass)
+        centroids = np.column_stack([np.bincount(leaf_cell, weights=leaf_moment[:, d]) for d in range(dim)])
+        centroids /= cell_mass[:, None]
+        coords = np.array(np.unravel_index(cells, (side,) * dim)).T
+        force = np.zeros((len(cells), dim))
+        for offset in children_of_neighbours:
+            other = (coords >> 1) * 2 + offset
+            separated = ((other >= 0) & (other < side)).all(axis=1) & (np.abs(other - coords).max(axis=1) > 1)
+            src = np.flatnonzero(separated)
+            other_ids = np.ravel_multi_index(other[src].T, (side,) * dim)
+            dst = np.minimum(np.searchsorted(cells, other_ids), len(cells) - 1)
+            src, dst = src[cells[dst] == other_ids], dst[cells[dst] == other_ids]
+            if len(src) == 0:
+                continue
+            delta = centroids[src] - centroids[dst]
+            distance2 = np.maximum((delta ** 2).sum(axis=1), 1e-4)
+            force[src] += delta * (cell_mass[dst] / distance2)[:, None]
+        leaf_force += force[leaf_cell]
+    force = leaf_force[node_slot]
+
+    #Near field: pairs of nodes in the same or in adjacent cells
+    slot = np.full(n_cells ** dim, -1, dtype=np.int64)
+    slot[occupied] = np.arange(len(occupied))
+    for offset in np.array(np.meshgrid(*[[-1, 0, 1]] * dim, indexing="ij")).reshape(dim, -1).T:
+        other = occupied_coords + offset
+        inside = ((other >= 0) & (other < n_cells)).all(axis=1)
+        src = np.flatnonzero(inside)
+        dst = slot[np.ravel_multi_index(other[inside].T, (n_cells,) * dim)]
+        src, dst = src[dst >= 0], dst[dst >= 0]
+        if len(src) == 0:
+            continue
+
+        #All (node of src cell, node of dst cell) pairs
+        n_pairs = counts[src] * counts[dst]
+        pair_cell = np.repeat(np.arange(len(src)), n_pairs)
+        local = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+        a = order[starts[src][pair_cell] + local // counts[dst][pair_cell]]
+        b = order[starts[dst][pair_cell] + local % counts[dst][pair_cell]]
+        a, b = a[a != b], b[a != b]
+
+        delta = pos[a] - pos[b]
+        distance2 = np.maximum((delta ** 2).sum(axis=1), 1e-4)
+        push = delta * (mass[b] / distance2)[:, None]
+        force += np.column_stack([np.bincount(a, weights=push[:, d], minlength=n) for d in range(dim)])
+
+    return force * (2 * mass * k * k)[:, None]
+
+
+# Attraction -2 A_ij d_ij / k along pos_i - pos_j, for the edges of the graph: with B_ij = A_ij d_ij,
+    # sum_j B_ij (pos_i - pos_j) = rowsum(B)_i pos_i - (B @ pos)_i
+def _attraction(pos, adjacency, entry_rows, k):
+    distance = np.sqrt(((pos[entry_rows] - pos[adjacency.indices]) ** 2).sum(axis=1))
+    pull = sp.csr_matrix((adjacency.data * distance, adjacency.indices, adjacency.indptr), shape=adjacency.shape)
+    return -2 * (np.asarray(pull.sum(axis=1)) * pos - pull @ pos) / k
+
+
+# Gravity: every node is pulled by its mass times the offset of its component's centroid from (0.5, 0.5, 0.5)
+def _gravity(pos, mass, component):
+    component_mass = np.bincount(component, weights=mass)
+    centroids = np.column_stack([np.bincount(component, weights=mass * pos[:, d]) for d in range(pos.shape[1])])
+    offset = centroids / component_mass[:, None] - 0.5
+    return -GRAVITY * mass[:, None] * offset[component]
+
+
+# Fruchterman-Reingold iterations (every node moves by the current temperature t, t decreases linearly) on the forces
+    # of the energy model of nx.spring_layout (attraction, repulsion, gravity), repulsion approximated on the grid.
+    # Checkpoints (level, iteration, positions, t, dt) every CHECKPOINT_EVERY iterations; a resumed run passes start
+    # and cooling = (t, dt) back
+def _fruchterman_reingold(pos, adjacency, mass, iterations, temperature, start=0, cooling=None, checkpoint=None,
+                          level=0, key=None):
+    n = pos.shape[0]
+    k = np.sqrt(1.0 / n)
+    if cooling is None:
+        t = temperature
+        dt = t / (iterations + 1)
+    else:
+        t, dt = cooling
+
+    entry_rows = np.repeat(np.arange(n), np.diff(adjacency.indptr))
+    _, component = connected_components(adjacency, directed=False)
+    for iteration in range(start, iterations):
+        displacement = _repulsion(pos, mass, k) + _attraction(pos, adjacency, entry_rows, k) + _gravity(pos, mass,
+                                                                                                       component)
+        length = np.maximum(np.sqrt((displacement ** 2).sum(axis=1)), 0.01)
+        pos = pos + displacement * (t / length)[:, None]
+        t -= dt
+
+        if checkpoint is not None and (iteration + 1) % CHECKPOINT_EVERY == 0:
+            np.savez(checkpoint, key=key, level=level, iteration=iteration + 1, pos=pos, t=t, dt=dt)
+    return pos
+
+
+def _load_checkpoint(checkpoint, key):
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return None
+    with np.load(checkpoint) as data:
+        if not np.array_equal(data["key"], key):
+            return None
+        return int(data["level"]), int(data["iteration"]), data["pos"], (float(data["t"]), float(data["dt"]))
+
+
+# Initial positions from an existing layout ({label: [x, y, z]}), mapped to the unit cube: nodes without one are placed
+    # at the weighted mean of their placed neighbours, or at random
+def _warm_positions(graph, adjacency, initial_pos, dim, rng):
+    labels = graph.node_labels
+    pos = np.full((len(labels), dim), np.nan)
+    known = np.array([label in initial_pos for label in labels], dtype=bool)
+    if known.any():
+        known_pos = np.array([initial_pos[label] for label, ok in zip(labels, known) if ok], dtype=np.float64)
+        pos[known] = _rescale(known_pos, 0.5) + 0.5
+
+    weights = adjacency[:, known]
+    total = np.asarray(weights.sum(axis=1)).ravel()
+    placed = ~known & (total > 0)
+    pos[placed] = (weights[placed] @ pos[known]) / total[placed, None]
+    missing = np.isnan(pos).any(axis=1)
+    low, high = (pos[~missing].min(axis=0), pos[~missing].max(axis=0)) if (~missing).any() else (0.0, 1.0)
+    pos[missing] = low + (high - low) * rng.random((missing.sum(), dim))
+    return pos
+
+
+# Same scaling as nx.rescale_layout: centered, largest coordinate (in absolute value) = scale
+def _rescale(pos, scale=1.0):
+    pos = pos - pos.mean(axis=0)
+    lim = np.abs(pos).max()
+    return pos * (scale / lim) if lim > 0 else pos
+
+
+# 3D force directed layout of a CSRGraph (positions in `nodes` order, rescaled like nx.spring_layout).
+    # Multilevel: the graph is coarsened by heavy edge matching, the coarsest level is seeded with a spectral
+    # embedding and every level is refined by grid Fruchterman-Reingold starting from the coarser one.
+    # With initial_pos ({label: position}, e.g. the graph_layout_no_fungi positions) the layout is only refined.
+    # With checkpoint (a .npz path) the progress is saved periodically and an interrupted run resumes from it
+def spring_layout_3d(graph, initial_pos=None, seed=42, dim=3, checkpoint=None):
+    adjacency = _layout_adjacency(graph)
+    n = adjacency.shape[0]
+    #A checkpoint is only resumed for the same graph (content hash of the CSR arrays), seed and start mode
+    digest = hashlib.sha256(np.array([n, seed, initial_pos is not None], dtype=np.int64).tobytes())
+    for array in (adjacency.indptr, adjacency.indices, adjacency.data):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    key = np.array(digest.hexdigest())
+    resume = _load_checkpoint(checkpoint, key)
+    if n == 0:
+        return np.zeros((0, dim))
+
+    if initial_pos is not None:
+        start, cooling = 0, None
+        if resume is not None:
+            _, start, pos, cooling = resume
+        else:
+            pos = _warm_positions(graph, adjacency, initial_pos, dim, np.random.default_rng(seed))
+        pos = _fruchterman_reingold(pos, adjacency, np.ones(n), WARM_ITERATIONS, FINE_TEMPERATURE, start, cooling,
+                                    checkpoint, 0, key)
+    else:
+        levels = _hierarchy(adjacency, seed)
+        print(f"Layout levels (nodes): {[level[0].shape[0] for level in levels]}")
+        first_level, start, cooling = len(levels) - 1, 0, None
+        if resume is not None:
+            first_level, start, pos, cooling = resume
+        else:
+            pos = _spectral_embedding(levels[-1][0], dim, np.random.default_rng(seed))
+
+        for level in range(first_level, -1, -1):
+            level_adjacency, mass, aggregation = levels[level]
+            if level < first_level:
+                #Children start at the position of their parent, slightly spread
+                parent = levels[level][2].indices
+                spread = np.sqrt(1.0 / level_adjacency.shape[0]) * 0.1
+                pos = pos[parent] + spread * np.random.default_rng([seed, level]).standard_normal((len(parent), dim))
+            coarsest = level == len(levels) - 1
+            pos = _fruchterman_reingold(pos, level_adjacency, mass,
+                                        COARSE_ITERATIONS if coarsest else FINE_ITERATIONS,
+                                        COARSE_TEMPERATURE if coarsest else FINE_TEMPERATURE,
+                                        start, cooling, checkpoint, level, key)
+            start, cooling = 0, None
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return _rescale(pos)
+
+
+def _component_task(c, seed, checkpoint):
+    return spring_layout_3d(_shared["components"][c], initial_pos=_shared["initial_pos"], seed=seed,
+                            checkpoint=checkpoint)
+
+
+# Shelf packing of cubes (sides, largest first) in a roughly cubic box: rows along x, rows stacked along y, layers
+    # along z. Returns the centres of the cubes
+def _pack(sides):
+    limit = max(sides.max(), np.sum(sides ** 3) ** (1.0 / 3.0))
+    centres = np.zeros((len(sides), 3))
+    x = y = z = row_depth = layer_height = 0.0
+    for c, side in enumerate(sides):
+        if x > 0 and x + side > limit:
+            x, y, row_depth = 0.0, y + row_depth, 0.0
+        if y > 0 and y + side > limit:
+            x, y, z, layer_height = 0.0, 0.0, z + layer_height, 0.0
+        centres[c] = (x + side / 2, y + side / 2, z + side / 2)
+        x += side
+        row_depth, layer_height = max(row_depth, side), max(layer_height, side)
+    return centres
+
+
+# 3D layout of a CSRGraph component by component (positions in `nodes` order): components larger than
+    # TRIVIAL_COMPONENT get spring_layout_3d in parallel, largest first, the smaller ones fixed positions. Every
+    # component is scaled by the cube root of its size and packed in a box, then the whole layout is rescaled
+    # like nx.spring_layout. initial_pos and checkpoint as in spring_layout_3d (one checkpoint file per component)
+def component_layout_3d(graph, initial_pos=None, seed=42, checkpoint=None, n_jobs=None):
+    components = graph.components()
+    large = [c for c, rows in enumerate(components) if len(rows) > TRIVIAL_COMPONENT]
+
+    _shared["components"] = [graph.subgraph(components[c]) for c in large]
+    _shared["initial_pos"] = initial_pos
+    try:
+        root, ext = os.path.splitext(checkpoint) if checkpoint is not None else (None, None)
+        tasks = [(i, seed, None if checkpoint is None else f"{root}_{i}{ext}") for i in range(len(large))]
+        layouts = dict(zip(large, map_tasks(_component_task, tasks, n_jobs=n_jobs)))
+    finally:
+        _shared.clear()
+
+    sizes = np.array([len(rows) for rows in components], dtype=np.float64)
+    scales = np.cbrt(sizes)
+    centres = _pack(2 * scales * (1 + PACKING_GAP))
+
+    pos = np.zeros((len(graph.labels), 3))
+    for c, rows in enumerate(components):
+        if c in layouts:
+            local = layouts[c]
+        elif len(rows) == 1:
+            local = np.zeros((1, 3))
+        else:
+            local = np.zeros((len(rows), 3))
+            local[:, 0] = np.linspace(-1, 1, len(rows))
+        pos[rows] = centres[c] + scales[c] * local
+    return _rescale(pos[graph.nodes])
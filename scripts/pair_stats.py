@@ -0,0 +1,79 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+# Streaming accumulator for the distribution of pairwise values (dissimilarities or similarities).
+    # Blocks are reduced to (distinct value, multiplicity) pairs as soon as they are produced, so memory
+    # depends on the number of distinct values, never on the number of pairs. Dissimilarities are integer
+    # (bacteria counts) and similarities are exp(-lam*D) of them, so distinct values stay few, and min/max,
+    # mean, the exact median and any fixed-bin histogram are recovered from them at the end.
+class PairStats:
+
+    def __init__(self):
+        self.values = np.empty(0, dtype=np.float64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def _add_counts(self, values, counts):
+        values = np.concatenate([self.values, values])
+        counts = np.concatenate([self.counts, counts])
+        self.values, inverse = np.unique(values, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=self.values.size).astype(np.int64)
+
+    # Adds values (any shape); with weights (integers, broadcastable to values) each value is counted weights times
+    def update(self, values, weights=None):
+        values = np.asarray(values, dtype=np.float64)
+        if weights is None:
+            values, counts = np.unique(values, return_counts=True)
+        else:
+            weights = np.broadcast_to(weights, values.shape).ravel()
+            values, inverse = np.unique(values.ravel(), return_inverse=True)
+            counts = np.bincount(inverse, weights=weights, minlength=values.size).astype(np.int64)
+        self._add_counts(values, counts)
+
+    # Adds `count` occurrences of the same value (e.g. the zeros not stored in a sparse matrix)
+    def add_constant(self, value, count):
+        if count > 0:
+            self._add_counts(np.array([value], dtype=np.float64), np.array([count], dtype=np.int64))
+
+    def merge(self, other):
+        self._add_counts(other.values, other.counts)
+        return self
+
+    # Takes back the values of other (which must all have been added before), e.g. the pairs of updated rows
+    def remove(self, other):
+        self._add_counts(other.values, -other.counts)
+        if np.any(self.counts < 0):
+            raise ValueError("Removing values that were never added")
+        present = self.counts > 0
+        self.values, self.counts = self.values[present], self.counts[present]
+        return self
+
+    @property
+    def n(self):
+        return int(self.counts.sum())
+
+    def min(self):
+        return self.values[0]
+
+    def max(self):
+        return self.values[-1]
+
+    def mean(self):
+        return np.dot(self.values, self.counts) / self.n
+
+    # Same as np.median over all the values: average of the two central values
+    def median(self):
+        n = self.n
+        cum = np.cumsum(self.counts)
+        low = self.values[np.searchsorted(cum, (n - 1) // 2, side="right")]
+        high = self.values[np.searchsorted(cum, n // 2, side="right")]
+        return (low + high) / 2
+
+    # Same counts as np.histogram over all the values
+    def histogram(self, bins):
+        counts, _ = np.histogram(self.values, bins=bins, weights=self.counts)
+        return counts
+
+    # Same figure as plt.hist over all the values
+    def plot_hist(self, bins, ax=None):
+        ax = plt.gca() if ax is None else ax
+        return ax.hist(bins[:-1], bins=bins, weights=self.histogram(bins))
@@ -0,0 +1,129 @@
+import numpy as np
+import scipy.sparse as sp
+from dissimilarity import similarity_rows
+
+#Default sketch size: N_BANDS bands of ROWS_PER_BAND weighted MinHash values each
+N_BANDS = 32
+ROWS_PER_BAND = 2
+#Buckets larger than this are split in chunks before generating pairs (bounds the quadratic cost of a bucket)
+MAX_BUCKET = 2000
+#Number of candidate pairs whose exact similarity is computed at once
+PAIR_CHUNK = 200_000
+
+
+# Weighted MinHash sketches of the rows (Ioffe's consistent weighted sampling, ICWS): the probability that two rows
+    # get the same value for a hash is their weighted Jaccard similarity sum_k min(A_ik, A_jk) / sum_k max(A_ik, A_jk).
+    # Returns a (n_rows, n_hashes, 2) array of (column, t) samples; empty rows get (-1, 0)
+def weighted_minhash(matrix, n_hashes, seed=42):
+    csr = sp.csr_matrix(matrix, dtype=np.float64)
+    csr.sum_duplicates()
+    n_rows, n_cols = csr.shape
+    rng = np.random.default_rng(seed)
+
+    entry_rows = np.repeat(np.arange(n_rows), np.diff(csr.indptr))
+    non_empty = np.flatnonzero(np.diff(csr.indptr) > 0)
+    log_w = np.log(csr.data)
+    sketches = np.zeros((n_rows, n_hashes, 2), dtype=np.int64)
+    sketches[:, :, 0] = -1
+
+    for h in range(n_hashes):
+        r = rng.gamma(2.0, 1.0, n_cols)
+        c = rng.gamma(2.0, 1.0, n_cols)
+        beta = rng.uniform(0.0, 1.0, n_cols)
+
+        k = csr.indices
+        t = np.floor(log_w / r[k] + beta[k])
+        a = np.log(c[k]) - r[k] * (t - beta[k]) - r[k]          #log of c / (y * exp(r)), y = exp(r * (t - beta))
+
+        #Per row argmin of a (first position in case of ties)
+        order = np.lexsort((a, entry_rows))
+        first = order[csr.indptr[non_empty]]
+        sketches[non_empty, h, 0] = k[first]
+        sketches[non_empty, h, 1] = t[first]
+
+    return sketches
+
+
+# Candidate pairs (i < j) of rows sharing at least one band of their sketches
+def lsh_candidates(sketches, n_bands=N_BANDS, rows_per_band=ROWS_PER_BAND, max_bucket=MAX_BUCKET):
+    n_rows = sketches.shape[0]
+    keys = []
+
+    for b in range(n_bands):
+        band = sketches[:, b * rows_per_band:(b + 1) * rows_per_band].reshape(n_rows, -1)
+        _, bucket = np.unique(band, axis=0, return_inverse=True)
+        bucket = bucket.ravel()
+
+        #Rows grouped by bucket, big buckets split in chunks of max_bucket rows
+        order = np.argsort(bucket, kind="stable")
+        sorted_bucket = bucket[order]
+        starts = np.flatnonzero(np.r_[True, sorted_bucket[1:] != sorted_bucket[:-1]])
+        pos = np.arange(n_rows) - np.repeat(starts, np.diff(np.r_[starts, n_rows]))
+        group = np.cumsum(np.r_[True, (sorted_bucket[1:] != sorted_bucket[:-1]) | (pos[1:] % max_bucket == 0)]) - 1
+        group_start = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+        group_end = np.r_[group_start[1:], n_rows]
+
+        #Every row is paired with the following rows of its group
+        n_pairs = group_end[group] - np.arange(n_rows) - 1
+        first = np.repeat(np.arange(n_rows), n_pairs)
+        second = first + 1 + np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+        i, j = order[first], order[second]
+        keys.append(np.minimum(i, j).astype(np.int64) * n_rows + np.maximum(i, j))
+
+    keys = np.unique(np.concatenate(keys)) if keys else np.empty(0, dtype=np.int64)
+    return np.divmod(keys, n_rows)
+
+
+# Exact similarities S = exp(-lam*D) of the given pairs (same operations as the exact kernel)
+def pair_similarities(matrix, i, j, lam):
+    csr = sp.csr_matrix(matrix, dtype=np.float64)
+    row_sums = np.asarray(csr.sum(axis=1)).ravel()
+    vals = np.empty(len(i), dtype=np.float64)
+
+    for s in range(0, len(i), PAIR_CHUNK):
+        ci, cj = i[s:s + PAIR_CHUNK], j[s:s + PAIR_CHUNK]
+        min_sums = np.asarray(csr[ci].minimum(csr[cj]).sum(axis=1)).ravel()
+        block = row_sums[ci] + row_sums[cj]
+        block -= 2.0 * min_sums
+        block[ci == cj] = 0.0
+        block[np.abs(block) < 1e-12] = 0.0
+        vals[s:s + PAIR_CHUNK] = np.exp(-lam * block)
+
+    return vals
+
+
+# Approximate thresholded similarity matrix: exact similarities, but only for the LSH candidate pairs
+    # (plus the diagonal). Same COO layout as dissimilarity.similarity_coo; pairs missed by the sketches are absent
+def lsh_similarity_coo(matrix, lam, threshold, n_bands=N_BANDS, rows_per_band=ROWS_PER_BAND, seed=42):
+    n_rows = matrix.shape[0]
+    sketches = weighted_minhash(matrix, n_bands * rows_per_band, seed=seed)
+    i, j = lsh_candidates(sketches, n_bands, rows_per_band)
+    print(f"LSH candidate pairs: {len(i)} ({2 * len(i) / max(n_rows * (n_rows - 1), 1):.2%} of all pairs)")
+
+    vals = pair_similarities(matrix, i, j, lam)
+    keep = ~(vals < threshold)
+    diag = np.arange(n_rows)
+    rows = np.concatenate([i[keep], j[keep], diag])
+    cols = np.concatenate([j[keep], i[keep], diag])
+    data = np.concatenate([vals[keep], vals[keep], np.ones(n_rows)])   #S[i, i] = exp(0) = 1
+
+    order = np.lexsort((cols, rows))
+    return sp.coo_matrix((data[order], (rows[order], cols[order])), shape=(n_rows, n_rows))
+
+
+# Recall of an approximate similarity matrix against the exact one on a sample of rows:
+    # fraction of the exact off-diagonal entries (S >= threshold) of the sampled rows that are also in approx
+def lsh_recall(matrix, approx, lam, threshold, sample_size=200, seed=42):
+    n_rows = matrix.shape[0]
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(n_rows, min(sample_size, n_rows), replace=False))
+
+    exact = similarity_rows(matrix, rows, lam, threshold)
+    exact_i, exact_j = rows[exact.row], exact.col
+    off_diag = exact_i != exact_j
+    if not off_diag.any():
+        return 1.0
+
+    approx = sp.csr_matrix(approx)
+    found = np.asarray(approx[exact_i[off_diag], exact_j[off_diag]]).ravel() != 0
+    return found.mean()
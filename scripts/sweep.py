@@ -0,0 +1,127 @@
+import hashlib
+import itertools
+import json
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from dsmz_processing import MATRIX_FILTERS, STAGING_DATA_DIR, load_matrix
+from dissimilarity import close_pairs_coo, dissimilarity_stats, map_tasks
+from csr_graph import CSRGraph
+from incremental import load_similarity_state
+import os
+
+#Parameter grid: similarity thresholds (dsmz_matrix.py) x sparsification PERCENT / M_MAX (graph.py)
+THRESHOLDS = (0.05, 0.10, 0.15, 0.20, 0.30)
+PERCENTS = (0.50, 0.70, 0.90)
+M_MAXS = (500, 2000)
+
+EDGES_DIR = os.path.join(STAGING_DATA_DIR, "sweep_edges_no_fungi")
+SUMMARY_FILE = os.path.join(STAGING_DATA_DIR, "sweep_summary_no_fungi.csv")
+DEGREES_FILE = os.path.join(STAGING_DATA_DIR, "sweep_degrees_no_fungi.csv")
+
+#Distance-sorted edges shared with the worker processes (inherited through fork, see dissimilarity.map_tasks)
+_shared = {}
+
+
+# Key of the distance-sorted edges: the taxon x habitat matrix and lambda
+def _edges_key(matrix, lam):
+    sha = hashlib.sha256()
+    for array in (matrix.indptr, matrix.indices, matrix.data, np.array(matrix.shape), np.array([lam])):
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+
+# All the pairs with S = exp(-lam*D) >= min_threshold sorted by increasing D (then row, column), stored once as .npy
+    # files in EDGES_DIR and memory-mapped: every threshold >= min_threshold is a prefix of them. Reused as long as the
+    # matrix and lambda are the same and the stored edges go down to min_threshold
+def distance_sorted_edges(matrix, lam, min_threshold, directory=EDGES_DIR):
+    key = _edges_key(matrix, lam)
+    info_file = os.path.join(directory, "edges.json")
+    if os.path.exists(info_file):
+        with open(info_file, "r") as f:
+            info = json.load(f)
+        if info["key"] == key and info["min_threshold"] <= min_threshold:
+            return tuple(np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                         for name in ("rows", "cols", "distances"))
+
+    #Small slack on d_max: the exact test S >= threshold is applied on the distances afterwards
+    d_max = np.log(1.0 / min_threshold) / lam * (1.0 + 1e-9) + 1e-9 if lam > 0 else np.inf
+    pairs = close_pairs_coo(matrix, d_max)
+    order = np.lexsort((pairs.col, pairs.row, pairs.data))
+    os.makedirs(directory, exist_ok=True)
+    for name, values in (("rows", pairs.row[order].astype(np.int32)), ("cols", pairs.col[order].astype(np.int32)),
+                         ("distances", pairs.data[order])):
+        np.save(os.path.join(directory, f"{name}.npy"), values)
+    with open(info_file, "w") as f:
+        json.dump({"key": key, "lam": lam, "min_threshold": min_threshold, "n_edges": int(pairs.nnz)}, f, indent=2)
+    print(f"\nSaved {pairs.nnz} distance-sorted edges (S >= {min_threshold}) in {os.path.basename(directory)}/")
+    return tuple(np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in ("rows", "cols", "distances"))
+
+
+# Number of leading edges with exp(-lam*D) >= threshold (same float64 test as dsmz_matrix.py, evaluated on the
+    # distinct distances only)
+def _prefix_length(distances, lam, threshold):
+    values = np.unique(distances)
+    kept = values[np.exp(-lam * values) >= threshold]
+    return int(np.searchsorted(distances, kept[-1], side="right")) if len(kept) else 0
+
+
+# One threshold of the grid: similarity graph of the prefix, its degrees and components, then every (percent, m_max)
+    # sparsification. Returns the summary rows and the weighted degrees (in node order)
+def _sweep_threshold(threshold, lam):
+    rows, cols, distances = _shared["edges"]
+    labels, n = _shared["labels"], len(_shared["labels"])
+    count = _shared["prefix"][threshold]
+    similarity = sp.coo_matrix((np.exp(-lam * distances[:count]), (rows[:count], cols[:count])), shape=(n, n))
+    graph = CSRGraph.from_coo(similarity, labels)
+    degrees = graph.weighted_degree()
+    components = graph.components()
+
+    summary = []
+    for percent, m_max in itertools.product(PERCENTS, M_MAXS):
+        sparse = graph.sparsify_top_percent(percent, m_max)
+        sparse_components = sparse.components()
+        summary.append({"threshold": threshold, "percent": percent, "m_max": m_max, "lambda": lam,
+                        "n_nodes": graph.n_nodes, "n_edges": graph.n_edges, "n_nonzero": similarity.nnz,
+                        "degree_mean": degrees.mean(), "degree_median": np.median(degrees), "degree_max": degrees.max(),
+                        "n_components": len(components), "largest_component": len(components[0]) if components else 0,
+                        "sparse_edges": sparse.n_edges,
+                        "sparse_components": len(sparse_components),
+                        "sparse_largest_component": len(sparse_components[0]) if sparse_components else 0})
+    return summary, graph.node_labels, degrees
+
+
+# Parameter sweep: lambda from the dissimilarity distribution (or the incremental state of the same matrix), the
+    # distances computed once, then one task per threshold in parallel. Saves the summary table (one row per
+    # threshold x percent x m_max) and the weighted degree distribution of every threshold
+def sweep(thresholds=THRESHOLDS, n_jobs=None):
+    matrix, row_labels, _ = load_matrix(**MATRIX_FILTERS)
+    state = load_similarity_state()
+    if state is not None and state["matrix"].shape == matrix.shape and (state["matrix"] != matrix).nnz == 0:
+        lam = float(state["lam"])
+    else:
+        lam = np.log(2) / dissimilarity_stats(matrix).median()
+    print(f"\nLambda: {lam:.6g}")
+
+    edges = distance_sorted_edges(matrix, lam, min(thresholds))
+    _shared["edges"] = edges
+    _shared["labels"] = np.asarray(row_labels)
+    _shared["prefix"] = {t: _prefix_length(edges[2], lam, t) for t in thresholds}
+    try:
+        results = list(map_tasks(_sweep_threshold, [(t, lam) for t in thresholds], n_jobs=n_jobs))
+    finally:
+        _shared.clear()
+
+    summary = pd.DataFrame([row for rows, _, _ in results for row in rows])
+    summary.to_csv(SUMMARY_FILE, index=False)
+    degrees = pd.concat([pd.DataFrame({"threshold": t, "ncbi": labels, "weighted_degree": d})
+                         for t, (_, labels, d) in zip(thresholds, results)], ignore_index=True)
+    degrees.to_csv(DEGREES_FILE, index=False)
+
+    print(summary.to_string(index=False))
+    print(f"\nSaved {os.path.basename(SUMMARY_FILE)} and {os.path.basename(DEGREES_FILE)}")
+    return summary
+
+
+if __name__ == "__main__":
+    sweep()
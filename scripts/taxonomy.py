@@ -0,0 +1,170 @@
+import io
+import json
+import tarfile
+import numpy as np
+from dsmz_processing import PROJECT_DIR, STAGING_DATA_DIR, source_hash
+import os
+
+#Local NCBI taxonomy dump (https://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz, the file ete3 builds its sqlite from)
+TAXDUMP_FILE = os.path.join(PROJECT_DIR, "project_data/initial_data/taxdump.tar.gz")
+TABLE_FILES = ("index", "taxid", "parent", "rank", "name_ptr", "name_bytes", "merged_old", "merged_new")
+
+
+def _dmp_rows(archive, member):
+    with io.TextIOWrapper(archive.extractfile(member), encoding="utf-8") as text:
+        for line in text:
+            yield line.rstrip("\n").rstrip("\t|").split("\t|\t")
+
+
+# Compact taxonomy table from taxdump.tar.gz, one row per taxid (in nodes.dmp order), all integer arrays:
+    # - index[taxid]: row of taxid (-1 if not in the dump), dense over 0..max taxid
+    # - taxid[row], parent[row] (row of the parent, the root is its own parent), rank[row] (code into rank_names)
+    # - name_bytes[name_ptr[row]:name_ptr[row+1]]: utf-8 scientific name of row (name id = row)
+    # - merged_old -> merged_new: taxids merged into other ones (merged.dmp), sorted by old taxid
+def _build_table(path, directory):
+    taxids, parents, rank_codes, rank_names = [], [], [], {}
+    with tarfile.open(path, "r:gz") as archive:
+        for fields in _dmp_rows(archive, "nodes.dmp"):
+            taxids.append(int(fields[0]))
+            parents.append(int(fields[1]))
+            rank_codes.append(rank_names.setdefault(fields[2], len(rank_names)))
+
+        names = {}
+        for fields in _dmp_rows(archive, "names.dmp"):
+            if fields[3] == "scientific name":
+                names[int(fields[0])] = fields[1]
+
+        merged = sorted((int(fields[0]), int(fields[1])) for fields in _dmp_rows(archive, "merged.dmp"))
+
+    taxid = np.array(taxids, dtype=np.int32)
+    index = np.full(int(taxid.max(initial=0)) + 1, -1, dtype=np.int32)
+    index[taxid] = np.arange(len(taxid), dtype=np.int32)
+    encoded = [names.get(t, "").encode("utf-8") for t in taxids]
+
+    arrays = {
+        "index": index,
+        "taxid": taxid,
+        "parent": index[np.array(parents, dtype=np.int64)],
+        "rank": np.array(rank_codes, dtype=np.int16),
+        "name_ptr": np.r_[0, np.cumsum([len(e) for e in encoded])].astype(np.int64),
+        "name_bytes": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        "merged_old": np.array([old for old, _ in merged], dtype=np.int32),
+        "merged_new": np.array([new for _, new in merged], dtype=np.int32),
+    }
+    os.makedirs(directory, exist_ok=True)
+    for name in TABLE_FILES:
+        np.save(os.path.join(directory, f"{name}.npy"), arrays[name])
+    with open(os.path.join(directory, "ranks.json"), "w") as f:
+        json.dump(list(rank_names), f)
+
+
+# NCBI taxonomy resolver on the memory-mapped table of a taxdump (built once in staging_data/taxonomy_<hash>/, keyed
+    # by the dump content). Bulk queries take arrays of integer taxids; taxids missing from the dump get `missing`.
+    # Same answers as ete3's NCBITaxa on the same dump: get_rank (no merged taxids) and get_taxid_translator
+    # (merged taxids answered with the name of the taxid they were merged into)
+class Taxonomy:
+
+    def __init__(self, directory):
+        self.directory = directory
+        for name in TABLE_FILES:
+            setattr(self, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r"))
+        with open(os.path.join(directory, "ranks.json"), "r") as f:
+            self.rank_names = np.array(json.load(f), dtype=object)
+
+    @classmethod
+    def load(cls, path=TAXDUMP_FILE, cache_dir=STAGING_DATA_DIR):
+        directory = os.path.join(cache_dir, f"taxonomy_{source_hash(path, cache_dir)[:16]}")
+        if not os.path.exists(os.path.join(directory, "ranks.json")):
+            print(f"Building the taxonomy table from {os.path.basename(path)} (only once)")
+            _build_table(path, directory)
+        return cls(directory)
+
+    # Rows of the taxids (-1 if not in the dump)
+    def rows(self, taxids):
+        taxids = np.asarray(taxids, dtype=np.int64)
+        inside = (taxids >= 0) & (taxids < len(self.index))
+        rows = np.full(taxids.shape, -1, dtype=np.int64)
+        rows[inside] = self.index[taxids[inside]]
+        return rows
+
+    # Taxids after following merged.dmp (unchanged if not merged)
+    def translate_merged(self, taxids):
+        taxids = np.array(taxids, dtype=np.int64)
+        position = np.minimum(np.searchsorted(self.merged_old, taxids), max(len(self.merged_old) - 1, 0))
+        if len(self.merged_old):
+            merged = self.merged_old[position] == taxids
+            taxids[merged] = self.merged_new[position[merged]]
+        return taxids
+
+    # Rank codes (indices into rank_names) of the taxids, -1 if not in the dump
+    def rank_codes(self, taxids):
+        rows = self.rows(taxids)
+        codes = np.full(rows.shape, -1, dtype=np.int64)
+        codes[rows >= 0] = self.rank[rows[rows >= 0]]
+        return codes
+
+    def ranks(self, taxids, missing="Unknown"):
+        codes = self.rank_codes(taxids)
+        out = np.full(codes.shape, missing, dtype=object)
+        out[codes >= 0] = self.rank_names[codes[codes >= 0]]
+        return out
+
+    def names(self, taxids, missing="Unknown"):
+        rows = self.rows(taxids)
+        not_found = rows < 0
+        rows[not_found] = self.rows(self.translate_merged(np.asarray(taxids)[not_found]))
+        out = np.full(rows.shape, missing, dtype=object)
+        found = np.flatnonzero(rows >= 0)
+        if len(found):
+            #Bytes of all the names gathered at once, decoded in one go and split on a NUL separator
+            starts, ends = self.name_ptr[rows[found]], self.name_ptr[rows[found] + 1]
+            lengths = ends - starts + 1
+            positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+            separator = np.zeros(lengths.sum(), dtype=bool)
+            separator[np.cumsum(lengths) - 1] = True
+            buffer = np.zeros(lengths.sum(), dtype=np.uint8)
+            buffer[~separator] = self.name_bytes[positions[~separator]]
+            out[found] = buffer.tobytes().decode("utf-8").split("\0")[:-1]
+        return out
+
+    # Full lineages (root first, taxid last) of many taxids at once, walking all the parent pointers together.
+        # Returns (ptr, lineage): lineage[ptr[i]:ptr[i+1]] are the taxids of the lineage of taxids[i] (empty if missing)
+    def lineages(self, taxids):
+        current = self.rows(taxids)
+        steps = [current]
+        while True:
+            alive = current >= 0
+            parent = np.full(current.shape, -1, dtype=np.int64)
+            parent[alive] = self.parent[current[alive]]
+            parent[parent == current] = -1                      #the root is its own parent
+            if not np.any(parent >= 0):
+                break
+            steps.append(parent)
+            current = parent
+
+        path = np.stack(steps[::-1], axis=1) if len(steps) > 1 else steps[0][:, None]
+        present = path >= 0
+        ptr = np.r_[0, np.cumsum(present.sum(axis=1))]
+        return ptr, np.asarray(self.taxid)[path[present]].astype(np.int64)
+
+    # Ancestor (or the taxid itself) of every taxid at each of the given ranks, e.g. ("phylum", "genus"), walking all
+        # the parent pointers together: {rank: array of taxids, -1 where the lineage has no taxon of that rank}
+    def ancestors(self, taxids, ranks):
+        codes = {r: np.flatnonzero(self.rank_names == r) for r in ranks}
+        current = self.rows(taxids)
+        found = {r: np.full(current.shape, -1, dtype=np.int64) for r in ranks}
+        while np.any(current >= 0):
+            alive = np.flatnonzero(current >= 0)
+            rows = current[alive]
+            rank = np.asarray(self.rank[rows])
+            for r, code in codes.items():
+                hit = np.isin(rank, code) & (found[r][alive] < 0)
+                found[r][alive[hit]] = self.taxid[rows[hit]]
+            parent = np.asarray(self.parent[rows], dtype=np.int64)
+            parent[parent == rows] = -1                         #the root is its own parent
+            current[alive] = parent
+        return found
+
+    def lineage(self, taxid):
+        ptr, lineage = self.lineages([taxid])
+        return lineage.tolist()
@@ -0,0 +1,116 @@
+import base64
+import json
+import shutil
+import numpy as np
+import plotly.graph_objects as go
+from community_summary import community_codes
+from dsmz_processing import PROJECT_DIR
+import os
+
+RESULTS_DIR = os.path.join(PROJECT_DIR, "results")
+LOD_DIR = os.path.join(RESULTS_DIR, "louvain_3d_lod_no_fungi")
+
+#Points of a community shown before it is expanded (one per occupied voxel of an adaptive grid)
+PREVIEW_POINTS = 256
+#Largest communities with their own trace; the others are only shown by their centroid
+MAX_COMMUNITY_TRACES = 300
+#Voxel grid refinement limit of the decimation (grid of 2^k cells per axis)
+MAX_GRID = 1024
+
+
+# Indices of at most k points spread over the space they occupy: the finest grid (2^g cells per axis) with at most k
+    # occupied voxels, first point of every occupied voxel
+def decimate(points, k=PREVIEW_POINTS):
+    if len(points) <= k:
+        return np.arange(len(points))
+    lo, hi = points.min(axis=0), points.max(axis=0)
+    span = np.where(hi > lo, hi - lo, 1.0)
+    best, g = np.zeros(1, dtype=np.int64), 1
+    while g <= MAX_GRID:
+        cell = np.minimum(((points - lo) / span * g).astype(np.int64), g - 1)
+        _, first = np.unique((cell[:, 0] * g + cell[:, 1]) * g + cell[:, 2], return_index=True)
+        if len(first) > k:
+            break
+        best, g = first, g * 2
+    return np.sort(best)
+
+
+def _b64(values):
+    return base64.b64encode(np.ascontiguousarray(values, dtype="<f4").tobytes()).decode("ascii")
+
+
+# Level of detail 3D viewer of the communities for large graphs: one Scatter3d trace per community (the
+    # max_traces largest) holding a decimated preview, a centroid trace for the others, coordinates as binary typed
+    # arrays and colors as one string per trace. A click on a community loads its full points from a sidecar
+    # communities/<code>.js (plain script tag, works from file://). The html and the shared plotly.min.js only grow
+    # with the number of communities, not of nodes. colors maps a community id to its color
+def write_lod_viewer(labels, x, y, z, communities, colors, directory=LOD_DIR, preview_points=PREVIEW_POINTS,
+                     max_traces=MAX_COMMUNITY_TRACES):
+    labels = np.asarray(labels).astype(str)
+    points = np.column_stack([x, y, z]).astype(np.float32)
+    node_codes, ids, sizes = community_codes(communities)
+    by_code = np.argsort(node_codes, kind="stable")
+    members = np.split(by_code, np.cumsum(sizes)[:-1])
+    centroids = np.column_stack([np.bincount(node_codes, weights=points[:, a], minlength=len(ids)) / sizes
+                                 for a in range(3)]).astype(np.float32)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(os.path.join(directory, "communities"))
+
+    traces, sources = [], {}
+    for code in range(min(max_traces, len(ids))):
+        nodes = members[code]
+        preview = nodes[decimate(points[nodes], preview_points)]
+        full = len(preview) == len(nodes)
+        traces.append(go.Scatter3d(
+            x=points[preview, 0], y=points[preview, 1], z=points[preview, 2], mode="markers",
+            marker=dict(size=2, color=colors[ids[code]]), text=labels[preview].tolist(),
+            name=f"{ids[code]} ({sizes[code]}{'' if full else ', preview'})",
+            hovertemplate=f"<b>NCBI:</b> %{{text}}<br>Community: {ids[code]}<br><extra></extra>"))
+        if not full:
+            trace = len(traces) - 1
+            sources[trace] = f"communities/{code}.js"
+            with open(os.path.join(directory, sources[trace]), "w") as f:
+                data = {"x": _b64(points[nodes, 0]), "y": _b64(points[nodes, 1]), "z": _b64(points[nodes, 2]),
+                        "text": labels[nodes].tolist(), "name": f"{ids[code]} ({sizes[code]})"}
+                f.write(f"VIEWER3D_COMMUNITY({trace}, {json.dumps(data)});\n")
+
+    rest = np.arange(min(max_traces, len(ids)), len(ids))
+    if len(rest):
+        traces.append(go.Scatter3d(
+            x=centroids[rest, 0], y=centroids[rest, 1], z=centroids[rest, 2], mode="markers",
+            marker=dict(size=np.clip(np.log2(sizes[rest]) + 2, 2, 10).astype(np.float32),
+                        color=[colors[c] for c in ids[rest].tolist()]),
+            customdata=np.column_stack([ids[rest], sizes[rest]]), name=f"{len(rest)} smaller communities (centroids)",
+            hovertemplate="Community: %{customdata[0]}<br>Size: %{customdata[1]}<extra></extra>"))
+
+    fig = go.Figure(data=traces)
+    fig.update_layout(title=f"{len(labels)} taxa, {len(ids)} communities (click a community to load all its nodes)",
+                      legend=dict(itemsizing="constant"))
+    fig.write_html(os.path.join(directory, "index.html"), include_plotlyjs="directory",
+                   post_script=VIEWER_SCRIPT.replace("SOURCES", json.dumps(sources)))
+    return os.path.join(directory, "index.html")
+
+
+#Expansion on demand: the sidecar of the clicked trace is loaded once and replaces its preview
+VIEWER_SCRIPT = """
+var gd = document.getElementById('{plot_id}');
+var sources = SOURCES, loaded = {};
+function decodeFloat32(s) {
+  var bytes = atob(s), u = new Uint8Array(bytes.length);
+  for (var i = 0; i < bytes.length; i++) u[i] = bytes.charCodeAt(i);
+  return new Float32Array(u.buffer);
+}
+window.VIEWER3D_COMMUNITY = function (trace, data) {
+  Plotly.restyle(gd, {x: [decodeFloat32(data.x)], y: [decodeFloat32(data.y)], z: [decodeFloat32(data.z)],
+                      text: [data.text], name: data.name}, [trace]);
+};
+gd.on('plotly_click', function (e) {
+  var trace = e.points[0].curveNumber;
+  if (!(trace in sources) || loaded[trace]) return;
+  loaded[trace] = true;
+  var script = document.createElement('script');
+  script.src = sources[trace];
+  document.head.appendChild(script);
+});
+"""
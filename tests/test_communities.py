@@ -0,0 +1,88 @@
+import sys
+import numpy as np
+import networkx as nx
+import scipy.sparse as sp
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+import communities
+from communities import louvain, modularity
+
+RESOLUTIONS = (0.5, 1.0, 2.0)
+
+
+def _matrix(graph):
+    matrix = sp.csr_matrix(nx.to_scipy_sparse_array(graph, nodelist=sorted(graph), format="csr").astype(np.float64))
+    matrix.sort_indices()
+    return matrix
+
+
+#Barabasi-Albert, caveman and dense G(n, p) graphs: the batched moves conflict most on these
+def _graphs():
+    for seed in range(4):
+        yield nx.barabasi_albert_graph(200, 3, seed=seed)
+        yield nx.connected_caveman_graph(6 + seed, 5)
+        yield nx.gnp_random_graph(80, 0.3, seed=seed)
+
+
+def test_modularity_matches_networkx():
+    graph = nx.karate_club_graph()
+    community = np.array([graph.nodes[i]["club"] == "Officer" for i in sorted(graph)], dtype=np.int64)
+    groups = [set(np.flatnonzero(community == c).tolist()) for c in (0, 1)]
+    for resolution in RESOLUTIONS:
+        expected = nx.community.modularity(graph, groups, weight="weight", resolution=resolution)
+        assert np.isclose(modularity(_matrix(graph), community, resolution), expected)
+
+
+def test_louvain_recovers_caves():
+    n_caves, size = 8, 6
+    matrix = _matrix(nx.connected_caveman_graph(n_caves, size))
+    for seed in range(4):
+        community = louvain(matrix, seed=seed)
+        assert community.max() + 1 == n_caves
+        caves = np.arange(n_caves * size) // size
+        assert all(len(np.unique(community[caves == c])) == 1 for c in range(n_caves))
+
+
+def test_batch_gain_is_exact():
+    rng = np.random.default_rng(0)
+    matrix = _matrix(nx.gnp_random_graph(60, 0.2, seed=1))
+    degree = np.asarray(matrix.sum(axis=1)).ravel()
+    nodes = communities._coloring(matrix, rng)[0]
+    for resolution in RESOLUTIONS:
+        community = rng.integers(0, 5, matrix.shape[0])
+        targets = rng.integers(0, 5, len(nodes))
+        links = np.array([[matrix[i, community == c].sum() for c in range(5)] for i in nodes])
+        link_gain = links[np.arange(len(nodes)), targets] - links[np.arange(len(nodes)), community[nodes]]
+        totals = np.bincount(community, weights=degree, minlength=matrix.shape[0])
+        delta, new_totals = communities._batch_gain(totals, community[nodes], targets, degree[nodes], link_gain,
+                                                    degree.sum(), resolution)
+        moved = community.copy()
+        moved[nodes] = targets
+        assert np.isclose(delta, modularity(matrix, moved, resolution) - modularity(matrix, community, resolution))
+        assert np.allclose(new_totals, np.bincount(moved, weights=degree, minlength=matrix.shape[0]))
+
+
+#The partition returned by every local moving phase (every level of louvain) has a modularity at least the one at the
+    # start of its last pass: a pass whose batches conflict on the community totals never returns a worse partition
+def test_local_moving_never_lowers_modularity(monkeypatch):
+    moving_pass, local_moving = communities._moving_pass, communities._local_moving
+    pass_starts = []
+
+    def recording_pass(matrix, classes, community, *args):
+        pass_starts.append(modularity(matrix, community, args[-2]))
+        return moving_pass(matrix, classes, community, *args)
+
+    def checked(matrix, resolution, rng):
+        pass_starts.clear()
+        community, moved = local_moving(matrix, resolution, rng)
+        assert modularity(matrix, community, resolution) >= pass_starts[-1] - 1e-12
+        return community, moved
+
+    monkeypatch.setattr(communities, "_moving_pass", recording_pass)
+    monkeypatch.setattr(communities, "_local_moving", checked)
+    for graph in _graphs():
+        matrix = _matrix(graph)
+        for resolution in RESOLUTIONS:
+            for seed in range(3):
+                louvain(matrix, resolution=resolution, seed=seed)
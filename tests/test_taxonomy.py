@@ -0,0 +1,67 @@
+import io
+import sys
+import tarfile
+import numpy as np
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+from taxonomy import Taxonomy
+
+#Tiny taxdump: root > Bacteria > Pseudomonadota > Gammaproteobacteria > Escherichia > Escherichia coli,
+    # 469 (Acinetobacter, genus under the class), 12345 merged into 562, 999 not in the dump
+NODES = [(1, 1, "no rank"), (2, 1, "superkingdom"), (1224, 2, "phylum"), (1236, 1224, "class"),
+         (561, 1236, "genus"), (562, 561, "species"), (469, 1236, "genus")]
+NAMES = [(1, "root", "scientific name"), (2, "Bacteria", "scientific name"), (2, "eubacteria", "synonym"),
+         (1224, "Pseudomonadota", "scientific name"), (1224, "Proteobacteria", "synonym"),
+         (1236, "Gammaproteobacteria", "scientific name"), (561, "Escherichia", "scientific name"),
+         (562, "Escherichia coli", "scientific name"), (469, "Acinetobacter", "scientific name")]
+MERGED = [(12345, 562)]
+
+
+def _dmp(rows):
+    return "".join("\t|\t".join(map(str, row)) + "\t|\n" for row in rows).encode("utf-8")
+
+
+def _taxonomy(tmp_path):
+    path = os.path.join(tmp_path, "taxdump.tar.gz")
+    with tarfile.open(path, "w:gz") as archive:
+        for member, rows in (("nodes.dmp", [(t, p, r, "", 0) for t, p, r in NODES]),
+                             ("names.dmp", [(t, n, "", c) for t, n, c in NAMES]),
+                             ("merged.dmp", MERGED)):
+            data = _dmp(rows)
+            info = tarfile.TarInfo(member)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return Taxonomy.load(path, cache_dir=str(tmp_path))
+
+
+def test_ranks(tmp_path):
+    taxonomy = _taxonomy(tmp_path)
+    ranks = taxonomy.ranks([562, 1224, 1, 999, 12345])
+    #Like ete3's get_rank, a merged taxid has no rank of its own
+    assert ranks.tolist() == ["species", "phylum", "no rank", "Unknown", "Unknown"]
+    assert taxonomy.ranks([999], missing="Unknown_rank").tolist() == ["Unknown_rank"]
+
+
+def test_names(tmp_path):
+    taxonomy = _taxonomy(tmp_path)
+    names = taxonomy.names([562, 12345, 2, 999, 1224])
+    assert names.tolist() == ["Escherichia coli", "Escherichia coli", "Bacteria", "Unknown", "Pseudomonadota"]
+
+
+def test_lineages(tmp_path):
+    taxonomy = _taxonomy(tmp_path)
+    ptr, lineage = taxonomy.lineages([562, 999, 469, 1])
+    lineages = [lineage[ptr[i]:ptr[i + 1]].tolist() for i in range(len(ptr) - 1)]
+    assert lineages == [[1, 2, 1224, 1236, 561, 562], [], [1, 2, 1224, 1236, 469], [1]]
+    assert taxonomy.lineage(561) == [1, 2, 1224, 1236, 561]
+
+
+def test_ancestors(tmp_path):
+    taxonomy = _taxonomy(tmp_path)
+    found = taxonomy.ancestors([562, 469, 999, 2], ("phylum", "genus", "species", "order"))
+    assert found["phylum"].tolist() == [1224, 1224, -1, -1]
+    assert found["genus"].tolist() == [561, 469, -1, -1]
+    assert found["species"].tolist() == [562, -1, -1, -1]
+    assert found["order"].tolist() == [-1, -1, -1, -1]
+    assert all(np.asarray(values).dtype == np.int64 for values in found.values())